@@ -8,12 +8,33 @@
     :license: MIT
 """
 
+import os
+
 from flask import Flask
 from TrendEngine.calculations.routes import calculations
+from TrendEngine.calculations.dbest_pool import default_workers
+from TrendEngine.calculations import runtime
 from TrendEngine.main.routes import main
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = '5791628bb0b13ce0c676dfde280ba245'
+# number of worker processes running DBEST on polygons, 1 runs it in the server process
+app.config['DBEST_WORKERS'] = default_workers()
+# polygons are analysed in background jobs, the browser follows their progress
+app.config['ASYNC_POLYGON_JOBS'] = True
+# number of polygon analyses running at the same time
+app.config['JOB_WORKERS'] = 2
+# previews of polygons are analysed at the scale of the dataset times this factor
+app.config['PREVIEW_SCALE_FACTOR'] = 4
+# results of analysed pixels are stored and reused by overlapping polygons, see pixelstore.py;
+# off unless TRENDENGINE_PIXEL_STORE=1
+app.config['PIXEL_STORE'] = os.environ.get('TRENDENGINE_PIXEL_STORE', '0') == '1'
+# initialize Earth Engine and R and import the analyses now instead of on the first request,
+# for servers that import the app once and then fork, e.g. gunicorn --preload
+app.config['WARM_UP'] = runtime.WARM_UP
 
 app.register_blueprint(calculations)
-app.register_blueprint(main)
\ No newline at end of file
+app.register_blueprint(main)
+
+if app.config['WARM_UP']:
+    runtime.warm_up()
@@ -0,0 +1,422 @@
+""" Batch runs of PolyTrend and DBEST over large areas, without the web app
+
+    The area of interest is read from a GeoJSON file, or from a text file
+    with coordinates as they are posted from home.html, and every polygon
+    is split into blocks of pixels of one grid (see grid.py). The blocks are fetched from
+    Earth Engine one after the other, the next one while the current one
+    is analysed. The pixels of a block are split into chunks, which worker
+    processes analyse with the functions of the web app
+    (iter_polytrend_polygon and iter_dbest_polygon). The results are
+    appended to a Parquet file as the chunks finish. A summary with the
+    statistics of all pixels and the throughput is written at the end.
+
+    Usage, from the root of the repository:
+        python -m TrendEngine.batch --aoi area.geojson --dataset MODIS/006/MOD13Q1_NDVI \\
+            --from-year 2001 --to-year 2018 --algorithm polytrend --engine numpy
+
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from .calculations import runtime
+from .calculations.grid import GRID_CRS, grid_latitude, grid_step
+from .calculations.catalog import DATASETS, covers_years, get_dataset
+from .calculations.earthengine import ee
+from .calculations.export import ParquetStream, make_export_directory
+from .calculations.fetch import get_bounds
+from .calculations.pixelcube import PixelCube
+from .calculations.results import whole_table
+from .calculations.summary import make_summary
+from .calculations.utils import get_dataset_for_polygon, parse_coordinates
+
+# pixels per side of a block fetched from Earth Engine at once
+BLOCK_PIXELS = 500
+# pixels analysed by a worker at once
+CHUNK_PIXELS = 5000
+
+
+def read_aoi(path):
+    """ Polygons of the area of interest
+
+    Args:
+        path: string
+            GeoJSON file with a Polygon, MultiPolygon, Feature or
+            FeatureCollection, or a text file with coordinates as they are
+            posted from home.html, e.g. '[[[13, 54], [15, 53], [13, 53]]]'
+
+    Returns:
+        polygons : list
+            rings of each polygon, the first ring is the outer one
+
+    """
+    with open(path) as aoi_file:
+        text = aoi_file.read()
+    try:
+        geojson = json.loads(text)
+    except ValueError:
+        geojson = None
+    if not isinstance(geojson, dict):
+        coordinates = parse_coordinates(text)
+        return [[list(zip(coordinates[0::2], coordinates[1::2]))]]
+
+    if geojson["type"] == "FeatureCollection":
+        geometries = [feature["geometry"] for feature in geojson["features"]]
+    elif geojson["type"] == "Feature":
+        geometries = [geojson["geometry"]]
+    else:
+        geometries = [geojson]
+    polygons = []
+    for geometry in geometries:
+        if geometry["type"] == "Polygon":
+            polygons.append(geometry["coordinates"])
+        elif geometry["type"] == "MultiPolygon":
+            polygons.extend(geometry["coordinates"])
+        else:
+            raise ValueError("%s is not a polygon" % geometry["type"])
+    return polygons
+
+
+def plan_blocks(bounds, scale, latitude, block_pixels=BLOCK_PIXELS):
+    """ Splits a rectangle into blocks of block_pixels x block_pixels pixels
+
+    Pixels are those of the grid at the latitude, see grid.py.
+
+    Returns:
+        blocks : list
+            west, south, east and north edge of each block
+
+    """
+    west, south, east, north = bounds
+    width, height = grid_step(scale, latitude)
+    step_x, step_y = block_pixels * width, block_pixels * height
+    columns = max(1, math.ceil((east - west) / step_x))
+    rows = max(1, math.ceil((north - south) / step_y))
+    return [
+        (
+            west + column * step_x,
+            south + row * step_y,
+            min(east, west + (column + 1) * step_x),
+            min(north, south + (row + 1) * step_y),
+        )
+        for row in range(rows)
+        for column in range(columns)
+    ]
+
+
+def make_composite(algorithm, collection, start_year, end_year):
+    """ Annual composite for PolyTrend or monthly composite for DBEST
+
+    Returns:
+        composite, number_of_images : ee.ImageCollection, int
+
+    """
+    if algorithm == "polytrend":
+        from .calculations.polytrend import make_annual_composite
+
+        return (
+            make_annual_composite(collection, start_year, end_year),
+            end_year - start_year + 1,
+        )
+    from .calculations.dbest import make_monthly_composite
+
+    return (
+        make_monthly_composite(collection, start_year, end_year),
+        12 * (end_year - start_year + 1),
+    )
+
+
+def fetch_block(
+    composite, aoi, block, dataset_info, latitude, algorithm, number_of_images
+):
+    """ Time series of the pixels of the AOI whose centre lies in the block
+
+    Pixels are those of the grid at the latitude, see grid.py. getRegion
+    returns pixels on the edge of two blocks for both, so only those in the
+    half-open block [west, east) x [south, north) are kept.
+
+    Returns:
+        dataset : dataframe
+            as returned by get_dataset_for_polygon, possibly empty
+
+    """
+    west, south, east, north = block
+    geometry = ee.Geometry.Rectangle(list(block)).intersection(aoi, 1)
+    dataset = get_dataset_for_polygon(
+        algorithm == "polytrend",
+        composite,
+        geometry,
+        dataset_info["scale"],
+        GRID_CRS,
+        latitude,
+        number_of_images=number_of_images,
+        number_of_bands=dataset_info["number_of_bands"],
+    )
+    longitudes = dataset["longitude"].astype(np.float64)
+    latitudes = dataset["latitude"].astype(np.float64)
+    inside = (
+        (longitudes >= west)
+        & (longitudes < east)
+        & (latitudes >= south)
+        & (latitudes < north)
+    )
+    return dataset[inside]
+
+
+def _init_worker(engine):
+    """ Starts R once in a worker process when the R packages are used """
+    if engine == "r":
+        runtime.warm_up_r()
+
+
+def analyse_chunk(task):
+    """ Runs PolyTrend or DBEST on a chunk of pixels, in a worker process
+
+    Args:
+        task: tuple
+            algorithm, PixelCube of the chunk and the options built by run()
+
+    Returns:
+        result : ResultTable
+            results of the qualified pixels of the chunk, see results.py
+
+    """
+    algorithm, cube, options = task
+    if algorithm == "polytrend":
+        from .calculations.polytrend import iter_polytrend_polygon
+
+        chunks = iter_polytrend_polygon(
+            cube,
+            options["alpha"],
+            options["ndvi_threshold"],
+            options["engine"],
+            options["chunk_size"],
+        )
+    else:
+        from .calculations.dbest import iter_dbest_polygon
+
+        chunks = iter_dbest_polygon(
+            options["dbest_parameters"],
+            cube,
+            options["ndvi_threshold"],
+            1,
+            options["engine"],
+        )
+    for _, _, chunk in chunks:
+        # every chunk is a view on the table of all pixels of the task
+        result = whole_table(chunk)
+    return result
+
+
+def make_options(args, dataset_info):
+    """ Parameters of the analysis passed to every worker """
+    from .calculations import polytrend_engine, rbridge
+
+    options = {
+        "alpha": args.alpha,
+        "engine": args.engine,
+        "ndvi_threshold": dataset_info["ndvi_threshold"],
+        "chunk_size": rbridge.CHUNK_SIZE
+        if args.engine == "r"
+        else polytrend_engine.CHUNK_SIZE,
+    }
+    if args.algorithm == "dbest":
+        distance_threshold = args.distance_threshold
+        if distance_threshold != "default":
+            distance_threshold = float(distance_threshold)
+        options["dbest_parameters"] = dict(
+            data_type="cyclical",
+            seasonality=args.seasonality,
+            algorithm=args.dbest_algorithm,
+            breakpoints_no=args.breakpoints_no,
+            first_level_shift=args.first_level_shift,
+            second_level_shift=args.second_level_shift,
+            duration=args.duration,
+            distance_threshold=distance_threshold,
+            alpha=args.alpha,
+        )
+    return options
+
+
+def run(args):
+    """ Analyses the whole AOI and writes the results to args.output
+
+    Returns:
+        report : dict
+            contents of summary.json
+
+    """
+    started = time.perf_counter()
+    runtime.ensure_ee()
+    dataset_info = get_dataset(args.dataset, args.algorithm)
+    if not covers_years(dataset_info, args.from_year, args.to_year):
+        raise SystemExit(
+            "The dataset has no images for %d-%d" % (args.from_year, args.to_year)
+        )
+    output = args.output or make_export_directory()
+    os.makedirs(output, exist_ok=True)
+    options = make_options(args, dataset_info)
+
+    collection = ee.ImageCollection(dataset_info["collection_id"]).filterDate(
+        "%d-01-01" % args.from_year, "%d-12-31" % args.to_year
+    )
+    composite, number_of_images = make_composite(
+        args.algorithm, collection, args.from_year, args.to_year
+    )
+    aois = [ee.Geometry.Polygon(rings) for rings in read_aoi(args.aoi)]
+    # all polygons of the AOI are sampled on one grid, see grid.py
+    latitude = grid_latitude(
+        [edge for aoi in aois for edge in get_bounds(aoi)[1::2]]
+    )
+    blocks = []
+    for number, aoi in enumerate(aois):
+        for block in plan_blocks(
+            get_bounds(aoi), dataset_info["scale"], latitude, args.block_pixels
+        ):
+            blocks.append((number, aoi, block))
+    print("number of blocks: ", len(blocks))
+
+    def fetch(index):
+        number, aoi, block = blocks[index]
+        return fetch_block(
+            composite, aoi, block, dataset_info, latitude, args.algorithm, number_of_images
+        )
+
+    summary = make_summary(args.algorithm)
+    pixels, failed_blocks, fetch_wait, analysis_time = 0, [], 0.0, 0.0
+    result_path = os.path.join(output, "%s_result.parquet" % args.algorithm)
+    if args.workers > 1:
+        pool = ProcessPoolExecutor(
+            max_workers=args.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(args.engine,),
+        )
+        analyse = pool.map
+    else:
+        pool, analyse = None, map
+    try:
+        with ThreadPoolExecutor(max_workers=1) as fetcher, ParquetStream(
+            result_path
+        ) as stream:
+            pending = fetcher.submit(fetch, 0) if blocks else None
+            for index, (number, aoi, block) in enumerate(blocks):
+                wait_started = time.perf_counter()
+                try:
+                    dataset = pending.result()
+                except Exception as error:
+                    print("block %d could not be fetched: %s" % (index, error))
+                    failed_blocks.append(
+                        {"block": index, "bounds": block, "error": str(error)}
+                    )
+                    dataset = None
+                fetch_wait += time.perf_counter() - wait_started
+                # the next block is fetched while this one is analysed
+                if index + 1 < len(blocks):
+                    pending = fetcher.submit(fetch, index + 1)
+                if dataset is None or len(dataset) == 0:
+                    continue
+
+                analysis_started = time.perf_counter()
+                cube = PixelCube.from_dataset(
+                    dataset, dataset_info["band_name"], dataset_info["scale"], latitude
+                )
+                del dataset
+                tasks = [
+                    (
+                        args.algorithm,
+                        cube.take(slice(start, start + args.chunk_pixels)),
+                        options,
+                    )
+                    for start in range(0, cube.number_of_pixels, args.chunk_pixels)
+                ]
+                for result in analyse(analyse_chunk, tasks):
+                    if len(result) == 0:
+                        continue
+                    summary.update(result)
+                    table = result.to_dataframe()
+                    table.insert(0, "aoi", number)
+                    stream.write(table)
+                pixels += cube.number_of_pixels
+                block_time = time.perf_counter() - analysis_started
+                analysis_time += block_time
+                print(
+                    "block %d of %d: %d pixels, %.0f pixels/s"
+                    % (
+                        index + 1,
+                        len(blocks),
+                        cube.number_of_pixels,
+                        cube.number_of_pixels / max(block_time, 1e-9),
+                    )
+                )
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    seconds = time.perf_counter() - started
+    report = {
+        "algorithm": args.algorithm,
+        "dataset": args.dataset,
+        "from_year": args.from_year,
+        "to_year": args.to_year,
+        "options": options,
+        "blocks": len(blocks),
+        "failed_blocks": failed_blocks,
+        "pixels": pixels,
+        "pixels_analysed": summary.pixels,
+        "seconds": seconds,
+        "seconds_waiting_for_earth_engine": fetch_wait,
+        "seconds_analysing": analysis_time,
+        "pixels_per_second": pixels / seconds if seconds else 0.0,
+        "result": result_path if stream.rows else None,
+        "statistics": summary.to_dict(),
+    }
+    with open(os.path.join(output, "summary.json"), "w") as summary_file:
+        json.dump(report, summary_file, indent=2, default=float)
+    print(
+        "%d pixels (%d analysed) in %.1f s: %.0f pixels/s, %.1f s waiting for Earth Engine"
+        % (pixels, summary.pixels, seconds, report["pixels_per_second"], fetch_wait)
+    )
+    if failed_blocks:
+        print("%d blocks failed, see summary.json" % len(failed_blocks))
+    print("results saved to ", output)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--aoi", required=True, help="GeoJSON or coordinates file")
+    parser.add_argument("--dataset", choices=sorted(DATASETS), required=True)
+    parser.add_argument("--from-year", type=int, required=True)
+    parser.add_argument("--to-year", type=int, required=True)
+    parser.add_argument("--algorithm", choices=["polytrend", "dbest"], default="polytrend")
+    parser.add_argument("--engine", choices=["r", "numpy"], default="r")
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--seasonality", type=int, default=12)
+    parser.add_argument(
+        "--dbest-algorithm",
+        choices=["changedetection", "generalization"],
+        default="changedetection",
+    )
+    parser.add_argument("--breakpoints-no", type=int, default=3)
+    parser.add_argument("--first-level-shift", type=float, default=0.1)
+    parser.add_argument("--second-level-shift", type=float, default=0.2)
+    parser.add_argument("--duration", type=int, default=12)
+    parser.add_argument("--distance-threshold", default="default")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--block-pixels", type=int, default=BLOCK_PIXELS)
+    parser.add_argument("--chunk-pixels", type=int, default=CHUNK_PIXELS)
+    parser.add_argument(
+        "--output", help="directory of the results, a new one under exports/ by default"
+    )
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
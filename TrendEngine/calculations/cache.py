@@ -0,0 +1,376 @@
+""" Caches for time series fetched from Earth Engine and for analysis results
+
+    The first tier keeps recently used datasets in memory, bounded by their
+    size. The second tier keeps them on disk as Parquet files and evicts the
+    least recently used files when the directory grows too large or when
+    files get too old. Counters of hits and misses are kept for tuning and
+    exported to Prometheus, see metrics.py.
+
+    Finished analyses are kept in memory by ResultCache: the result table
+    and the rendered page, served with an ETag so that browsers can
+    revalidate a page without it being sent again.
+
+"""
+import hashlib
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+from flask import make_response, request
+
+from . import metrics
+from .grid import GRID_CRS, grid_latitude, grid_step
+
+MEMORY_BYTES = int(os.environ.get("TRENDENGINE_CACHE_MEMORY_MB", 256)) * 2 ** 20
+DISK_BYTES = int(os.environ.get("TRENDENGINE_CACHE_DISK_MB", 4096)) * 2 ** 20
+MAX_AGE = int(os.environ.get("TRENDENGINE_CACHE_MAX_AGE_DAYS", 30)) * 24 * 3600
+RESULT_MEMORY_BYTES = int(os.environ.get("TRENDENGINE_RESULT_CACHE_MB", 128)) * 2 ** 20
+DIRECTORY = os.environ.get(
+    "TRENDENGINE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "trendengine-cache")
+)
+
+
+def make_cache_key(
+    dataset, band_name, composite, coordinates, scale, latitude, start_date, end_date
+):
+    """ Key of a time series in the cache
+
+    Args:
+        dataset: string
+            ID of the image collection in Google Earth Engine
+        band_name: string
+            band analysed
+        composite: string
+            how images were composited, e.g. 'annual_mean' or 'monthly_mean'
+        coordinates: list
+            coordinates of the AOI as parsed from the form
+        scale: int
+            pixel size in meters
+        latitude: float
+            latitude of the grid the pixels are sampled on, see grid.py
+        start_date, end_date: string
+            period of the time series
+
+    Returns:
+        key : string
+
+    """
+    coordinates = [round(coordinate, 6) for coordinate in coordinates]
+    description = json.dumps(
+        [
+            dataset,
+            band_name,
+            composite,
+            coordinates,
+            scale,
+            start_date,
+            end_date,
+            # time series sampled on another grid are not reused, see grid.py
+            GRID_CRS,
+            latitude,
+        ]
+    )
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+
+def snap_coordinates(point, scale):
+    """ Moves a point to the centre of the pixel it falls in
+
+    Points are sampled on the grid of grid.py at their own grid latitude,
+    so clicks within the same pixel give the same coordinates and share
+    the cached time series and results.
+
+    Args:
+        point: list
+            longitude and latitude as parsed from the form
+        scale: int
+            pixel size in meters
+
+    Returns:
+        snapped : list
+
+    """
+    longitude, latitude = point
+    width, height = grid_step(scale, grid_latitude([latitude]))
+    return [
+        round((math.floor(longitude / width) + 0.5) * width, 6),
+        round((math.floor(latitude / height) + 0.5) * height, 6),
+    ]
+
+
+def make_result_key(
+    algorithm, dataset_name, coordinates, start_year, end_year, algorithm_parameters
+):
+    """ Key of an analysis result in the cache
+
+    Args:
+        algorithm: string
+            'polytrend' or 'dbest'
+        dataset_name: string
+            value of the dataset field in home.html
+        coordinates: list
+            vertices of a polygon as parsed from the form, or a point
+            snapped with snap_coordinates()
+        start_year, end_year: int
+            period of the analysis
+        algorithm_parameters: dict
+            every parameter of the algorithm that changes the result
+
+    Returns:
+        key : string
+
+    """
+    coordinates = [round(coordinate, 6) for coordinate in coordinates]
+    description = json.dumps(
+        [
+            algorithm,
+            dataset_name,
+            coordinates,
+            start_year,
+            end_year,
+            sorted(algorithm_parameters.items()),
+        ]
+    )
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+
+class TimeSeriesCache:
+    """ In-memory LRU in front of a directory of Parquet files """
+
+    def __init__(
+        self,
+        memory_bytes=MEMORY_BYTES,
+        directory=DIRECTORY,
+        disk_bytes=DISK_BYTES,
+        max_age=MAX_AGE,
+    ):
+        self.memory_bytes = memory_bytes
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.max_age = max_age
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "disk_errors": 0}
+
+    def get(self, key):
+        """ Returns the cached dataset or None """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                metrics.CACHE_HITS.labels(cache="time_series", tier="memory").inc()
+                return self._memory[key][0].copy(deep=False)
+        data = self._read_from_disk(key)
+        with self._lock:
+            if data is None:
+                self.counters["misses"] += 1
+                metrics.CACHE_MISSES.labels(cache="time_series").inc()
+                return None
+            self.counters["disk_hits"] += 1
+            metrics.CACHE_HITS.labels(cache="time_series", tier="disk").inc()
+        self._put_in_memory(key, data)
+        return data.copy(deep=False)
+
+    def put(self, key, data):
+        """ Stores a dataset in both tiers """
+        self._put_in_memory(key, data)
+        self._write_to_disk(key, data)
+
+    def stats(self):
+        """ Counters and current size of both tiers """
+        with self._lock:
+            result = dict(self.counters)
+            result["memory_entries"] = len(self._memory)
+            result["memory_bytes"] = self._memory_used
+        files = self._disk_files()
+        result["disk_entries"] = len(files)
+        result["disk_bytes"] = sum(size for _, size, _ in files)
+        requests = result["memory_hits"] + result["disk_hits"] + result["misses"]
+        result["hit_ratio"] = (
+            round((result["memory_hits"] + result["disk_hits"]) / requests, 3)
+            if requests
+            else 0.0
+        )
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_used = 0
+        for path, _, _ in self._disk_files():
+            _remove(path)
+
+    def _put_in_memory(self, key, data):
+        size = int(data.memory_usage(deep=True).sum())
+        if size > self.memory_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_used -= self._memory.pop(key)[1]
+            self._memory[key] = (data, size)
+            self._memory_used += size
+            while self._memory_used > self.memory_bytes:
+                _, (_, evicted_size) = self._memory.popitem(last=False)
+                self._memory_used -= evicted_size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".parquet")
+
+    def _read_from_disk(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        if time.time() - os.path.getmtime(path) > self.max_age:
+            _remove(path)
+            return None
+        try:
+            data = pd.read_parquet(path)
+        except Exception as error:
+            print("cache: couldn't read", path, error)
+            self.counters["disk_errors"] += 1
+            metrics.CACHE_DISK_ERRORS.labels(cache="time_series").inc()
+            return None
+        # modification time records the last use for eviction
+        os.utime(path)
+        return data
+
+    def _write_to_disk(self, key, data):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # write to a temporary file so readers never see half a file
+            temporary_path = "%s.%d.%d.tmp" % (
+                self._path(key), os.getpid(), threading.get_ident()
+            )
+            data.to_parquet(temporary_path, index=False)
+            os.replace(temporary_path, self._path(key))
+        except Exception as error:
+            print("cache: couldn't write", key, error)
+            self.counters["disk_errors"] += 1
+            metrics.CACHE_DISK_ERRORS.labels(cache="time_series").inc()
+            return
+        self._evict_from_disk()
+
+    def _disk_files(self):
+        """ Path, size and modification time of each cached file """
+        if not os.path.isdir(self.directory):
+            return []
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".parquet"):
+                path = os.path.join(self.directory, name)
+                try:
+                    status = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, status.st_size, status.st_mtime))
+        return files
+
+    def _evict_from_disk(self):
+        now = time.time()
+        files = []
+        for path, size, modified in self._disk_files():
+            if now - modified > self.max_age:
+                _remove(path)
+            else:
+                files.append((path, size, modified))
+        used = sum(size for _, size, _ in files)
+        # least recently used first
+        for path, size, _ in sorted(files, key=lambda item: item[2]):
+            if used <= self.disk_bytes:
+                break
+            _remove(path)
+            used -= size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class CachedResult:
+    """ Result of one analysis and the page rendered from it """
+
+    def __init__(self, key, result, html):
+        self.key = key
+        self.result = result
+        self.html = html
+        # the key covers everything the page depends on
+        self.etag = key
+        self.size = len(html) + _size_of(result)
+
+    def to_response(self):
+        """ Page with an ETag, 304 Not Modified if the browser has it already """
+        response = make_response(self.html)
+        response.set_etag(self.etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response.make_conditional(request)
+
+
+class ResultCache:
+    """ In-memory LRU of finished analyses, bounded by their size """
+
+    def __init__(self, memory_bytes=RESULT_MEMORY_BYTES):
+        self.memory_bytes = memory_bytes
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0}
+
+    def get(self, key):
+        """ Returns the CachedResult or None """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                metrics.CACHE_MISSES.labels(cache="result").inc()
+                return None
+            self._memory.move_to_end(key)
+            self.counters["hits"] += 1
+            metrics.CACHE_HITS.labels(cache="result", tier="memory").inc()
+            return entry
+
+    def put(self, key, result, html):
+        """ Stores a result and its page, returns the CachedResult """
+        entry = CachedResult(key, result, html)
+        if entry.size > self.memory_bytes:
+            return entry
+        with self._lock:
+            if key in self._memory:
+                self._memory_used -= self._memory.pop(key).size
+            self._memory[key] = entry
+            self._memory_used += entry.size
+            while self._memory_used > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_used -= evicted.size
+        return entry
+
+    def stats(self):
+        with self._lock:
+            result = dict(self.counters)
+            result["entries"] = len(self._memory)
+            result["bytes"] = self._memory_used
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_used = 0
+
+
+def _size_of(result):
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return int(result.memory_usage(deep=True).sum())
+    # ResultTable of a polygon, see results.py
+    return int(getattr(result, "nbytes", 0))
+
+
+time_series_cache = TimeSeriesCache()
+result_cache = ResultCache()
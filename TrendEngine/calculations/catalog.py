@@ -0,0 +1,116 @@
+""" Catalog of the datasets available in TrendEngine
+
+    Band names, scales and NDVI thresholds are defined once here for both
+    algorithms; the thresholds differ between the algorithms, so each
+    dataset has one per algorithm. Metadata of each collection (CRS, number of bands and the
+    dates it covers) is asked from Earth Engine once per process, on first
+    use or when load_catalog() is called at startup, and reused afterwards.
+
+"""
+import threading
+
+from .earthengine import ee
+
+# keys are the values of the dataset field in home.html
+DATASETS = {
+    "NASA/GIMMS/3GV0": {
+        "collection_id": "NASA/GIMMS/3GV0",
+        "band_name": "ndvi",
+        "scale": 8000,
+        # bimonthly images, fetched raw for local compositing, see compositing.py
+        "images_per_year": 24,
+        # NDVI values from -1 to 1
+        "ndvi_threshold": {"polytrend": 0.1, "dbest": 0.1},
+    },
+    "MODIS/006/MOD13Q1_NDVI": {
+        "collection_id": "MODIS/006/MOD13Q1",
+        "band_name": "NDVI",
+        "scale": 250,
+        # 16-day images
+        "images_per_year": 23,
+        # values scaled by 10000; DBEST analyses monthly values and keeps
+        # pixels above 0.01, PolyTrend annual maxima above 0.1
+        "ndvi_threshold": {"polytrend": 1000, "dbest": 100},
+    },
+    "MODIS/006/MOD13Q1_EVI": {
+        "collection_id": "MODIS/006/MOD13Q1",
+        "band_name": "EVI",
+        "scale": 250,
+        "images_per_year": 23,
+        "ndvi_threshold": {"polytrend": 1000, "dbest": 100},
+    },
+}
+
+_metadata = {}
+_lock = threading.Lock()
+
+
+def get_collection_metadata(collection_id):
+    """ CRS, number of bands and first and last image date of a collection
+
+    Asks Earth Engine with a single request the first time a collection
+    is used and returns the stored answer afterwards.
+
+    Returns:
+        metadata : dict
+            crs, number_of_bands, start_date and end_date ('YYYY-MM-DD')
+
+    """
+    with _lock:
+        if collection_id in _metadata:
+            return _metadata[collection_id]
+    collection = ee.ImageCollection(collection_id)
+    first = ee.Image(collection.first())
+    info = ee.Dictionary(
+        {
+            "crs": first.select(0).projection().crs(),
+            "number_of_bands": first.bandNames().size(),
+            "start_date": ee.Date(collection.aggregate_min("system:time_start")).format(
+                "YYYY-MM-dd"
+            ),
+            "end_date": ee.Date(collection.aggregate_max("system:time_start")).format(
+                "YYYY-MM-dd"
+            ),
+        }
+    ).getInfo()
+    with _lock:
+        _metadata[collection_id] = info
+    return info
+
+
+def get_dataset(dataset_name, algorithm):
+    """ Everything needed to query a dataset chosen in the form
+
+    Args:
+        dataset_name: string
+            value of the dataset field in home.html, e.g. 'MODIS/006/MOD13Q1_NDVI'
+        algorithm: string
+            'polytrend' or 'dbest', selects the NDVI threshold
+
+    Returns:
+        dataset : dict
+            collection_id, band_name, scale, ndvi_threshold, images_per_year,
+            crs, number_of_bands, start_date and end_date
+
+    Raises:
+        KeyError if the dataset is not in the catalog
+
+    """
+    dataset = dict(DATASETS[dataset_name])
+    dataset["ndvi_threshold"] = dataset["ndvi_threshold"][algorithm]
+    dataset.update(get_collection_metadata(dataset["collection_id"]))
+    return dataset
+
+
+def covers_years(dataset, start_year, end_year):
+    """ True if the dataset has images in every requested year """
+    return (
+        int(dataset["start_date"][:4]) <= start_year
+        and end_year <= int(dataset["end_date"][:4])
+    )
+
+
+def load_catalog():
+    """ Gets metadata of all collections, e.g. when the server starts """
+    for collection_id in sorted({d["collection_id"] for d in DATASETS.values()}):
+        get_collection_metadata(collection_id)
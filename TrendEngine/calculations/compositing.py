@@ -0,0 +1,228 @@
+""" Annual and monthly composites computed locally from raw observations
+
+    With Earth Engine compositing PolyTrend fetches annual means
+    (make_annual_composite) and DBEST monthly means (make_monthly_composite),
+    each with a graph and a getRegion download of its own. With local
+    compositing both fetch the raw observations of the dataset band once
+    (16-day MODIS or bimonthly GIMMS images), cached per year under the
+    same keys for both algorithms (see periods.py), and reduce them here:
+
+    - every observation is assigned to a pixel and a time step, the year or
+      the month of its date
+    - the mean is a weighted np.bincount over pixel x time step, the max a
+      np.maximum.reduceat over the observations sorted by pixel and time step
+    - masked observations (NaN) are skipped; a time step without any valid
+      observation stays NaN, as a masked pixel of an Earth Engine composite
+
+    The composites have the columns of get_dataset_for_polygon: annual ones
+    have the year as time, monthly ones the first day of the month, as set
+    by the Earth Engine composites.
+
+"""
+import numpy as np
+import pandas as pd
+
+from .periods import get_dataset_by_year, make_year_keys
+from . import metrics
+
+# values of the compositing field in home.html and the reducer used locally,
+# None composites in Earth Engine
+COMPOSITING = {"server": None, "local_mean": "mean", "local_max": "max"}
+DEFAULT_COMPOSITING = "server"
+PERIODS = ("annual", "monthly")
+
+
+def get_raw_dataset_by_year(
+    is_polytrend,
+    collection,
+    AOI,
+    scale,
+    crs,
+    latitude,
+    dataset_info,
+    coordinates,
+    start_year,
+    end_year,
+):
+    """ Raw observations of the dataset band in the AOI, fetching only uncached years
+
+    Args:
+        is_polytrend: bool
+            which algorithm the data is for, only used for the metrics
+        collection: ee.ImageCollection
+            images of the AOI, not filtered by date, see get_dataset_by_year
+        AOI: ee.Geometry
+            area of interest
+        scale: int
+            pixel size in meters
+        crs: string
+            projection of the sampled pixels
+        latitude: float
+            latitude of the grid, see grid.py
+        dataset_info: dict
+            dataset as returned by catalog.get_dataset
+        coordinates: list
+            coordinates of the AOI, for the cache keys
+        start_year, end_year: int
+            period of the analysis
+
+    Returns:
+        data : dataframe
+            one row per pixel and observation, time as datetime64
+
+    """
+    band_name = dataset_info["band_name"]
+    year_keys = make_year_keys(
+        dataset_info["collection_id"],
+        band_name,
+        "raw",
+        coordinates,
+        scale,
+        latitude,
+        start_year,
+        end_year,
+    )
+    data = get_dataset_by_year(
+        is_polytrend,
+        collection,
+        lambda images, first, last: images.select(band_name),
+        AOI,
+        scale,
+        crs,
+        latitude,
+        year_keys,
+        images_per_year=dataset_info["images_per_year"],
+        number_of_bands=1,
+    )
+    if not pd.api.types.is_datetime64_any_dtype(data["time"]):
+        # getRegion gives the time of raw images in milliseconds
+        data["time"] = data["time"].values.astype(np.int64).astype("datetime64[ms]")
+    return data
+
+
+def composite(raw, band_name, period, reducer, start_year, end_year):
+    """ Composites of every year or month of a period, see the module docstring
+
+    Args:
+        raw: dataframe
+            raw observations, as returned by get_raw_dataset_by_year
+        band_name: string
+            band to be composited
+        period: string
+            'annual' or 'monthly'
+        reducer: string
+            'mean' or 'max'
+        start_year, end_year: int
+            period of the analysis, observations outside it are ignored
+
+    Returns:
+        data : dataframe
+            one row per pixel and year or month with id, longitude,
+            latitude, time and band columns
+
+    """
+    if period not in PERIODS:
+        raise ValueError("unknown composite period: %s" % period)
+    times = pd.DatetimeIndex(raw["time"].values)
+    years = times.year.values.astype(np.int64) - start_year
+    number_of_years = end_year - start_year + 1
+    if period == "annual":
+        steps = years
+        number_of_steps = number_of_years
+        step_times = np.arange(start_year, end_year + 1)
+    else:
+        steps = years * 12 + times.month.values - 1
+        number_of_steps = number_of_years * 12
+        step_times = np.array(
+            [
+                "%d-%02d-01" % (year, month)
+                for year in range(start_year, end_year + 1)
+                for month in range(1, 13)
+            ],
+            dtype="datetime64[ms]",
+        )
+
+    # pixels keep the order in which getRegion lists them
+    pixel_codes, pixel_keys = pd.factorize(
+        pd.MultiIndex.from_arrays(
+            [raw["longitude"].values, raw["latitude"].values]
+        )
+    )
+    values = raw[band_name].values.astype(np.float64)
+    valid = (years >= 0) & (years < number_of_years) & ~np.isnan(values)
+    groups = pixel_codes[valid] * number_of_steps + steps[valid]
+    values = values[valid]
+    size = len(pixel_keys) * number_of_steps
+
+    if reducer == "mean":
+        sums = np.bincount(groups, weights=values, minlength=size)
+        counts = np.bincount(groups, minlength=size)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            reduced = sums / counts
+    elif reducer == "max":
+        reduced = np.full(size, np.nan)
+        if len(groups):
+            order = np.argsort(groups, kind="stable")
+            groups, values = groups[order], values[order]
+            starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+            reduced[groups[starts]] = np.maximum.reduceat(values, starts)
+    else:
+        raise ValueError("unknown composite reducer: %s" % reducer)
+
+    number_of_pixels = len(pixel_keys)
+    return pd.DataFrame(
+        {
+            # composites of Earth Engine are numbered in the same way
+            "id": pd.Categorical.from_codes(
+                np.tile(np.arange(number_of_steps), number_of_pixels),
+                [str(step) for step in range(number_of_steps)],
+            ),
+            "longitude": np.repeat(pixel_keys.get_level_values(0).values, number_of_steps),
+            "latitude": np.repeat(pixel_keys.get_level_values(1).values, number_of_steps),
+            "time": np.tile(step_times, number_of_pixels),
+            band_name: reduced,
+        }
+    )
+
+
+def get_composited_dataset(
+    is_polytrend,
+    collection,
+    AOI,
+    scale,
+    crs,
+    latitude,
+    dataset_info,
+    coordinates,
+    start_year,
+    end_year,
+    period,
+    reducer,
+):
+    """ Composites of the AOI computed locally from its raw observations
+
+    Args:
+        see get_raw_dataset_by_year and composite
+
+    Returns:
+        data : dataframe
+            as from get_dataset_by_year with Earth Engine composites
+
+    """
+    raw = get_raw_dataset_by_year(
+        is_polytrend,
+        collection,
+        AOI,
+        scale,
+        crs,
+        latitude,
+        dataset_info,
+        coordinates,
+        start_year,
+        end_year,
+    )
+    algorithm = "polytrend" if is_polytrend else "dbest"
+    with metrics.stage(algorithm, "composite"):
+        return composite(
+            raw, dataset_info["band_name"], period, reducer, start_year, end_year
+        )
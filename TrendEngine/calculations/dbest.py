@@ -1,17 +1,11 @@
-from flask import Flask, render_template, url_for, request, flash, Blueprint
+from flask import Flask, render_template, url_for, request, flash, Blueprint, current_app
 import jinja2
 from werkzeug import ImmutableMultiDict
 
-# for transforming R objects
-from rpy2.robjects.packages import importr
-from rpy2.robjects.vectors import FloatVector
-import rpy2.robjects as ro
-import re
+import logging
+
 import numpy as np
 import pandas as pd
-import geopandas as gpd
-import pandas_bokeh
-from shapely.geometry import Point
 
 # for bokeh maps and plots
 from bokeh.io import show
@@ -22,14 +16,32 @@ from bokeh.layouts import layout, row
 from bokeh.embed import components
 
 # local import
-from .utils import get_dataset_for_point, get_dataset_for_polygon
-
+from .utils import get_dataset_for_point, get_dataset_for_polygon, parse_coordinates
+from .dbest_pool import iter_dbest_parallel
+from .cache import make_cache_key, make_result_key, result_cache, snap_coordinates
+from .catalog import covers_years, get_dataset
+from .periods import get_dataset_by_year, make_year_keys
+from .compositing import COMPOSITING, DEFAULT_COMPOSITING, get_composited_dataset
+from .grid import GRID_CRS, grid_latitude
+from .pixelcube import PixelCube
+from .pixelstore import PixelStore, PolygonLookup, make_store_key
+from .results import ResultTable, whole_table
+from .summary import DbestSummary, histogram_figure
+from .export import (
+    export_point_result,
+    export_polygon_result,
+    export_time_series,
+    make_export_directory,
+)
+from .raster import DEFAULT_MAP_MODE, MAP_MODES, raster_maps
+from . import dbest_engine, metrics, rbridge, runtime
+
+logger = logging.getLogger(__name__)
 
 try:
-    import ee
+    from .earthengine import ee
 except ImportError:
     raise ImportError("You either haven't installed or authenticated Earth Engine")
-ee.Initialize()
 
 def calculate_monthly_mean(year_and_collection):
     # Unpack variable from the input parameter
@@ -61,8 +73,109 @@ def calculate_monthly_mean(year_and_collection):
     monthly_NDVI_collection = list_of_months_and_collections.map(get_monthly)
     return monthly_NDVI_collection
 
+
+def make_monthly_composite(collection, start_year, end_year):
+    """ Monthly mean images of every year from start_year to end_year """
+    years = ee.List.sequence(start_year, end_year, 1)
+    # Create a list of year-collection pairs (i.e. pack the function inputs)
+    list_of_years_and_collections = years.zip(
+        ee.List.repeat(collection, years.length())
+    )
+    monthly_NDVI_list = list_of_years_and_collections.map(
+        calculate_monthly_mean
+    ).flatten()
+    return ee.ImageCollection.fromImages(monthly_NDVI_list)
+
+def dbest_in_process(Y, dbest_parameters, parity=False):
+    """ Runs dbest_engine.dbest on the rows of Y
+
+    Args:
+        Y: numpy array
+            pixels x months matrix of values
+        dbest_parameters: dict
+            keyword arguments of dbest_engine.dbest
+        parity: bool
+            whether to check the output against the R package; the
+            report is logged and counted in metrics.py
+
+    Returns:
+        values : numpy array
+            as returned by dbest_engine.dbest
+
+    """
+    values = dbest_engine.dbest(Y, **dbest_parameters)
+    if parity:
+        report = dbest_engine.compare_with_r(Y, dbest_parameters, values)
+        metrics.record_parity("dbest", report)
+        log = logger.warning if any(report["mismatches"].values()) else logger.info
+        log("DBEST parity with R package: %s", report)
+    return values
+
+
+def iter_dbest_polygon(dbest_parameters, cube, ndvi_threshold, workers=1, engine="r"):
+    """ Runs DBEST on the pixels of the pixel cube chunk by chunk
+
+    Args:
+        dbest_parameters: dict
+            keyword arguments passed to DBEST for every pixel
+        cube: PixelCube
+            monthly NDVI values per pixel, see pixelcube.py
+        ndvi_threshold: float
+            pixels with any value below it are not analysed
+        workers: int
+            number of worker processes, see dbest_pool.py
+        engine: string
+            'r' calls DBEST R package, 'numpy' analyses the pixels in process,
+            see dbest_engine.py, 'parity' does the latter and checks the
+            output against the R package
+
+    Yields:
+        pixels_done, pixels_total, chunk : int, int, ResultTable
+            number of analysed and of all qualified pixels and the
+            results of the last chunk, a view on the table of all
+            qualified pixels (see results.py)
+
+    """
+    # DBEST receives values rounded to three decimals
+    values = np.round(cube.values, 3)
+    with np.errstate(invalid="ignore"):
+        qualified = cube.mask.all(axis=1) & (values > ndvi_threshold).all(axis=1)
+    metrics.PIXELS.labels(algorithm="dbest").inc(cube.number_of_pixels)
+    metrics.REJECTED_PIXELS.labels(algorithm="dbest").inc(int((~qualified).sum()))
+    pixel_series = values[qualified]
+    if len(pixel_series) == 0:
+        yield 0, 0, ResultTable.empty("dbest")
+        return
+
+    if engine in ("numpy", "parity"):
+        chunks = (
+            dbest_in_process(
+                pixel_series[start : start + rbridge.CHUNK_SIZE],
+                dbest_parameters,
+                engine == "parity",
+            )
+            for start in range(0, len(pixel_series), rbridge.CHUNK_SIZE)
+        )
+    elif workers > 1:
+        chunks = iter_dbest_parallel(pixel_series, dbest_parameters, workers)
+    else:
+        # one call of the R package per chunk of pixels, see rbridge.py
+        chunks = (
+            rbridge.dbest_batch(
+                pixel_series[start : start + rbridge.CHUNK_SIZE], dbest_parameters
+            )
+            for start in range(0, len(pixel_series), rbridge.CHUNK_SIZE)
+        )
+    # filled in place, chunk by chunk
+    table = ResultTable.allocate("dbest", cube, np.flatnonzero(qualified))
+    pixels_done = 0
+    for chunk_values in chunks:
+        start = pixels_done
+        pixels_done += table.fill(start, dict(zip(rbridge.DBEST_FIELDS, chunk_values.T)))
+        yield pixels_done, len(pixel_series), table.view(start, pixels_done)
+
+
 def call_dbest_polygon(
-    dataset,
     data_type,
     seasonality,
     algorithm,
@@ -72,81 +185,44 @@ def call_dbest_polygon(
     duration,
     distance_threshold,
     alpha,
-    n,
-    number_of_pixels,
-    band_name,
+    cube,
     ndvi_threshold,
+    workers=1,
+    progress=None,
+    engine="r",
 ):
-    """ For polygons splits the image into pixels and runs DBEST
-        separately on each pixel time series list of values
+    """ For polygons takes each pixel time series from the pixel cube
+        (see pixelcube.py) and runs DBEST separately on it.
+        With more than one worker the pixels are analysed in
+        parallel worker processes, see dbest_pool.py.
+        progress is called after each chunk with the number of analysed
+        pixels, the number of all pixels and the results of the chunk.
+        engine 'numpy' replaces the R package by dbest_engine.py,
+        'parity' also checks its output against the R package.
+        Returns a ResultTable, see results.py.
     """
-    dbest = importr(
-        "DBEST",
-        robject_translations={
-            "data.type": "data_type",
-            "breakpoints.no": "breakpoints_no",
-            "first.level.shift": "first_level_shift",
-            "second.level.shift": "second_level_shift",
-            "distance.threshold": "distance_threshold",
-        },
-    )
-    DBEST_result = []
     if data_type == "non-cyclical":
         pass
 
     elif data_type == "cyclical":
-        DBEST_result_header = [
-            "geometry",
-            "start",
-            "duration",
-            "end",
-            "change",
-            "change_type",
-            "significance",
-        ]
-        for i in range(0, number_of_pixels, n):
-            Y_long = dataset[i : i + n][band_name].values
-            Y = [round(x, 3) for x in Y_long]
-            if all(val > ndvi_threshold for val in Y):
-                vec = FloatVector(Y)
-                result = list(
-                    dbest.DBEST(
-                        data=vec,
-                        data_type=data_type,
-                        seasonality=seasonality,
-                        algorithm=algorithm,
-                        breakpoints_no=breakpoints_no,
-                        first_level_shift=first_level_shift,
-                        second_level_shift=second_level_shift,
-                        duration=duration,
-                        distance_threshold=distance_threshold,
-                        alpha=alpha,
-                    )
-                )
-                # populate the empty PT_result list with values
-                pixel_long = dataset.at[i, "longitude"]
-                pixel_lat = dataset.at[i, "latitude"]
-                geometry = [round(pixel_long, 4), round(pixel_lat, 4)]
-
-                print("result inside dbest", result[2][0])
-
-                DBEST_result.append(
-                    [
-                        geometry,
-                        int(result[2][0]),
-                        int(result[3][0]),
-                        int(result[4][0]),
-                        float(result[5][0]),
-                        int(result[6][0]),
-                        result[7][0],
-                    ]
-                )
-            else:
-                print("!!! Unqualified value !!!")
-
-
-        df = pd.DataFrame(DBEST_result[0:], columns=DBEST_result_header)
-    return df
+        dbest_parameters = dict(
+            data_type=data_type,
+            seasonality=seasonality,
+            algorithm=algorithm,
+            breakpoints_no=breakpoints_no,
+            first_level_shift=first_level_shift,
+            second_level_shift=second_level_shift,
+            duration=duration,
+            distance_threshold=distance_threshold,
+            alpha=alpha,
+        )
+        for pixels_done, pixels_total, chunk in iter_dbest_polygon(
+            dbest_parameters, cube, ndvi_threshold, workers, engine
+        ):
+            if progress is not None:
+                progress(pixels_done, pixels_total, chunk)
+        result = whole_table(chunk)
+    return result
 
 
 def call_dbest_point(
@@ -162,52 +238,80 @@ def call_dbest_point(
     alpha,
     band_name,
     ndvi_threshold,
+    engine="r",
 ):
-    """ For point runs DBEST on a pixel's time series """
-
-    dbest = importr(
-        "DBEST",
-        robject_translations={
-            "data.type": "data_type",
-            "breakpoints.no": "breakpoints_no",
-            "first.level.shift": "first_level_shift",
-            "second.level.shift": "second_level_shift",
-            "distance.threshold": "distance_threshold",
-        },
-    )
-    Y = dataset[band_name].values
+    """ For point runs DBEST on a pixel's time series,
+        with the R package or with dbest_engine.py when engine is 'numpy'
+        or 'parity', the latter checking the largest change against the R package
+    """
 
-    if all(val > ndvi_threshold for val in Y):
-        vec = FloatVector(Y)
-        ro.globalenv["dbest_result"] = dbest.DBEST(
-            data=vec,
-            data_type=data_type,
-            seasonality=seasonality,
-            algorithm=algorithm,
-            breakpoints_no=breakpoints_no,
-            first_level_shift=first_level_shift,
-            second_level_shift=second_level_shift,
-            duration=duration,
-            distance_threshold=distance_threshold,
-            alpha=alpha,
+    Y = dataset[band_name].values
+    metrics.PIXELS.labels(algorithm="dbest").inc()
+
+    if all(val > ndvi_threshold for val in Y) and engine in ("numpy", "parity"):
+        if engine == "parity" and algorithm == "changedetection":
+            dbest_in_process(
+                Y[None, :],
+                dict(
+                    data_type=data_type,
+                    seasonality=seasonality,
+                    algorithm=algorithm,
+                    breakpoints_no=breakpoints_no,
+                    first_level_shift=first_level_shift,
+                    second_level_shift=second_level_shift,
+                    duration=duration,
+                    distance_threshold=distance_threshold,
+                    alpha=alpha,
+                ),
+                parity=True,
+            )
+        df = dbest_engine.dbest_point(
+            Y,
+            data_type,
+            seasonality,
+            algorithm,
+            breakpoints_no,
+            first_level_shift,
+            second_level_shift,
+            duration,
+            distance_threshold,
+            alpha,
         )
-        dbest_result = list(ro.r("dbest_result"))
-        df = pd.DataFrame(dbest_result)
+    elif all(val > ndvi_threshold for val in Y):
+        dbest = runtime.r_package("DBEST")
+        with runtime.r_lock:
+            dbest_result = dbest.DBEST(
+                data=rbridge.to_r_vector(Y),
+                data_type=data_type,
+                seasonality=seasonality,
+                algorithm=algorithm,
+                breakpoints_no=breakpoints_no,
+                first_level_shift=first_level_shift,
+                second_level_shift=second_level_shift,
+                duration=duration,
+                distance_threshold=distance_threshold,
+                alpha=alpha,
+            )
+            df = pd.DataFrame(list(dbest_result))
     else:
+        metrics.REJECTED_PIXELS.labels(algorithm="dbest").inc()
         print("!!! Values below threshold !!!")
 
 
     return df
 
 
-def dbest_visualize_polygon(result, algorithm, data_type):
+def dbest_visualize_polygon(result, algorithm, data_type, map_mode=DEFAULT_MAP_MODE):
     """ Create maps for polygons
 
     Args:
-        result: dataframe
-            contains what comes out of DBEST package 
+        result: ResultTable
+            output of call_dbest_polygon, see results.py
         algorithm: string
             'generalization' or 'change detection' depending on user's choice
+        map_mode: string
+            'raster' draws each map as one image (see raster.py),
+            'patches' draws a patch per pixel
 
     Returns: 
         render_template with graphics
@@ -215,12 +319,48 @@ def dbest_visualize_polygon(result, algorithm, data_type):
     """
     result_to_display = {}
     if data_type == "cyclical":
-        gpd_coordinates = result["geometry"].apply(Point)
-        gpd_df = gpd.GeoDataFrame(result, geometry=gpd_coordinates)
+        result_to_display = DbestSummary().update(result).to_dict()
+        histograms = result_to_display["histograms"]
+        summary_layout = row(
+            [
+                histogram_figure(histograms["start"], "Start time (number of pixels)"),
+                histogram_figure(histograms["duration"], "Duration (number of pixels)"),
+                histogram_figure(histograms["change"], "Change (number of pixels)"),
+            ],
+            sizing_mode="stretch_both",
+        )
+    if data_type == "cyclical" and map_mode == "raster":
+        plot_grid = raster_maps(
+            result,
+            [
+                ("change", "Change map", palette, None),
+                ("duration", "Duration (months)", palette, None),
+                ("start", "Start time", palette, None),
+                (
+                    "change_type",
+                    "Change type map - abrupt (1), non-abrupt (0)",
+                    None,
+                    {0: "grey", 1: "yellow"},
+                ),
+            ],
+        )
+        script, div = components(summary_layout)
+        generalization = ""
+        change_detection = ""
+    elif data_type == "cyclical":
+        # only the patch maps need geopandas and pandas_bokeh
+        import geopandas as gpd
+        import pandas_bokeh
+        from shapely.geometry import Point
+
+        table = result.to_dataframe()
+        gpd_coordinates = [
+            Point(longitude, latitude)
+            for longitude, latitude in zip(table["longitude"], table["latitude"])
+        ]
+        gpd_df = gpd.GeoDataFrame(table, geometry=gpd_coordinates)
         gpd_df.crs = {"init": "epsg:4326"}
-        pointA = result["geometry"][0]
-        pointB = result["geometry"][1]
-        buffer_size = pointA.distance(pointB) / 2
+        buffer_size = result.resolution[0] / 2
         gpd_df.geometry = gpd_df.geometry.buffer(buffer_size).envelope
         mapper = LinearColorMapper(palette=palette)
         colormap = ["grey", "yellow"]
@@ -266,8 +406,7 @@ def dbest_visualize_polygon(result, algorithm, data_type):
             return_html=True,
             show_plot=False,
         )
-        script = ""
-        div = ""
+        script, div = components(summary_layout)
         generalization = ""
         change_detection = ""
     elif data_type == "non-cyclical":
@@ -314,7 +453,8 @@ def dbest_visualize_point(result, time_steps, algorithm, data_type):
             "breakpoint_no": np.asarray(result[0][0]),
             "segment_no": np.asarray(result[0][1]),
             "start": start_arr,
-            "first_change": time_steps[start_arr[0]],
+            # a series without changes of interest has no breakpoints
+            "first_change": time_steps[start_arr[0]] if len(start_arr) else None,
             "duration": np.asarray(result[0][3]),
             "end": np.asarray(result[0][4]),
             "change": np.asarray(result[0][5]),
@@ -440,7 +580,8 @@ def dbest_visualize_point(result, time_steps, algorithm, data_type):
     )
 
 
-def do_dbest(parameters):
+@metrics.timed("dbest", "total")
+def do_dbest(parameters, progress=None):
     """ Get data from GEE, split images into pixel time series,
         call DBEST R package for a list of time series values
         for each pixel separately, visualize results
@@ -451,49 +592,60 @@ def do_dbest(parameters):
         parameters: dict
             contains all parameters entered by the user to query data 
             and parameters for the DBEST algorithm
+        progress: function, optional
+            called with the number of analysed pixels and the number of all pixels, see jobs.py
 
     Returns: 
         render template result_DBEST.html with maps for polygon or plots for point
 
     """
     # Step 1: get all parameters entered by the user and transform them
-    name_of_collection = parameters.get("dataset_name")
-    if name_of_collection == "NASA/GIMMS/3GV0":
-        band_name = "ndvi"
-        scale = 8000
-        ndvi_threshold = 0.1
-    elif name_of_collection == "MODIS/006/MOD13Q1_NDVI":
-        name_of_collection = "MODIS/006/MOD13Q1"
-        band_name = "NDVI"
-        scale = 250
-        ndvi_threshold = 100
-    elif name_of_collection == "MODIS/006/MOD13Q1_EVI":
-        name_of_collection = "MODIS/006/MOD13Q1"
-        band_name = "EVI"
-        scale = 250
-        ndvi_threshold = 100
-    coordinates = parameters["coordinates"]
-    regex = re.sub("[\[\]]", "", coordinates)
-    split = regex.split(",")
-    coords = list(map(float, split))
+    try:
+        runtime.ensure_ee()
+    except Exception as error:
+        print("Earth Engine could not be initialized: ", error)
+        message = "Sorry, Google Earth Engine is not available at the moment."
+        return render_template("error.html", error_message=message)
+    try:
+        dataset_info = get_dataset(parameters.get("dataset_name"), "dbest")
+    except KeyError:
+        message = "Sorry, this dataset is not available."
+        return render_template("error.html", error_message=message)
+    name_of_collection = dataset_info["collection_id"]
+    band_name = dataset_info["band_name"]
+    scale = dataset_info["scale"]
+    ndvi_threshold = dataset_info["ndvi_threshold"]
+    coords = parse_coordinates(parameters["coordinates"])
     if len(coords) > 2:
         aoi = ee.Geometry.Polygon(coords)
         is_polygon = True
         is_point = False
     elif len(coords) == 2:
+        # points are sampled on the grid too, see grid.py; clicks within
+        # one of its pixels give the same point and share the caches
+        coords = snap_coordinates(coords, scale)
         aoi = ee.Geometry.Point(coords)
         is_point = True
         is_polygon = False
     else:
         print("wrong coordinates")
+    # previews of polygons are analysed at a coarser scale, see jobs.py
+    scale_factor = max(1, parameters.get("scale_factor", 1, type=int))
+    if len(coords) > 2:
+        scale = scale * scale_factor
+    # pixels of polygons are square in meters at this latitude, see grid.py
+    latitude = grid_latitude(coords[1::2])
     start_year = parameters.get("from_year")
     end_year = parameters.get("to_year")
     start_date = start_year + "-01-01"
     end_date = end_year + "-12-31"
     start_year = int(start_year)
     end_year = int(end_year)
+    if not covers_years(dataset_info, start_year, end_year):
+        print("dataset empty")
+        message = "Sorry, the dataset for this period does not exist."
+        return render_template("error.html", error_message=message)
     img_collection = ee.ImageCollection(name_of_collection)
-    crs = img_collection.first().getInfo()["bands"][0]["crs"]
     collection = img_collection.filterDate(start_date, end_date).filterBounds(aoi)
     save_ts_to_csv = parameters.get("save_ts_to_csv")
     save_result_to_csv = parameters.get("save_result_to_csv")
@@ -511,65 +663,184 @@ def do_dbest(parameters):
     if distance_threshold != "default":
         distance_threshold = float(distance_threshold)
     alpha = parameters.get("alpha", type=float)
-    years = ee.List.sequence(start_year, end_year, 1)
+    engine = parameters.get("dbest_engine", dbest_engine.DEFAULT_ENGINE)
+    if engine not in dbest_engine.ENGINES:
+        engine = dbest_engine.DEFAULT_ENGINE
+    map_mode = parameters.get("map_mode", DEFAULT_MAP_MODE)
+    if map_mode not in MAP_MODES:
+        map_mode = DEFAULT_MAP_MODE
+    # composites of polygons are made in Earth Engine or locally, see compositing.py
+    compositing = parameters.get("compositing", DEFAULT_COMPOSITING)
+    if compositing not in COMPOSITING:
+        compositing = DEFAULT_COMPOSITING
+    workers = current_app.config.get("DBEST_WORKERS", 1)
+
+    # a finished analysis of the same pixels with the same parameters is reused
+    result_key = make_result_key(
+        "dbest",
+        parameters.get("dataset_name"),
+        coords,
+        start_year,
+        end_year,
+        {
+            "data_type": data_type,
+            "seasonality": seasonality,
+            "algorithm": algorithm,
+            "breakpoints_no": breakpoints_no,
+            "first_level_shift": first_level_shift,
+            "second_level_shift": second_level_shift,
+            "duration": duration,
+            "distance_threshold": distance_threshold,
+            "alpha": alpha,
+            "engine": engine,
+            "map_mode": map_mode,
+            "scale_factor": scale_factor,
+            "compositing": compositing,
+        },
+    )
+    use_result_cache = save_ts_to_csv != "yes" and save_result_to_csv != "yes"
+    # the time series of stored pixels are not fetched again, so not when they are saved
+    use_pixel_store = current_app.config.get("PIXEL_STORE", False) and save_ts_to_csv != "yes"
+    # files of this request are written to a directory of their own, see export.py
+    export_directory = None if use_result_cache else make_export_directory()
+    if use_result_cache:
+        cached = result_cache.get(result_key)
+        if cached is not None:
+            return cached.to_response()
+    cache_key = make_cache_key(
+        name_of_collection,
+        band_name,
+        "monthly_mean",
+        coords,
+        scale,
+        latitude,
+        start_date,
+        end_date,
+    )
 
     if is_polygon:
-        
-        # Step 2: From bimonthly data create monthly data
-        # Create a list of year-collection pairs (i.e. pack the function inputs)
-        list_of_years_and_collections = years.zip(
-            ee.List.repeat(collection, years.length())
-        )
-        monthly_NDVI_list = list_of_years_and_collections.map(
-            calculate_monthly_mean
-        ).flatten()
-        monthly_NDVI = ee.ImageCollection.fromImages(monthly_NDVI_list)
-
-        # Step 3: get time series values from GEE
-        try:
-            dataset = get_dataset_for_polygon(
-                is_polytrend, monthly_NDVI, aoi, scale, crs
+        # pixels analysed for earlier polygons are taken from the pixel
+        # store, only the others are fetched and analysed, see pixelstore.py
+        lookup = None
+        fetch_aoi, fetch_coords = aoi, coords
+        if use_pixel_store:
+            store_key = make_store_key(
+                "dbest",
+                parameters.get("dataset_name"),
+                scale,
+                latitude,
+                start_year,
+                end_year,
+                {
+                    "data_type": data_type,
+                    "seasonality": seasonality,
+                    "algorithm": algorithm,
+                    "breakpoints_no": breakpoints_no,
+                    "first_level_shift": first_level_shift,
+                    "second_level_shift": second_level_shift,
+                    "duration": duration,
+                    "distance_threshold": distance_threshold,
+                    "alpha": alpha,
+                    "engine": engine,
+                    "compositing": compositing,
+                },
             )
-        except:
-            message = "Sorry, couldn't get the data you requested. Possible problems: the dataset is too large (study area too large), study period is too long or the dataset for this period does not exist."
-            return render_template("error.html", error_message=message)
-        number_of_pixels = len(dataset)
-        print(number_of_pixels)
-        list_of_images = dataset["id"]
-        ids_of_images = []
-        for img_id in list_of_images:
-            if img_id not in ids_of_images:
-                ids_of_images.append(img_id)
-        n = len(ids_of_images)
-        if save_ts_to_csv == "yes":
-            dataset.to_csv("time_series.csv")
-
-        # Step 4: Run DBEST
-        try:
-            result = call_dbest_polygon(
-                dataset,
-                data_type,
-                seasonality,
-                algorithm,
-                breakpoints_no,
-                first_level_shift,
-                second_level_shift,
-                duration,
-                distance_threshold,
-                alpha,
-                n,
-                number_of_pixels,
-                band_name,
-                ndvi_threshold,
+            store = PixelStore("dbest", store_key, scale, latitude)
+            lookup = PolygonLookup(store, coords)
+            fetch_aoi, fetch_coords = lookup.fetch_area()
+        result = None
+        if fetch_aoi is not None:
+            # Step 2 and 3: monthly composites of the years that were not
+            # fetched before and their time series values, see periods.py
+            try:
+                if COMPOSITING[compositing] is None:
+                    dataset = get_dataset_by_year(
+                        is_polytrend,
+                        img_collection.filterBounds(fetch_aoi),
+                        make_monthly_composite,
+                        fetch_aoi,
+                        scale,
+                        GRID_CRS,
+                        latitude,
+                        make_year_keys(
+                            name_of_collection,
+                            band_name,
+                            "monthly_mean",
+                            fetch_coords,
+                            scale,
+                            latitude,
+                            start_year,
+                            end_year,
+                        ),
+                        images_per_year=12,
+                        number_of_bands=dataset_info["number_of_bands"],
+                    )
+                else:
+                    # raw observations, shared with PolyTrend, composited locally
+                    dataset = get_composited_dataset(
+                        is_polytrend,
+                        img_collection.filterBounds(fetch_aoi),
+                        fetch_aoi,
+                        scale,
+                        GRID_CRS,
+                        latitude,
+                        dataset_info,
+                        fetch_coords,
+                        start_year,
+                        end_year,
+                        "monthly",
+                        COMPOSITING[compositing],
+                    )
+            except:
+                message = "Sorry, couldn't get the data you requested. Possible problems: the dataset is too large (study area too large), study period is too long or the dataset for this period does not exist."
+                return render_template("error.html", error_message=message)
+            with metrics.stage("dbest", "reshape"):
+                cube = PixelCube.from_dataset(dataset, band_name, scale, latitude)
+                if lookup is not None:
+                    cube = lookup.select(cube)
+            metrics.ANALYSIS_PIXELS.labels(algorithm="dbest").observe(
+                cube.number_of_pixels
             )
-        except:
-            message = "Sorry, something went wrong inside DBEST function. Potential problem: your data is not cyclical."
-            return render_template("error.html", error_message=message)
+            if save_ts_to_csv == "yes":
+                with metrics.stage("dbest", "export"):
+                    export_time_series(dataset, export_directory)
+
+            # Step 4: Run DBEST
+            try:
+                with metrics.stage("dbest", "analysis"):
+                    result = call_dbest_polygon(
+                        data_type,
+                        seasonality,
+                        algorithm,
+                        breakpoints_no,
+                        first_level_shift,
+                        second_level_shift,
+                        duration,
+                        distance_threshold,
+                        alpha,
+                        cube,
+                        ndvi_threshold,
+                        workers,
+                        progress,
+                        engine,
+                    )
+            except:
+                message = "Sorry, something went wrong inside DBEST function. Potential problem: your data is not cyclical."
+                return render_template("error.html", error_message=message)
+        if lookup is not None:
+            result = lookup.merge(result)
         if save_result_to_csv == "yes":
-            result.to_csv("DBEST_result.csv")
+            with metrics.stage("dbest", "export"):
+                export_polygon_result(
+                    result,
+                    ["start", "duration", "end", "change", "change_type", "significance"],
+                    export_directory,
+                    "DBEST_result",
+                )
 
         # Step 5: Visualize results 
-        plots = dbest_visualize_polygon(result, algorithm, data_type)
+        with metrics.stage("dbest", "render"):
+            plots = dbest_visualize_polygon(result, algorithm, data_type, map_mode)
 
     elif is_point:
         # Step 2: From bimonthly data create monthly data
@@ -578,50 +849,59 @@ def do_dbest(parameters):
             .filterDate(start_date, end_date)
             .select(band_name)
         )
-        # Create a list of year-collection pairs (i.e. pack the function inputs)
-        list_of_years_and_collections = years.zip(
-            ee.List.repeat(MOD13Q1, years.length())
-        )
-        monthly_NDVI_list = list_of_years_and_collections.map(
-            calculate_monthly_mean
-        ).flatten()
-        monthly_NDVI = ee.ImageCollection.fromImages(monthly_NDVI_list)
+        with metrics.stage("dbest", "composite"):
+            monthly_NDVI = make_monthly_composite(MOD13Q1, start_year, end_year)
         # Step 3: get time series values from GEE
         try:
             dataset = get_dataset_for_polygon(
-                is_polytrend, monthly_NDVI, aoi, scale, crs
+                is_polytrend,
+                monthly_NDVI,
+                aoi,
+                scale,
+                GRID_CRS,
+                latitude,
+                cache_key,
+                number_of_images=12 * (end_year - start_year + 1),
+                number_of_bands=1,
             )
         except:
             message = "Sorry, couldn't get the data you requested. Possible problems: the dataset is too large (study area too large), study period is too long or the dataset for this period does not exist."
             return render_template("error.html", error_message=message)
-        number_of_pixels = len(dataset)
-        print('number of pixels: ', number_of_pixels)
         time_steps = dataset["time"]
         # Step 4: Run DBEST
         try:
-            result = call_dbest_point(
-                dataset,
-                data_type,
-                seasonality,
-                algorithm,
-                breakpoints_no,
-                first_level_shift,
-                second_level_shift,
-                duration,
-                distance_threshold,
-                alpha,
-                band_name,
-                ndvi_threshold,
-            )
+            with metrics.stage("dbest", "analysis"):
+                result = call_dbest_point(
+                    dataset,
+                    data_type,
+                    seasonality,
+                    algorithm,
+                    breakpoints_no,
+                    first_level_shift,
+                    second_level_shift,
+                    duration,
+                    distance_threshold,
+                    alpha,
+                    band_name,
+                    ndvi_threshold,
+                    engine,
+                )
         except:
             message = "Sorry, something went wrong inside DBEST function."
             return render_template("error.html", error_message=message)
 
         if save_result_to_csv == "yes":
-            result.to_csv("DBEST_result.csv")
+            with metrics.stage("dbest", "export"):
+                export_point_result(result, export_directory, "DBEST_result")
         # Step 5: Visualize results 
-        plots = dbest_visualize_point(result, time_steps, algorithm, data_type)
-
-    return plots
+        with metrics.stage("dbest", "render"):
+            plots = dbest_visualize_point(result, time_steps, algorithm, data_type)
+
+    metrics.ANALYSES.labels(
+        algorithm="dbest", aoi="polygon" if is_polygon else "point"
+    ).inc()
+    if not use_result_cache:
+        return plots
+    return result_cache.put(result_key, result, plots).to_response()
 
 
@@ -0,0 +1,670 @@
+""" In-process implementation of DBEST change detection
+
+    Analyses many pixel time series at once. All pixels of a polygon share
+    the same time axis, so the STL decomposition is a fixed linear operator
+    that is built once per series length and applied to a pixels x months
+    array with one matrix product. Level shifts, trend segmentation and the
+    significance of changes are computed with array operations over all
+    pixels as well.
+
+    The steps follow the description of DBEST, not the code of the R package:
+    level shifts are detected in the data and removed, the rest is
+    decomposed with STL (non-robust, periodic seasonal component), the trend
+    is split into linear segments at the points farthest from the current
+    fit, and the changes are tested against the noise of the remainder.
+    Results are close to, but not the same as, those of the R package; the
+    'parity' engine checks them against it, see compare_with_r.
+
+    The distance threshold is the lowest change of interest: no breakpoint
+    closer than it to the fit is added and no change smaller than it is
+    reported or tested. By default it is the noise of the remainder, its
+    standard deviation but at least NOISE_FLOOR of the mean absolute value
+    of the series, so that the rounding errors of a flat series are not
+    taken for changes. Change detection splits the trend wherever the
+    threshold allows and reports the breakpoints_no largest changes,
+    generalization splits it into at most breakpoints_no + 1 segments.
+
+    See: Jamali, S., Jönsson, P., Eklundh, L., Ardö, J., Seaquist, J., 2015.
+    Detecting changes in vegetation trends using time series segmentation.
+    Remote Sens. Environ. 156, 182–195. https://doi.org/10.1016/j.rse.2014.09.010
+
+"""
+import functools
+import math
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.ndimage import maximum_filter1d
+
+# values accepted by the "dbest_engine" parameter of the DBEST form
+ENGINES = ("r", "numpy", "parity")
+# until the in-process engine agrees with the R package, see compare_with_r
+DEFAULT_ENGINE = "r"
+
+# same fields and order as rbridge.DBEST_FIELDS
+RESULT_FIELDS = ("start", "duration", "end", "change", "change_type", "significance")
+
+# fields of the result of a point, in the order of the R package's output
+CHANGE_DETECTION_FIELDS = (
+    "breakpoint_no",
+    "segment_no",
+    "start",
+    "duration",
+    "end",
+    "change",
+    "change_type",
+    "significance",
+    "fit",
+    "data",
+    "trend",
+    "seasonal",
+    "remainder",
+)
+GENERALIZATION_FIELDS = (
+    "segment_no",
+    "RMSE",
+    "MAD",
+    "fit",
+    "data",
+    "trend",
+    "seasonal",
+    "remainder",
+    "f_local",
+)
+
+# noise of a series is at least this fraction of its mean absolute value
+NOISE_FLOOR = 1e-3
+# changes of the R package and of dbest() closer than this, relative, are equal
+CHANGE_TOLERANCE = 1e-3
+
+# pixels analysed at once, bounds the memory of the intermediate arrays
+CHUNK_SIZE = 10000
+
+
+def _next_odd(x):
+    x = int(math.ceil(x))
+    return x if x % 2 == 1 else x + 1
+
+
+def _loess_row(n, span, degree, xs, nleft, nright):
+    """ Weights of a local fit at position xs, as in the STL paper (1-based positions)
+
+    Returns None when no observation gets a weight.
+    """
+    positions = np.arange(nleft, nright + 1, dtype=np.float64)
+    h = max(xs - nleft, nright - xs)
+    if span > n:
+        h += (span - n) // 2
+    distances = np.abs(positions - xs)
+    weights = np.zeros_like(positions)
+    if h > 0:
+        weights[distances <= 0.999 * h] = (
+            1 - (distances[distances <= 0.999 * h] / h) ** 3
+        ) ** 3
+    weights[distances <= 0.001 * h] = 1.0
+    total = weights.sum()
+    if total <= 0:
+        return None
+    weights /= total
+    if h > 0 and degree > 0:
+        mean = (weights * positions).sum()
+        spread = (weights * (positions - mean) ** 2).sum()
+        if math.sqrt(spread) > 0.001 * (n - 1):
+            weights = weights * ((xs - mean) / spread * (positions - mean) + 1)
+    row = np.zeros(n)
+    row[nleft - 1 : nright] = weights
+    return row
+
+
+def _loess_matrix(n, span, degree):
+    """ n x n matrix of a loess smoother evaluated at every observation """
+    matrix = np.zeros((n, n))
+    if span >= n:
+        nleft, nright = 1, n
+    else:
+        half = (span + 1) // 2
+        nleft, nright = 1, span
+    for i in range(1, n + 1):
+        if span < n and i > half and nright != n:
+            nleft += 1
+            nright += 1
+        row = _loess_row(n, span, degree, i, nleft, nright)
+        matrix[i - 1] = row if row is not None else np.eye(n)[i - 1]
+    return matrix
+
+
+def _moving_average_matrix(n, length):
+    """ (n - length + 1) x n matrix of a moving average """
+    matrix = np.zeros((n - length + 1, n))
+    for i in range(n - length + 1):
+        matrix[i, i : i + length] = 1.0 / length
+    return matrix
+
+
+def _cycle_subseries_matrix(n, period, span, degree):
+    """ (n + 2 * period) x n matrix smoothing each cycle-subseries,
+        extended by one cycle at both ends
+    """
+    matrix = np.zeros((n + 2 * period, n))
+    for phase in range(period):
+        indices = np.arange(phase, n, period)
+        k = len(indices)
+        if k == 0:
+            continue
+        smoothed = np.zeros((k + 2, k))
+        smoothed[1 : k + 1] = _loess_matrix(k, span, degree)
+        first = _loess_row(k, span, degree, 0, 1, min(span, k))
+        smoothed[0] = first if first is not None else smoothed[1]
+        last = _loess_row(k, span, degree, k + 1, max(1, k - span + 1), k)
+        smoothed[k + 1] = last if last is not None else smoothed[k]
+        rows = phase + period * np.arange(k + 2)
+        matrix[np.ix_(rows, indices)] = smoothed
+    return matrix
+
+
+@functools.lru_cache(maxsize=32)
+def stl_operators(n, period, inner=2):
+    """ Trend and seasonal components of STL as n x n matrices
+
+    STL without robustness weights is a chain of linear smoothers, so for a
+    given series length and period its result is a fixed linear function
+    of the data. Settings are those of R's stl(x, s.window = "periodic").
+
+    Args:
+        n: int
+            number of time steps
+        period: int
+            number of time steps in a season
+        inner: int
+            number of passes of the inner loop
+
+    Returns:
+        trend_operator, seasonal_operator : numpy arrays
+            trend = data @ trend_operator.T, seasonal likewise
+
+    """
+    seasonal_span = 10 * n + 1
+    trend_span = _next_odd(1.5 * period / (1 - 1.5 / seasonal_span))
+    low_pass_span = _next_odd(period)
+
+    cycle_subseries = _cycle_subseries_matrix(n, period, seasonal_span, 0)
+    low_pass = (
+        _loess_matrix(n, low_pass_span, 1)
+        @ _moving_average_matrix(n + 2, 3)
+        @ _moving_average_matrix(n + period + 1, period)
+        @ _moving_average_matrix(n + 2 * period, period)
+    )
+    # maps the detrended data to the seasonal component
+    detrended_to_seasonal = (
+        cycle_subseries[period : period + n] - low_pass @ cycle_subseries
+    )
+    trend_smoother = _loess_matrix(n, trend_span, 1)
+
+    identity = np.eye(n)
+    trend_operator = np.zeros((n, n))
+    for _ in range(inner):
+        seasonal_operator = detrended_to_seasonal @ (identity - trend_operator)
+        trend_operator = trend_smoother @ (identity - seasonal_operator)
+
+    # a periodic seasonal component is the mean of each cycle-subseries
+    cycle = np.arange(n) % period
+    cycle_mean = (cycle[:, None] == cycle[None, :]).astype(np.float64)
+    cycle_mean /= cycle_mean.sum(axis=1, keepdims=True)
+    seasonal_operator = cycle_mean @ seasonal_operator
+    return trend_operator, seasonal_operator
+
+
+@functools.lru_cache(maxsize=32)
+def _smoothing_operator(n, period):
+    """ Trend of a series without seasonal component """
+    return _loess_matrix(n, _next_odd(1.5 * period), 1)
+
+
+@functools.lru_cache(maxsize=32)
+def trend_gain(n, data_type, seasonality):
+    """ Standard deviation of the trend of white noise of unit variance at every time step """
+    if data_type == "cyclical" and n >= 2 * seasonality:
+        operator = stl_operators(n, seasonality)[0]
+    else:
+        operator = _smoothing_operator(n, seasonality)
+    return np.sqrt((operator ** 2).sum(axis=1))
+
+
+def decompose(Y, data_type, seasonality):
+    """ Trend, seasonal and remainder components of every row of Y """
+    n = Y.shape[1]
+    if data_type == "cyclical" and n >= 2 * seasonality:
+        trend_operator, seasonal_operator = stl_operators(n, seasonality)
+        trend = Y @ trend_operator.T
+        seasonal = Y @ seasonal_operator.T
+    else:
+        trend = Y @ _smoothing_operator(n, seasonality).T
+        seasonal = np.zeros_like(Y)
+    return trend, seasonal, Y - trend - seasonal
+
+
+def level_shifts(
+    Y, data_type, seasonality, first_level_shift, second_level_shift, duration
+):
+    """ Abrupt changes in the level of every row of Y
+
+    A level shift at t is a jump of at least first_level_shift between a
+    value and the value one season earlier, where the means of the data in
+    windows of whole seasons before and after t differ by at least
+    second_level_shift. Of shifts closer than one window only the largest
+    is kept.
+
+    Returns:
+        shifts : numpy array
+            pixels x time steps, the size of the shift where one starts, 0 elsewhere
+
+    """
+    pixels, n = Y.shape
+    lag = seasonality if data_type == "cyclical" else 1
+    window = max(1, int(duration))
+    if data_type == "cyclical":
+        window = seasonality * max(1, int(round(window / seasonality)))
+    shifts = np.zeros_like(Y)
+    if n < 2 * window or n <= lag:
+        return shifts
+    cumulative = np.concatenate([np.zeros((pixels, 1)), np.cumsum(Y, axis=1)], axis=1)
+    t = np.arange(window, n - window + 1)
+    before = (cumulative[:, t] - cumulative[:, t - window]) / window
+    after = (cumulative[:, t + window] - cumulative[:, t]) / window
+    difference = after - before
+    jump = np.abs(Y[:, t] - Y[:, t - lag])
+    candidate = (jump >= first_level_shift) & (np.abs(difference) >= second_level_shift)
+    magnitude = np.where(candidate, np.abs(difference), 0.0)
+    local_maximum = maximum_filter1d(
+        magnitude, size=2 * window + 1, axis=1, mode="constant"
+    )
+    keep = candidate & (magnitude == local_maximum)
+    shifts[:, t] = np.where(keep, difference, 0.0)
+    return shifts
+
+
+def _neighbouring_breakpoints(mask):
+    """ Index of the breakpoint at or before and at or after each time step """
+    n = mask.shape[1]
+    index = np.arange(n)
+    left = np.maximum.accumulate(np.where(mask, index, 0), axis=1)
+    right = np.minimum.accumulate(np.where(mask, index, n - 1)[:, ::-1], axis=1)
+    right = right[:, ::-1]
+    return left, right
+
+
+def interpolate(values, mask):
+    """ Piecewise linear fit through the values at the breakpoints of each row """
+    n = values.shape[1]
+    left, right = _neighbouring_breakpoints(mask)
+    left_values = np.take_along_axis(values, left, axis=1)
+    right_values = np.take_along_axis(values, right, axis=1)
+    span = np.maximum(right - left, 1)
+    position = (np.arange(n)[None, :] - left) / span
+    return left_values + (right_values - left_values) * position
+
+
+def segment(trend, breakpoints_no, distance_threshold):
+    """ Splits every trend into linear segments
+
+    Breakpoints are added one at a time at the point farthest from the
+    current piecewise linear fit, until breakpoints_no points are added or
+    no point is farther than the distance threshold of its pixel.
+
+    Returns:
+        mask : numpy array
+            pixels x time steps, True at the breakpoints including both ends
+
+    """
+    pixels, n = trend.shape
+    mask = np.zeros(trend.shape, dtype=bool)
+    mask[:, 0] = True
+    mask[:, -1] = True
+    distance_threshold = np.broadcast_to(distance_threshold, (pixels,))
+    # pixels that may get another breakpoint; once none is added the fit stays the same
+    active = np.arange(pixels)
+    for _ in range(max(0, min(int(breakpoints_no), n - 2))):
+        active_mask = mask[active]
+        distance = np.abs(trend[active] - interpolate(trend[active], active_mask))
+        distance[active_mask] = -np.inf
+        farthest = distance.argmax(axis=1)
+        accepted = (
+            distance[np.arange(len(active)), farthest] > distance_threshold[active]
+        )
+        active, farthest = active[accepted], farthest[accepted]
+        if not len(active):
+            break
+        mask[active, farthest] = True
+    return mask
+
+
+def _changes(smooth_trend, mask, shifts):
+    """ Every change of every pixel: segments between breakpoints and level shifts
+
+    Returns:
+        start, end, change, change_type : numpy arrays
+            pixels x (2 * time steps); 0-based start and end, change 0 where there is none
+
+    """
+    pixels, n = smooth_trend.shape
+    index = np.arange(n)
+    # the breakpoint after each breakpoint
+    following = np.minimum.accumulate(
+        np.where(mask, index, n - 1)[:, ::-1], axis=1
+    )[:, ::-1]
+    following = np.concatenate([following[:, 1:], np.full((pixels, 1), n - 1)], axis=1)
+    is_segment = mask & (index < n - 1)[None, :]
+    segment_change = np.where(
+        is_segment,
+        np.take_along_axis(smooth_trend, following, axis=1) - smooth_trend,
+        0.0,
+    )
+    shift_start = np.maximum(index - 1, 0)[None, :].repeat(pixels, axis=0)
+    start = np.concatenate([index[None, :].repeat(pixels, axis=0), shift_start], axis=1)
+    end = np.concatenate([following, index[None, :].repeat(pixels, axis=0)], axis=1)
+    change = np.concatenate([segment_change, shifts], axis=1)
+    change_type = np.concatenate(
+        [np.zeros((pixels, n), dtype=int), np.ones((pixels, n), dtype=int)], axis=1
+    )
+    exists = np.concatenate([is_segment, shifts != 0], axis=1)
+    return start, end, np.where(exists, change, 0.0), change_type, exists
+
+
+def _noise(data, remainder):
+    """ Standard deviation of the remainder of every row, at least NOISE_FLOOR
+        of the mean absolute value of the row
+    """
+    floor = NOISE_FLOOR * np.abs(data).mean(axis=1)
+    noise = np.maximum(remainder.std(axis=1, ddof=1), floor)
+    # all-zero series
+    return np.maximum(noise, np.finfo(np.float64).tiny)
+
+
+def _significance(change, start, end, change_type, analysis, duration, alpha):
+    """ 1 where a change is larger than the distance threshold and than the noise allows
+
+    The standard error of a segment's change follows from the noise and the
+    gain of the trend smoother at the segment's ends, that of a level shift
+    from the means over duration months it compares. Breakpoints are put
+    at the extremes of the trend, so the largest changes are picked from the
+    differences between any two time steps: p-values are multiplied by the
+    number of those (Bonferroni).
+
+    Args:
+        change, start, end, change_type: numpy array
+            pixels x tested changes, 0-based start and end
+        analysis: dict
+            as returned by _analyse
+
+    """
+    gain = analysis["trend_gain"]
+    window = max(2, int(duration))
+    error = np.where(
+        change_type == 1,
+        math.sqrt(2.0 / window),
+        np.sqrt(gain[start] ** 2 + gain[end] ** 2),
+    )
+    t_values = np.abs(change) / (analysis["noise"][:, None] * error)
+    p_values = 2 * stats.t.sf(t_values, max(len(gain) - 2, 1))
+    p_values *= max(1, len(gain) * (len(gain) - 1) // 2)
+    significant = (np.abs(change) > analysis["threshold"][:, None]) & (p_values < alpha)
+    return significant.astype(int)
+
+
+def _analyse(
+    Y,
+    data_type,
+    seasonality,
+    algorithm,
+    breakpoints_no,
+    first_level_shift,
+    second_level_shift,
+    duration,
+    distance_threshold,
+):
+    """ Components, level shifts and breakpoints of every row of Y """
+    Y = np.atleast_2d(np.asarray(Y, dtype=np.float64))
+    shifts = level_shifts(
+        Y, data_type, seasonality, first_level_shift, second_level_shift, duration
+    )
+    steps = np.cumsum(shifts, axis=1)
+    smooth_trend, seasonal, remainder = decompose(Y - steps, data_type, seasonality)
+    noise = _noise(Y, remainder)
+    if distance_threshold == "default":
+        # breakpoints closer to the fit than the noise are not meaningful
+        threshold = noise
+    else:
+        threshold = np.full(len(Y), float(distance_threshold))
+    if algorithm == "generalization":
+        mask = segment(smooth_trend, breakpoints_no, threshold)
+    else:
+        # every breakpoint above the threshold, the largest changes are picked later
+        mask = segment(smooth_trend, Y.shape[1] - 2, threshold)
+    return {
+        "data": Y,
+        "shifts": shifts,
+        "smooth_trend": smooth_trend,
+        "trend": smooth_trend + steps,
+        "seasonal": seasonal,
+        "remainder": remainder,
+        "noise": noise,
+        "threshold": threshold,
+        "trend_gain": trend_gain(Y.shape[1], data_type, seasonality),
+        "mask": mask,
+        "fit": interpolate(smooth_trend, mask) + steps,
+    }
+
+
+def dbest(
+    Y,
+    data_type,
+    seasonality,
+    algorithm,
+    breakpoints_no,
+    first_level_shift,
+    second_level_shift,
+    duration,
+    distance_threshold,
+    alpha,
+    chunk_size=CHUNK_SIZE,
+):
+    """ Largest change of every row of Y, NaN for rows without a change
+        larger than the distance threshold
+
+    Args:
+        Y: numpy array
+            pixels x months matrix of values, one time series per row
+        data_type, seasonality, algorithm, breakpoints_no, first_level_shift,
+        second_level_shift, duration, distance_threshold, alpha:
+            parameters of the DBEST form, see DbestParametersForm;
+            with 'generalization' the largest change of the generalized trend
+        chunk_size : int
+            number of pixels analysed at once
+
+    Returns:
+        values : numpy array
+            pixels x 6 array of start, duration, end, change, change type and
+            significance, as returned by rbridge.dbest_batch(), NaN where
+            a pixel has no change
+
+    """
+    Y = np.atleast_2d(np.asarray(Y, dtype=np.float64))
+    chunks = []
+    for i in range(0, len(Y), chunk_size):
+        analysis = _analyse(
+            Y[i : i + chunk_size],
+            data_type,
+            seasonality,
+            algorithm,
+            breakpoints_no,
+            first_level_shift,
+            second_level_shift,
+            duration,
+            distance_threshold,
+        )
+        start, end, change, change_type, exists = _changes(
+            analysis["smooth_trend"], analysis["mask"], analysis["shifts"]
+        )
+        rows = np.arange(len(start))
+        # changes above the distance threshold, as for points in dbest_point
+        of_interest = exists & (np.abs(change) > analysis["threshold"][:, None])
+        largest = np.where(of_interest, np.abs(change), -1.0).argmax(axis=1)
+        largest_change = change[rows, largest]
+        significance = _significance(
+            largest_change[:, None],
+            start[rows, largest][:, None],
+            end[rows, largest][:, None],
+            change_type[rows, largest][:, None],
+            analysis,
+            duration,
+            alpha,
+        )[:, 0]
+        # 1-based time steps, as in the R package
+        values = np.column_stack(
+            (
+                start[rows, largest] + 1,
+                end[rows, largest] - start[rows, largest],
+                end[rows, largest] + 1,
+                largest_change,
+                change_type[rows, largest],
+                significance,
+            )
+        ).astype(np.float64)
+        # NaN for pixels without a change, as the R package gives NA
+        values[~of_interest.any(axis=1)] = np.nan
+        chunks.append(values)
+    if not chunks:
+        return np.empty((0, len(RESULT_FIELDS)))
+    return np.concatenate(chunks)
+
+
+def compare_with_r(Y, dbest_parameters, values):
+    """ Checks the output of dbest() against the DBEST R package
+
+    Args:
+        Y: numpy array
+            pixels x months matrix that was passed to dbest()
+        dbest_parameters : dict
+            keyword arguments that were passed to dbest()
+        values : numpy array
+            output of dbest() for Y
+
+    Returns:
+        report : dict
+            number of compared pixels, number of mismatches per field
+            (changes differing by more than CHANGE_TOLERANCE, relative) and
+            the largest absolute change difference
+
+    """
+    from .rbridge import dbest_batch
+
+    expected = dbest_batch(Y, dbest_parameters)
+    mismatches = {}
+    for index, field in enumerate(RESULT_FIELDS):
+        if field == "change":
+            equal = np.isclose(
+                values[:, index],
+                expected[:, index],
+                rtol=CHANGE_TOLERANCE,
+                atol=0,
+                equal_nan=True,
+            )
+        else:
+            equal = (values[:, index] == expected[:, index]) | (
+                np.isnan(values[:, index]) & np.isnan(expected[:, index])
+            )
+        mismatches[field] = int((~equal).sum())
+    difference = np.abs(values[:, 3] - expected[:, 3])
+    return {
+        "pixels": len(Y),
+        "mismatches": mismatches,
+        # NaN where neither found a change
+        "max_change_difference": float(np.nanmax(difference))
+        if np.isfinite(difference).any()
+        else 0.0,
+    }
+
+
+def dbest_point(
+    y,
+    data_type,
+    seasonality,
+    algorithm,
+    breakpoints_no,
+    first_level_shift,
+    second_level_shift,
+    duration,
+    distance_threshold,
+    alpha,
+):
+    """ DBEST on the time series of one point
+
+    Returns:
+        df : dataframe
+            one column, 0, holding the fields of the R package's output in
+            its order (CHANGE_DETECTION_FIELDS or GENERALIZATION_FIELDS), as
+            read by dbest_visualize_point
+
+    """
+    analysis = _analyse(
+        y,
+        data_type,
+        seasonality,
+        algorithm,
+        breakpoints_no,
+        first_level_shift,
+        second_level_shift,
+        duration,
+        distance_threshold,
+    )
+    data = analysis["data"][0]
+    fit = analysis["fit"][0]
+    segment_no = int(analysis["mask"][0].sum()) - 1
+    segment_no += int((analysis["shifts"][0] != 0).sum())
+    if algorithm == "generalization":
+        deseasonalized = data - analysis["seasonal"][0]
+        fields = {
+            "segment_no": np.array([segment_no]),
+            "RMSE": np.array([np.sqrt(np.mean((deseasonalized - fit) ** 2))]),
+            "MAD": np.array([np.mean(np.abs(deseasonalized - fit))]),
+            "f_local": np.diff(fit, prepend=fit[0]),
+        }
+        names = GENERALIZATION_FIELDS
+    else:
+        start, end, change, change_type, exists = _changes(
+            analysis["smooth_trend"], analysis["mask"], analysis["shifts"]
+        )
+        # the largest changes above the threshold first, at most breakpoints_no
+        # of them; none for a series without such changes
+        order = np.argsort(-np.abs(change[0]), kind="stable")
+        of_interest = exists[0] & (np.abs(change[0]) > analysis["threshold"][0])
+        order = order[of_interest[order]][: max(1, int(breakpoints_no))]
+        significance = _significance(
+            change[:, order],
+            start[:, order],
+            end[:, order],
+            change_type[:, order],
+            analysis,
+            duration,
+            alpha,
+        )[0]
+        fields = {
+            "breakpoint_no": np.array([len(order)]),
+            "segment_no": np.array([segment_no]),
+            "start": start[0][order] + 1,
+            "duration": end[0][order] - start[0][order],
+            "end": end[0][order] + 1,
+            "change": change[0][order],
+            "change_type": change_type[0][order],
+            "significance": significance,
+        }
+        names = CHANGE_DETECTION_FIELDS
+    fields.update(
+        fit=fit,
+        data=data,
+        trend=analysis["trend"][0],
+        seasonal=analysis["seasonal"][0],
+        remainder=analysis["remainder"][0],
+    )
+    return pd.DataFrame({0: pd.Series([fields[name] for name in names], dtype=object)})
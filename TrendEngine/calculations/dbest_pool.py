@@ -0,0 +1,128 @@
+""" Parallel execution of DBEST over the pixels of a polygon
+
+    Pixel time series are split into chunks which are analysed in worker
+    processes. Every worker runs its own embedded R interpreter with the
+    R packages imported once, when the worker starts (see runtime.py).
+
+"""
+import math
+import os
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# names of DBEST arguments that are not valid Python identifiers
+DBEST_TRANSLATIONS = {
+    "data.type": "data_type",
+    "breakpoints.no": "breakpoints_no",
+    "first.level.shift": "first_level_shift",
+    "second.level.shift": "second_level_shift",
+    "distance.threshold": "distance_threshold",
+}
+
+# number of chunks per worker, more chunks even out pixels that take longer
+CHUNKS_PER_WORKER = 4
+
+# pools by number of workers
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def default_workers():
+    """ Number of workers used when the configuration doesn't specify it """
+    return int(os.environ.get("DBEST_WORKERS", os.cpu_count() or 1))
+
+
+def _init_worker():
+    """ Starts R in a worker process, imports DBEST and evaluates the batch function """
+    from . import runtime
+
+    runtime.warm_up_r()
+
+
+def _run_chunk(chunk_and_parameters):
+    """ Runs DBEST on every pixel time series of a chunk
+
+    Args:
+        chunk_and_parameters: tuple
+            pixels x months array and a dict of DBEST parameters
+
+    Returns:
+        values : numpy array
+            pixels x 6 array of start, duration, end, change, change type and
+            significance of the largest change of each pixel, in the order
+            of the chunk
+
+    """
+    from . import rbridge
+
+    chunk, dbest_parameters = chunk_and_parameters
+    return rbridge.dbest_batch(chunk, dbest_parameters)
+
+
+def get_pool(workers):
+    """ Returns a pool of DBEST workers, started on first use and reused afterwards
+
+    Workers are spawned rather than forked so that none of them inherits
+    the state of the R interpreter embedded in the web server process.
+    Every number of workers has a pool of its own, so a request with a
+    different number never shuts down a pool that runs the chunks of
+    another one.
+
+    """
+    with _pool_lock:
+        if workers not in _pools:
+            _pools[workers] = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return _pools[workers]
+
+
+def iter_dbest_parallel(pixel_series, dbest_parameters, workers):
+    """ Runs DBEST on pixel time series in worker processes
+
+    Args:
+        pixel_series: numpy array
+            pixels x months array, one time series per row
+        dbest_parameters: dict
+            keyword arguments passed to DBEST for every pixel
+        workers: int
+            number of worker processes
+
+    Yields:
+        values : numpy array
+            one row per pixel of a chunk, chunks in the same order as pixel_series
+
+    """
+    if len(pixel_series) == 0:
+        return
+    chunk_size = math.ceil(len(pixel_series) / (workers * CHUNKS_PER_WORKER))
+    chunks = [
+        (pixel_series[i : i + chunk_size], dbest_parameters)
+        for i in range(0, len(pixel_series), chunk_size)
+    ]
+    pool = get_pool(workers)
+    # map returns the chunks in the order they were submitted
+    for chunk_values in pool.map(_run_chunk, chunks):
+        yield chunk_values
+
+
+def run_dbest_parallel(pixel_series, dbest_parameters, workers, progress=None):
+    """ Like iter_dbest_parallel, but returns the values of all pixels at once
+
+    progress is called with the number of analysed pixels and the number of all pixels
+    """
+    chunks = []
+    pixels_done = 0
+    for chunk_values in iter_dbest_parallel(pixel_series, dbest_parameters, workers):
+        chunks.append(chunk_values)
+        pixels_done += len(chunk_values)
+        if progress is not None:
+            progress(pixels_done, len(pixel_series))
+    if not chunks:
+        return np.empty((0, 6))
+    return np.concatenate(chunks)
@@ -0,0 +1,16 @@
+""" Selects the Earth Engine backend
+
+    By default this is the Earth Engine Python API. With the environment
+    variable TRENDENGINE_EE_BACKEND=offline the stand-in from offline_ee.py
+    is used instead, which needs no account or network, e.g. for tests and
+    benchmarks.
+
+"""
+import os
+
+BACKEND = os.environ.get("TRENDENGINE_EE_BACKEND", "earthengine")
+
+if BACKEND == "offline":
+    from . import offline_ee as ee
+else:
+    import ee
@@ -0,0 +1,159 @@
+""" Export of time series and results to files
+
+    Each request that asks for files gets its own directory under
+    TRENDENGINE_EXPORT_DIR, so concurrent users never write to the same file.
+    Time series are written as Parquet, chunk by chunk, so only one chunk
+    at a time is converted to the columnar format; result tables are
+    already columnar and are written from their arrays (ResultTable.to_arrow).
+    Per-pixel results of polygons are also written as a GeoTIFF with one
+    band per field, straight from the arrays of the result table (see
+    results.py).
+
+"""
+import os
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import rasterio
+from rasterio.transform import from_origin
+
+EXPORT_DIRECTORY = os.environ.get(
+    "TRENDENGINE_EXPORT_DIR", os.path.join(os.getcwd(), "exports")
+)
+# rows converted and written at once
+EXPORT_CHUNK_ROWS = 100000
+
+
+def make_export_directory(base=EXPORT_DIRECTORY):
+    """ Creates a new directory for the files of one request and returns its path """
+    name = "%s-%s" % (time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8])
+    path = os.path.join(base, name)
+    os.makedirs(path)
+    return path
+
+
+class ParquetStream:
+    """ Parquet file written one dataframe at a time, e.g. by batch.py
+
+    The schema is taken from the first dataframe, every write adds a row
+    group. Use as a context manager or call close().
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self._writer = None
+
+    def write(self, table):
+        if self._writer is None:
+            chunk = pa.Table.from_pandas(table, preserve_index=False)
+            self._writer = pq.ParquetWriter(self.path, chunk.schema)
+        else:
+            # later chunks take the types of the first one, e.g. int to float
+            chunk = pa.Table.from_pandas(
+                table, schema=self._writer.schema, preserve_index=False
+            )
+        self._writer.write_table(chunk)
+        self.rows += len(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_parquet(table, path, chunk_rows=EXPORT_CHUNK_ROWS):
+    """ Writes a dataframe to a Parquet file, one row group per chunk of rows
+
+    Returns:
+        path : string
+
+    """
+    with ParquetStream(path) as stream:
+        for start in range(0, max(len(table), 1), chunk_rows):
+            stream.write(table.iloc[start : start + chunk_rows])
+    return path
+
+
+def export_time_series(dataset, directory):
+    """ Writes the time series fetched for a request to time_series.parquet """
+    path = write_parquet(dataset, os.path.join(directory, "time_series.parquet"))
+    print("time series saved to ", path)
+    return path
+
+
+def export_polygon_result(result, fields, directory, name):
+    """ Writes the result of a polygon to <name>.parquet and <name>.tif
+
+    Args:
+        result: ResultTable
+            output of call_polytrend_polygon or call_dbest_polygon, see results.py
+        fields: list
+            result fields written as bands of the GeoTIFF
+        directory: string
+            output directory of the request, see make_export_directory
+        name: string
+            file name without extension, e.g. 'PolyTrend_result'
+
+    Returns:
+        paths : list
+            files written
+
+    """
+    table_path = os.path.join(directory, name + ".parquet")
+    pq.write_table(result.to_arrow(), table_path, row_group_size=EXPORT_CHUNK_ROWS)
+    paths = [table_path]
+    if len(result):
+        raster_path = os.path.join(directory, name + ".tif")
+        paths.append(write_geotiff(result, fields, raster_path))
+    print("result saved to ", paths)
+    return paths
+
+
+def write_geotiff(result, fields, path):
+    """ Writes result fields as the bands of a float32 GeoTIFF in EPSG:4326 """
+    # imported here, raster.py needs bokeh
+    from .raster import grid_result
+
+    grid = grid_result(result, fields)
+    height, width = grid[fields[0]].shape
+    transform = from_origin(
+        grid["x"], grid["y"] + grid["dh"], grid["dw"] / width, grid["dh"] / height
+    )
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=height,
+        width=width,
+        count=len(fields),
+        dtype="float32",
+        crs="EPSG:4326",
+        transform=transform,
+        nodata=np.nan,
+        compress="deflate",
+    ) as raster:
+        for band, field in enumerate(fields, start=1):
+            # grid rows start in the south, GeoTIFF rows in the north
+            raster.write(np.flipud(grid.pop(field)).astype(np.float32), band)
+            raster.set_band_description(band, field)
+    return path
+
+
+def export_point_result(result, directory, name):
+    """ Writes the result of a point to <name>.csv, it holds a single pixel """
+    path = os.path.join(directory, name + ".csv")
+    pd.DataFrame(result).to_csv(path)
+    print("result saved to ", path)
+    return path
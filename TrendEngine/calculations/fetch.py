@@ -0,0 +1,184 @@
+""" Fetch planner for getRegion requests over large areas of interest
+
+    Earth Engine refuses getRegion requests that would return more values
+    than its element limit. The planner estimates the size of the response
+    for an AOI, splits the AOI into rectangles that stay under the limit,
+    fetches them concurrently and stitches the rows into one table.
+
+"""
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+from .earthengine import ee
+from .grid import GRID_CRS, grid_step, grid_transform
+from .metrics import FETCHED_TILES
+
+# getRegion fails when points x bands x images exceeds this number
+MAX_REGION_ELEMENTS = 1048576
+# part of the limit planned for one tile, the pixel count is only an estimate
+TILE_FILL = 0.5
+# requests sent to Earth Engine at the same time
+MAX_CONCURRENT_FETCHES = 8
+
+def get_bounds(AOI):
+    """ West, south, east and north edge of a geometry built on the client
+
+    Args:
+        AOI: ee.Geometry
+            geometry created from coordinates, e.g. ee.Geometry.Polygon
+
+    Returns:
+        bounds : tuple
+
+    """
+    coordinates = AOI.toGeoJSON()["coordinates"]
+    longitudes, latitudes = [], []
+
+    def collect(item):
+        if isinstance(item[0], (list, tuple)):
+            for sub_item in item:
+                collect(sub_item)
+        else:
+            longitudes.append(item[0])
+            latitudes.append(item[1])
+
+    collect(coordinates)
+    return min(longitudes), min(latitudes), max(longitudes), max(latitudes)
+
+
+def estimate_elements(bounds, scale, number_of_images, number_of_bands=1):
+    """ Estimates the number of values getRegion returns for a rectangle
+
+    Args:
+        bounds: tuple
+            west, south, east and north edge in degrees
+        scale: int
+            pixel size in meters
+        number_of_images: int
+            number of images in the collection
+        number_of_bands: int
+            number of bands of each image
+
+    Returns:
+        elements : int
+
+    """
+    west, south, east, north = bounds
+    # pixels of the grid of grid.py, about square in meters
+    width, height = grid_step(scale, (south + north) / 2)
+    columns = max(1, math.ceil((east - west) / width))
+    rows = max(1, math.ceil((north - south) / height))
+    return columns * rows * number_of_images * number_of_bands
+
+
+def plan_tiles(bounds, scale, number_of_images, number_of_bands=1):
+    """ Splits a rectangle into a grid of rectangles that stay under the element limit
+
+    Returns:
+        tiles : list
+            west, south, east and north edge of each tile, one tile if no split is needed
+
+    """
+    elements = estimate_elements(bounds, scale, number_of_images, number_of_bands)
+    number_of_tiles = math.ceil(elements / (MAX_REGION_ELEMENTS * TILE_FILL))
+    if number_of_tiles <= 1:
+        return [bounds]
+    west, south, east, north = bounds
+    middle_latitude = math.radians((south + north) / 2)
+    width = (east - west) * math.cos(middle_latitude)
+    height = north - south
+    # keep the tiles roughly square
+    tile_columns = max(1, round(math.sqrt(number_of_tiles * width / max(height, 1e-9))))
+    tile_rows = math.ceil(number_of_tiles / tile_columns)
+    step_x = (east - west) / tile_columns
+    step_y = (north - south) / tile_rows
+    tiles = []
+    for row in range(tile_rows):
+        for column in range(tile_columns):
+            tiles.append(
+                (
+                    west + column * step_x,
+                    south + row * step_y,
+                    west + (column + 1) * step_x,
+                    south + (row + 1) * step_y,
+                )
+            )
+    return tiles
+
+
+def fetch_region(collection, geometry, scale, crs, latitude):
+    """ One getRegion request, returns the header followed by rows
+
+    With crs GRID_CRS the pixels are those of the grid of grid.py at the
+    latitude, see grid_latitude().
+
+    """
+    if crs == GRID_CRS:
+        geom_values = collection.getRegion(
+            geometry=geometry, crs=crs, crsTransform=grid_transform(scale, latitude)
+        )
+    else:
+        geom_values = collection.getRegion(geometry=geometry, scale=scale, crs=crs)
+    return ee.List(geom_values).getInfo()
+
+
+def fetch_region_tiled(
+    collection, AOI, scale, crs, latitude, number_of_images=None, number_of_bands=None
+):
+    """ getRegion for an AOI of any size
+
+    Splits the AOI into tiles when the response would be too large and
+    fetches the tiles through a bounded thread pool.
+
+    Args:
+        collection: ee.ImageCollection
+            images to sample
+        AOI: ee.Geometry
+            area of interest
+        scale: int
+            pixel size in meters
+        crs: string
+            projection of the sampled pixels
+        latitude: float
+            latitude of the grid with crs GRID_CRS, see grid.py; the tiles
+            of an AOI are sampled on the grid of the whole AOI
+        number_of_images, number_of_bands: int, optional
+            size of the collection; asked from Earth Engine when not given
+
+    Returns:
+        geom_values_list : list
+            header followed by rows of all tiles, as returned by getRegion
+
+    """
+    if number_of_images is None or number_of_bands is None:
+        size = ee.Dictionary(
+            {"images": collection.size(), "bands": collection.first().bandNames().size()}
+        ).getInfo()
+        number_of_images = number_of_images or size["images"]
+        number_of_bands = number_of_bands or size["bands"]
+    bounds = get_bounds(AOI)
+    tiles = plan_tiles(bounds, scale, number_of_images, number_of_bands)
+    FETCHED_TILES.inc(len(tiles))
+    if len(tiles) == 1:
+        return fetch_region(collection, AOI, scale, crs, latitude)
+
+    geometries = [ee.Geometry.Rectangle(list(tile)).intersection(AOI, 1) for tile in tiles]
+    workers = min(MAX_CONCURRENT_FETCHES, len(tiles))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        responses = list(
+            pool.map(
+                lambda geometry: fetch_region(collection, geometry, scale, crs, latitude),
+                geometries,
+            )
+        )
+
+    # pixels on the edge of two tiles are returned by both
+    geom_values_list = [responses[0][0]]
+    seen = set()
+    for response in responses:
+        for row in response[1:]:
+            key = (row[0], row[1], row[2])
+            if key not in seen:
+                seen.add(key)
+                geom_values_list.append(row)
+    return geom_values_list
@@ -0,0 +1,103 @@
+""" The grid on which polygons are sampled
+
+    getRegion samples images at the pixel centres of the requested
+    projection. In the native sinusoidal projection of MODIS the centres of
+    neighbouring rows are shifted in longitude, so no regular grid can be
+    inferred from their coordinates. Polygons are therefore sampled on a
+    global latitude/longitude grid, GRID_CRS with pixels of
+    grid_step(scale, latitude) degrees aligned at longitude and latitude 0,
+    passed to getRegion as grid_transform(scale, latitude). Pixel centres
+    lie at ((column + 0.5) * width, (row + 0.5) * height), so the position
+    of every pixel follows from its coordinates, the scale and the latitude
+    alone.
+
+    A degree of longitude is cos(latitude) times shorter than a degree of
+    latitude, so pixels are scale meters high and scale meters wide at the
+    latitude of the grid, grid_latitude() of the AOI: the centre of the band
+    of LATITUDE_BAND degrees its own centre lies in. AOIs in the same band
+    share a grid; pixels are square only near that latitude, which for AOIs
+    a few degrees high is close enough.
+
+"""
+import math
+
+import numpy as np
+
+METERS_PER_DEGREE = 111320.0
+GRID_CRS = "EPSG:4326"
+# AOIs whose centre lies in the same band of latitude share a grid
+LATITUDE_BAND = 1.0
+
+
+def grid_latitude(latitudes):
+    """ Latitude at which pixels of an AOI are square
+
+    Args:
+        latitudes: list
+            latitudes of the vertices of the AOI, or of a point
+
+    Returns:
+        latitude : float
+            centre of the band of LATITUDE_BAND degrees containing the
+            centre of the AOI
+
+    """
+    centre = (min(latitudes) + max(latitudes)) / 2
+    return (math.floor(centre / LATITUDE_BAND) + 0.5) * LATITUDE_BAND
+
+
+def grid_step(scale, latitude):
+    """ Width and height of a pixel in degrees, scale in meters """
+    height = scale / METERS_PER_DEGREE
+    return height / math.cos(math.radians(latitude)), height
+
+
+def grid_transform(scale, latitude):
+    """ crsTransform of the grid for getRegion, north up """
+    width, height = grid_step(scale, latitude)
+    return [width, 0, 0, 0, -height, 0]
+
+
+def global_index(coordinates, step):
+    """ Global column (of longitudes, step the width of a pixel) or row counted
+        northwards (of latitudes, step the height) of the pixels containing
+        the coordinates
+    """
+    return np.floor(np.asarray(coordinates, dtype=np.float64) / step).astype(np.int64)
+
+
+def pixel_grid(longitudes, latitudes, scale, latitude):
+    """ Position of pixel centres on the grid
+
+    Args:
+        longitudes, latitudes: numpy array
+            pixel centres returned by getRegion on the grid
+        scale: int
+            pixel size in meters
+        latitude: float
+            latitude of the grid, see grid_latitude()
+
+    Returns:
+        origin : tuple
+            longitude of column 0 and latitude of row 0
+        resolution : tuple
+            width and height of a pixel in degrees
+        rows, cols : numpy array
+            int32 position of each pixel, row 0 is the northernmost
+
+    """
+    width, height = grid_step(scale, latitude)
+    if len(longitudes) == 0:
+        empty = np.empty(0, dtype=np.int32)
+        return (0.0, 0.0), (width, height), empty, empty
+    columns = global_index(longitudes, width)
+    north_rows = global_index(latitudes, height)
+    first_column = columns.min()
+    last_row = north_rows.max()
+    origin = (float((first_column + 0.5) * width), float((last_row + 0.5) * height))
+    return (
+        origin,
+        (width, height),
+        (last_row - north_rows).astype(np.int32),
+        (columns - first_column).astype(np.int32),
+    )
@@ -0,0 +1,88 @@
+""" Typed tables from getRegion responses
+
+    getRegion returns a header, ["id", "longitude", "latitude", "time",
+    <bands>...], followed by one row of Python objects per pixel and image.
+    region_to_dataframe() reads every column out of the rows once and
+    converts it with a single NumPy call, instead of building an object
+    dataframe and converting its columns value by value:
+
+    - band values keep an integer type when they have one, e.g. MODIS NDVI
+      stays int16; bands with gaps or fractions (e.g. mean composites) are
+      float64 with NaN
+    - Earth Engine dates ({'type': 'Date', 'value': milliseconds}) become
+      datetime64, numeric times stay numbers
+    - image ids are interned as a categorical column, one integer code per row
+
+"""
+import numpy as np
+import pandas as pd
+
+# integer types tried for band values, smallest first
+INTEGER_TYPES = (np.int16, np.int32, np.int64)
+
+
+def band_column(values):
+    """ Values of a band in the smallest type that holds them
+
+    Args:
+        values: sequence
+            numbers, None where the pixel is masked
+
+    Returns:
+        column : numpy array
+            integer array if every value is a whole number, else float64
+
+    """
+    # None becomes NaN
+    column = np.array(values, dtype=np.float64)
+    if len(column) == 0 or np.isnan(column).any():
+        return column
+    if not (column == np.rint(column)).all():
+        return column
+    low, high = column.min(), column.max()
+    for dtype in INTEGER_TYPES:
+        limits = np.iinfo(dtype)
+        if limits.min <= low and high <= limits.max:
+            return column.astype(dtype)
+    return column
+
+
+def time_column(values):
+    """ Times of the rows: datetime64 for Earth Engine dates, else numbers """
+    if len(values) and isinstance(values[0], dict):
+        millis = np.fromiter(
+            (item["value"] for item in values), dtype=np.int64, count=len(values)
+        )
+        return millis.astype("datetime64[ms]")
+    return np.asarray(values)
+
+
+def region_to_dataframe(geom_values_list):
+    """ Dataframe of a getRegion response, see the module docstring
+
+    Args:
+        geom_values_list: list
+            header followed by rows, as returned by getRegion(...).getInfo()
+            or fetch.fetch_region_tiled
+
+    Returns:
+        data : dataframe
+            columns id (categorical), longitude and latitude (float64),
+            time and one column per band
+
+    """
+    header = geom_values_list[0]
+    rows = geom_values_list[1:]
+    data = {}
+    for index, name in enumerate(header):
+        # much faster than zip(*rows) for millions of rows
+        values = [row[index] for row in rows]
+        if name == "id":
+            data[name] = pd.Categorical(values)
+        elif name in ("longitude", "latitude"):
+            data[name] = np.array(values, dtype=np.float64)
+        elif name == "time":
+            data[name] = time_column(values)
+        else:
+            data[name] = band_column(values)
+    return pd.DataFrame(data, columns=header)
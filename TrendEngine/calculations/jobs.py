@@ -0,0 +1,218 @@
+""" Background jobs for polygon analyses
+
+    A polygon submission is run by a pool of worker threads instead of
+    inside the HTTP request. The request gets a job ID at once; the status,
+    progress (pixels analysed out of all pixels) and the rendered results
+    page are served by the job endpoints in routes.py. Results of finished
+    chunks of pixels are kept for streaming, see streaming.py.
+
+    A job with a preview factor first analyses the polygon at a coarse
+    scale (the dataset's scale times the factor), which takes a fraction of
+    the time, and keeps that page as the preview. It then refines the
+    analysis at the native scale, or stops after the preview and is refined
+    on request by a new job with the same parameters.
+
+"""
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import copy_current_request_context
+
+from .streaming import chunk_payload
+from .summary import make_summary
+
+# finished jobs are forgotten after this many seconds
+JOB_TTL = 3600
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+
+# passes of a job with a preview
+PREVIEW = "preview"
+NATIVE = "native"
+
+
+class Job:
+    """ State of one analysis run in the background """
+
+    def __init__(self, algorithm, pixel_size=None, parameters=None, preview_factor=None):
+        self.id = uuid.uuid4().hex
+        self.algorithm = algorithm
+        self.pixel_size = pixel_size
+        self.parameters = parameters
+        self.preview_factor = preview_factor
+        self.stage = PREVIEW if preview_factor else NATIVE
+        self.preview_html = None
+        self.status = QUEUED
+        self.pixels_done = 0
+        self.pixels_total = 0
+        self.chunks = []
+        self.statistics = make_summary(algorithm)
+        self.html = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def update_progress(self, pixels_done, pixels_total, chunk=None):
+        """ Progress callback passed to do_polytrend/do_dbest
+
+        chunk holds the results of the pixels analysed since the last call
+        """
+        if chunk is not None and len(chunk):
+            self.statistics.update(chunk)
+            if self.pixel_size is not None:
+                pixel_size = self.pixel_size
+                if self.stage == PREVIEW:
+                    pixel_size = tuple(size * self.preview_factor for size in pixel_size)
+                self.chunks.append(chunk_payload(self.algorithm, chunk, pixel_size))
+        self.pixels_done = pixels_done
+        self.pixels_total = pixels_total
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "algorithm": self.algorithm,
+            "status": self.status,
+            "pixels_done": self.pixels_done,
+            "pixels_total": self.pixels_total,
+            "error": self.error,
+            "stage": self.stage,
+            "preview_factor": self.preview_factor,
+            "preview": self.preview_html is not None,
+        }
+
+    def start_native(self):
+        """ Starts counting again for the analysis at the native scale """
+        self.stage = NATIVE
+        self.pixels_done = 0
+        self.pixels_total = 0
+        self.statistics = make_summary(self.algorithm)
+
+
+_jobs = {}
+_lock = threading.Lock()
+_executor = None
+
+
+def _get_executor(workers):
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers)
+        return _executor
+
+
+def _forget_old_jobs():
+    now = time.time()
+    with _lock:
+        for job_id in [
+            job_id
+            for job_id, job in _jobs.items()
+            if job.finished is not None and now - job.finished > JOB_TTL
+        ]:
+            del _jobs[job_id]
+
+
+def with_scale_factor(parameters, factor):
+    """ Form parameters of a preview: a coarser scale and no saved files """
+    preview = parameters.copy()
+    preview["scale_factor"] = str(factor)
+    preview["save_ts_to_csv"] = "no"
+    preview["save_result_to_csv"] = "no"
+    return preview
+
+
+def _page(page):
+    # cached results come as a response with an ETag, keep only the page
+    return page if isinstance(page, str) else page.get_data(as_text=True)
+
+
+def _run(job, function, parameters, refine=True):
+    job.status = RUNNING
+    try:
+        if job.preview_factor:
+            preview = with_scale_factor(parameters, job.preview_factor)
+            job.preview_html = _page(function(preview, progress=job.update_progress))
+            if not refine:
+                job.html = job.preview_html
+                job.status = FINISHED
+                job.finished = time.time()
+                return
+            job.start_native()
+        page = function(parameters, progress=job.update_progress)
+        job.html = _page(page)
+        job.status = FINISHED
+    except Exception as error:
+        traceback.print_exc()
+        job.error = str(error)
+        job.status = FAILED
+    job.finished = time.time()
+
+
+def submit(
+    app,
+    algorithm,
+    function,
+    parameters,
+    pixel_size=None,
+    preview_factor=None,
+    refine=True,
+):
+    """ Queues an analysis, called while handling the submitting request
+
+    The worker runs the analysis with a copy of the context of that
+    request, so do_polytrend/do_dbest read the configuration of the
+    application and render their templates (url_for) as within it; the
+    form is passed as parameters.
+
+    Args:
+        app: Flask
+            application, for the configuration of the job workers
+        algorithm: string
+            'polytrend' or 'dbest'
+        function: function
+            do_polytrend or do_dbest
+        parameters: ImmutableMultiDict
+            the submitted form
+        pixel_size: tuple, optional
+            width and height of a pixel in degrees, results are streamed
+            when given
+        preview_factor: int, optional
+            analyse at the scale times this factor first, see with_scale_factor
+        refine: bool
+            go on at the native scale after the preview; if False the job
+            ends with the preview and can be refined with refine_job()
+
+    Returns:
+        job : Job
+
+    """
+    _forget_old_jobs()
+    job = Job(algorithm, pixel_size, parameters, preview_factor)
+    with _lock:
+        _jobs[job.id] = job
+    executor = _get_executor(app.config.get("JOB_WORKERS", 2))
+    executor.submit(copy_current_request_context(_run), job, function, parameters, refine)
+    return job
+
+
+def refine_job(app, job, function):
+    """ Queues the analysis of a previewed job at the native scale
+
+    Returns:
+        job : Job
+            a new job without preview
+
+    """
+    return submit(app, job.algorithm, function, job.parameters, job.pixel_size)
+
+
+def get_job(job_id):
+    """ Returns the job or None if it doesn't exist (anymore) """
+    with _lock:
+        return _jobs.get(job_id)
@@ -0,0 +1,222 @@
+""" Timings and counters of the analyses, served to Prometheus
+
+    Every step of do_polytrend/do_dbest (building the composite, downloading
+    from Earth Engine, building the dataframe and the pixel cube, the
+    analysis, exports and rendering) is timed with stage() and recorded in
+    a histogram per algorithm and step. Earth Engine computes the composite
+    when its values are requested, so that time is part of 'download'.
+    Counters keep the number of analysed and rejected pixels, the size of
+    the fetched time series and the tiles it was fetched in, the mismatches of the in-process engines with
+    the R packages ('parity' engine), the hits and misses of the caches and
+    the years of a period taken from the cache or fetched (periods.py); the
+    sizes of the caches and the peak memory of the process are gauges.
+    They are prometheus_client metrics of REGISTRY, which /metrics renders
+    with render().
+
+    The metrics are kept per process; Prometheus adds up the workers of a
+    server when each of them is scraped.
+
+"""
+import functools
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+# upper bounds of the buckets of the duration histograms, in seconds
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# upper bounds of the buckets of the histogram of pixels per analysis
+PIXELS_BUCKETS = (1, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+NAMESPACE = "trendengine"
+# metrics of TrendEngine only, served by /metrics
+REGISTRY = CollectorRegistry()
+
+
+def _counter(name, description, label_names):
+    return Counter(name, description, label_names, namespace=NAMESPACE, registry=REGISTRY)
+
+
+def _histogram(name, description, label_names, buckets=SECONDS_BUCKETS):
+    return Histogram(
+        name,
+        description,
+        label_names,
+        namespace=NAMESPACE,
+        registry=REGISTRY,
+        buckets=buckets,
+    )
+
+
+def _gauge(name, description, label_names=()):
+    return Gauge(name, description, label_names, namespace=NAMESPACE, registry=REGISTRY)
+
+
+STAGE_SECONDS = _histogram(
+    "stage_seconds",
+    "Duration of each step of an analysis",
+    ("algorithm", "stage"),
+)
+ANALYSIS_PIXELS = _histogram(
+    "analysis_pixels",
+    "Pixels of the AOI of each analysis",
+    ("algorithm",),
+    PIXELS_BUCKETS,
+)
+ANALYSES = _counter("analyses_total", "Finished analyses", ("algorithm", "aoi"))
+PIXELS = _counter("pixels_total", "Pixels whose time series were fetched", ("algorithm",))
+REJECTED_PIXELS = _counter(
+    "rejected_pixels_total",
+    "Pixels not analysed, with a missing value or a value below the NDVI threshold",
+    ("algorithm",),
+)
+STORED_PIXELS = _counter(
+    "stored_pixels_total",
+    "Pixels of polygons whose results were read from the pixel store",
+    ("algorithm",),
+)
+PIXEL_STORE_ERRORS = _counter(
+    "pixel_store_errors_total",
+    "Block files of the pixel store that could not be read or written",
+    ("operation",),
+)
+FETCHED_BYTES = _counter(
+    "fetched_bytes_total",
+    "Size in memory of the time series tables fetched from Earth Engine",
+    ("algorithm",),
+)
+FETCHED_ROWS = _counter(
+    "fetched_rows_total",
+    "Rows (pixel and image) returned by getRegion",
+    ("algorithm",),
+)
+FETCHED_TILES = _counter(
+    "fetched_tiles_total",
+    "getRegion requests of the tiles an AOI is split into, see fetch.py",
+    (),
+)
+
+PARITY_PIXELS = _counter(
+    "parity_pixels_total",
+    "Pixels analysed in process and checked against the R package",
+    ("algorithm",),
+)
+PARITY_MISMATCHES = _counter(
+    "parity_mismatches_total",
+    "Results of pixels checked against the R package that differ from its output",
+    ("algorithm", "field"),
+)
+
+CACHE_HITS = _counter(
+    "cache_hits_total",
+    "Datasets and results found in a cache",
+    ("cache", "tier"),
+)
+CACHE_MISSES = _counter(
+    "cache_misses_total",
+    "Datasets and results not found in a cache",
+    ("cache",),
+)
+CACHE_DISK_ERRORS = _counter(
+    "cache_disk_errors_total",
+    "Cache files that could not be read or written",
+    ("cache",),
+)
+CACHED_YEARS = _counter(
+    "cached_years_total",
+    "Years of a period whose time series were found in the time series cache",
+    ("algorithm",),
+)
+FETCHED_YEARS = _counter(
+    "fetched_years_total",
+    "Years of a period whose time series were fetched from Earth Engine",
+    ("algorithm",),
+)
+# sizes of the caches, set from their stats() when /metrics is served
+CACHE_ENTRIES = _gauge("cache_entries", "Entries in a cache", ("cache", "tier"))
+CACHE_BYTES = _gauge("cache_bytes", "Size of a cache", ("cache", "tier"))
+PEAK_MEMORY = _gauge("peak_memory_bytes", "Peak resident memory of the process")
+
+
+@contextmanager
+def stage(algorithm, name):
+    """ Times the block inside the with statement as a step of an analysis
+
+    Args:
+        algorithm: string
+            'polytrend' or 'dbest'
+        name: string
+            step, e.g. 'download', 'analysis' or 'render'
+
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(algorithm=algorithm, stage=name).observe(
+            time.perf_counter() - start
+        )
+
+
+def timed(algorithm, name):
+    """ Decorator timing every call of a function as a step, see stage() """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(algorithm, name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_parity(algorithm, report):
+    """ Counts the compared pixels and the mismatches of a parity check
+
+    Args:
+        algorithm: string
+            'polytrend' or 'dbest'
+        report: dict
+            as returned by compare_with_r of polytrend_engine.py or dbest_engine.py
+
+    """
+    PARITY_PIXELS.labels(algorithm=algorithm).inc(report["pixels"])
+    for field, mismatches in report["mismatches"].items():
+        PARITY_MISMATCHES.labels(algorithm=algorithm, field=field).inc(mismatches)
+
+
+def peak_memory_bytes():
+    """ Largest resident set size of this process so far, 0 if unknown """
+    if resource is None:
+        return 0
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def render():
+    """ All metrics in the Prometheus text exposition format
+
+    Returns:
+        text : bytes
+        content type : string
+
+    """
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+PEAK_MEMORY.set_function(peak_memory_bytes)
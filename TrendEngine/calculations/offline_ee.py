@@ -0,0 +1,537 @@
+""" Offline stand-in for the Earth Engine API
+
+    Implements the part of the ee module used by TrendEngine: image
+    collections with filterDate, filterBounds, select, first, size, mean,
+    getRegion and fromImages, ee.List, ee.Number, ee.Date arithmetic,
+    ee.Dictionary and the geometries drawn in home.html.
+
+    Every object is evaluated eagerly on the client. Images carry
+    deterministic synthetic NDVI and EVI: a spatial pattern, a per-pixel
+    linear trend, an annual cycle and pseudo-random noise, so repeated runs
+    give identical time series and the whole pipeline can be profiled
+    without network access. Select it with TRENDENGINE_EE_BACKEND=offline,
+    see earthengine.py.
+
+"""
+import calendar
+import datetime
+import math
+
+import numpy as np
+
+METERS_PER_DEGREE = 111320.0
+# radius of the sphere of the sinusoidal projection of MODIS
+EARTH_RADIUS = 6371007.181
+MILLISECONDS_PER_DAY = 86400000
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# collections known to the stand-in; dates of their first and last image
+COLLECTIONS = {
+    "NASA/GIMMS/3GV0": {
+        "bands": ["ndvi", "qa"],
+        "crs": "EPSG:4326",
+        "start": datetime.datetime(1981, 7, 1),
+        "end": datetime.datetime(2013, 12, 16),
+        "images_per_year": 24,
+        "scaling": None,
+    },
+    "MODIS/006/MOD13Q1": {
+        "bands": ["NDVI", "EVI"],
+        "crs": "SR-ORG:6974",
+        "start": datetime.datetime(2000, 2, 18),
+        "end": datetime.datetime(2020, 12, 18),
+        "images_per_year": 23,
+        "scaling": 10000,
+    },
+}
+
+
+def Initialize(*args, **kwargs):
+    """ Nothing to authenticate offline """
+    return None
+
+
+def _value(item):
+    """ Plain Python value of a stand-in object """
+    if isinstance(item, (Number, String)):
+        return item._value
+    if isinstance(item, List):
+        return [_value(element) for element in item._items]
+    return item
+
+
+def _info(item):
+    """ What getInfo() would return for an item """
+    if hasattr(item, "getInfo"):
+        return item.getInfo()
+    if isinstance(item, (list, tuple)):
+        return [_info(element) for element in item]
+    if isinstance(item, dict):
+        return {key: _info(value) for key, value in item.items()}
+    return item
+
+
+class ComputedObject:
+    def getInfo(self):
+        return _value(self)
+
+
+class Number(ComputedObject):
+    def __init__(self, value):
+        self._value = _value(value)
+
+    def add(self, other):
+        return Number(self._value + _value(other))
+
+    def subtract(self, other):
+        return Number(self._value - _value(other))
+
+    def multiply(self, other):
+        return Number(self._value * _value(other))
+
+
+class String(ComputedObject):
+    def __init__(self, value):
+        self._value = value
+
+
+class List(ComputedObject):
+    def __init__(self, items):
+        if isinstance(items, List):
+            items = items._items
+        self._items = list(items)
+
+    @staticmethod
+    def sequence(start, end, step=1):
+        start, end, step = _value(start), _value(end), _value(step)
+        items = []
+        value = start
+        while value <= end:
+            items.append(value)
+            value += step
+        return List(items)
+
+    @staticmethod
+    def repeat(value, count):
+        return List([value] * int(_value(count)))
+
+    def get(self, index):
+        return self._items[int(_value(index))]
+
+    def length(self):
+        return Number(len(self._items))
+
+    def size(self):
+        return self.length()
+
+    def zip(self, other):
+        return List([[a, b] for a, b in zip(self._items, List(other)._items)])
+
+    def map(self, function):
+        return List([function(item) for item in self._items])
+
+    def flatten(self):
+        items = []
+        for item in self._items:
+            if isinstance(item, (List, list)):
+                items.extend(List(item).flatten()._items)
+            else:
+                items.append(item)
+        return List(items)
+
+    def getInfo(self):
+        return [_info(item) for item in self._items]
+
+
+class Dictionary(ComputedObject):
+    def __init__(self, items):
+        self._items = dict(items)
+
+    def getInfo(self):
+        return {key: _info(value) for key, value in self._items.items()}
+
+
+class Date(ComputedObject):
+    def __init__(self, date):
+        date = _value(date)
+        if isinstance(date, Date):
+            date = date._date
+        elif isinstance(date, str):
+            date = datetime.datetime.strptime(date[:10], "%Y-%m-%d")
+        elif isinstance(date, (int, float)):
+            date = EPOCH + datetime.timedelta(milliseconds=date)
+        self._date = date
+
+    @staticmethod
+    def fromYMD(year, month, day):
+        return Date(datetime.datetime(int(_value(year)), int(_value(month)), int(_value(day))))
+
+    def advance(self, delta, unit):
+        delta = _value(delta)
+        date = self._date
+        if unit == "year":
+            return Date(date.replace(year=date.year + int(delta)))
+        if unit == "month":
+            month = date.month - 1 + int(delta)
+            year = date.year + month // 12
+            month = month % 12 + 1
+            day = min(date.day, calendar.monthrange(year, month)[1])
+            return Date(date.replace(year=year, month=month, day=day))
+        days = {"day": 1, "week": 7}[unit]
+        return Date(date + datetime.timedelta(days=days * delta))
+
+    def millis(self):
+        return Number(int((self._date - EPOCH).total_seconds() * 1000))
+
+    def format(self, pattern=None):
+        return String(self._date.strftime("%Y-%m-%d"))
+
+    def getInfo(self):
+        return {"type": "Date", "value": _value(self.millis())}
+
+
+def _millis(date):
+    return _value(Date(date).millis())
+
+
+class Geometry(ComputedObject):
+    """ Geometry described by its bounding box """
+
+    def __init__(self, geometry_type, coordinates):
+        self._type = geometry_type
+        self._coordinates = coordinates
+
+    @staticmethod
+    def Point(coordinates):
+        coordinates = [float(c) for c in _value(coordinates)]
+        return Geometry("Point", coordinates[:2])
+
+    @staticmethod
+    def Polygon(coordinates, proj=None, geodesic=None):
+        flat = np.ravel(np.asarray(_value(coordinates), dtype=float))
+        ring = flat.reshape(-1, 2).tolist()
+        return Geometry("Polygon", [ring])
+
+    @staticmethod
+    def Rectangle(coordinates, proj=None, geodesic=None):
+        west, south, east, north = [float(c) for c in _value(coordinates)]
+        ring = [[west, south], [east, south], [east, north], [west, north]]
+        return Geometry("Polygon", [ring])
+
+    def bounds_tuple(self):
+        if self._type == "Point":
+            x, y = self._coordinates
+            return x, y, x, y
+        ring = np.asarray(self._coordinates[0])
+        return ring[:, 0].min(), ring[:, 1].min(), ring[:, 0].max(), ring[:, 1].max()
+
+    def intersection(self, other, maxError=None):
+        a, b = self.bounds_tuple(), other.bounds_tuple()
+        west, south = max(a[0], b[0]), max(a[1], b[1])
+        east, north = min(a[2], b[2]), min(a[3], b[3])
+        return Geometry.Rectangle([west, south, max(west, east), max(south, north)])
+
+    def bounds(self, maxError=None):
+        return Geometry.Rectangle(list(self.bounds_tuple()))
+
+    def toGeoJSON(self):
+        return {"type": self._type, "coordinates": self._coordinates}
+
+    def getInfo(self):
+        return self.toGeoJSON()
+
+
+class Projection(ComputedObject):
+    def __init__(self, crs):
+        self._crs = crs
+
+    def crs(self):
+        return String(self._crs)
+
+
+class Image(ComputedObject):
+    """ Image evaluated at pixel centres on request
+
+    Args:
+        bands: list
+            band names
+        sampler: function
+            takes arrays of longitudes and latitudes, returns a dict band -> values
+        properties: dict
+            image properties, e.g. system:time_start
+
+    """
+
+    def __init__(self, image=None, bands=None, sampler=None, properties=None, crs="EPSG:4326"):
+        if isinstance(image, Image):
+            bands, sampler = image._bands, image._sampler
+            properties, crs = image._properties, image._crs
+        self._bands = list(bands or [])
+        self._sampler = sampler
+        self._properties = dict(properties or {})
+        self._crs = crs
+
+    def set(self, name, value):
+        properties = dict(self._properties)
+        properties[name] = value if isinstance(value, Date) else _value(value)
+        return Image(bands=self._bands, sampler=self._sampler, properties=properties, crs=self._crs)
+
+    def get(self, name):
+        return self._properties.get(name)
+
+    def select(self, *selectors):
+        if len(selectors) == 1 and isinstance(selectors[0], (list, tuple)):
+            selectors = selectors[0]
+        bands = [self._bands[s] if isinstance(s, int) else s for s in selectors]
+        sampler = self._sampler
+
+        def select_sampler(longitudes, latitudes):
+            values = sampler(longitudes, latitudes)
+            return {band: values[band] for band in bands}
+
+        return Image(bands=bands, sampler=select_sampler, properties=self._properties, crs=self._crs)
+
+    def bandNames(self):
+        return List(self._bands)
+
+    def projection(self):
+        return Projection(self._crs)
+
+    def sample_points(self, longitudes, latitudes):
+        if self._sampler is None or not self._bands:
+            return {}
+        return self._sampler(longitudes, latitudes)
+
+    def getInfo(self):
+        return {
+            "type": "Image",
+            "bands": [{"id": band, "crs": self._crs} for band in self._bands],
+            "properties": _info(self._properties),
+        }
+
+
+def _synthetic_sampler(collection_id, time):
+    """ Deterministic vegetation index values for one image date """
+    description = COLLECTIONS[collection_id]
+    years = (time - datetime.datetime(2000, 1, 1)).days / 365.25
+    day_of_year = time.timetuple().tm_yday / 365.25
+    bands = description["bands"]
+    scaling = description["scaling"]
+
+    def sampler(longitudes, latitudes):
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        base = 0.45 + 0.3 * np.sin(longitudes * 3.1) * np.cos(latitudes * 2.3)
+        trend = 0.006 * np.sin(longitudes * 7.0 + latitudes * 5.0)
+        season = 0.15 * np.sin(2 * math.pi * (day_of_year - 0.3))
+        noise = np.sin(longitudes * 12.9898 + latitudes * 78.233 + years * 37.719) * 43758.5453
+        noise = (noise - np.floor(noise) - 0.5) * 0.04
+        ndvi = np.clip(base + trend * years + season + noise, -0.2, 1.0)
+        values = {}
+        for band in bands:
+            if band.lower() == "ndvi":
+                value = ndvi
+            elif band.lower() == "evi":
+                value = ndvi * 0.6
+            else:
+                value = np.zeros_like(ndvi)
+            if scaling:
+                value = np.rint(value * scaling).astype(np.int16)
+            values[band] = value
+        return values
+
+    return sampler
+
+
+def _mean_sampler(images):
+    def sampler(longitudes, latitudes):
+        samples = [image.sample_points(longitudes, latitudes) for image in images]
+        return {
+            band: np.mean([sample[band] for sample in samples], axis=0)
+            for band in images[0]._bands
+        }
+
+    return sampler
+
+
+class ImageCollection(ComputedObject):
+    def __init__(self, source):
+        if isinstance(source, ImageCollection):
+            self._images = list(source._images)
+        elif isinstance(source, (List, list)):
+            self._images = [Image(image) for image in List(source)._items]
+        else:
+            self._images = _raw_images(source)
+
+    @staticmethod
+    def fromImages(images):
+        collection = ImageCollection([])
+        collection._images = [image for image in List(images)._items]
+        return collection
+
+    def _with_images(self, images):
+        collection = ImageCollection([])
+        collection._images = images
+        return collection
+
+    def filterDate(self, start, end=None):
+        start = _millis(start)
+        end = _millis(end) if end is not None else start + MILLISECONDS_PER_DAY
+        return self._with_images(
+            [image for image in self._images if start <= _time_millis(image) < end]
+        )
+
+    def filterBounds(self, geometry):
+        # the synthetic collections cover the whole globe
+        return self._with_images(list(self._images))
+
+    def select(self, *selectors):
+        return self._with_images([image.select(*selectors) for image in self._images])
+
+    def first(self):
+        return self._images[0] if self._images else None
+
+    def size(self):
+        return Number(len(self._images))
+
+    def mean(self):
+        if not self._images:
+            return Image()
+        first = self._images[0]
+        return Image(bands=first._bands, sampler=_mean_sampler(self._images), crs=first._crs)
+
+    def aggregate_min(self, name):
+        return Number(min(_time_millis(image) for image in self._images))
+
+    def aggregate_max(self, name):
+        return Number(max(_time_millis(image) for image in self._images))
+
+    def getRegion(self, geometry, scale=None, crs=None, crsTransform=None):
+        """ One row per pixel and image, the first row is the header
+
+        Pixels are those of a latitude/longitude grid with crsTransform or
+        EPSG:4326, else of the sinusoidal projection of MODIS, as Earth
+        Engine samples the native projection of the collections.
+
+        """
+        if crsTransform is not None:
+            longitudes, latitudes = _pixel_centres(
+                geometry, width=crsTransform[0], height=-crsTransform[4]
+            )
+        elif crs in (None, "EPSG:4326"):
+            step = scale / METERS_PER_DEGREE
+            longitudes, latitudes = _pixel_centres(geometry, width=step, height=step)
+        else:
+            longitudes, latitudes = _sinusoidal_centres(geometry, scale)
+        bands = self._images[0]._bands if self._images else []
+        header = ["id", "longitude", "latitude", "time"] + bands
+        columns = []
+        for index, image in enumerate(self._images):
+            values = image.sample_points(longitudes, latitudes)
+            columns.append(
+                (
+                    image._properties.get("system:index", str(index)),
+                    _info(image._properties.get("system:time_start")),
+                    [values[band].tolist() if band in values else None for band in bands],
+                )
+            )
+        rows = _Region([header])
+        for pixel, (longitude, latitude) in enumerate(zip(longitudes.tolist(), latitudes.tolist())):
+            for image_id, time, values in columns:
+                row = [image_id, longitude, latitude, time]
+                row.extend(None if value is None else value[pixel] for value in values)
+                rows._items.append(row)
+        return rows
+
+    def getInfo(self):
+        return {"type": "ImageCollection", "features": [image.getInfo() for image in self._images]}
+
+
+class _Region(List):
+    """ Result of getRegion, rows hold plain values only """
+
+    def getInfo(self):
+        return [list(row) for row in self._items]
+
+
+def _time_millis(image):
+    time = image._properties.get("system:time_start")
+    if isinstance(time, Date):
+        return _millis(time)
+    return time
+
+
+def _raw_images(collection_id):
+    """ Images of a synthetic collection at regular intervals between its first and last date """
+    description = COLLECTIONS[collection_id]
+    step = datetime.timedelta(days=365.25 / description["images_per_year"])
+    images = []
+    time = description["start"]
+    while time <= description["end"]:
+        images.append(
+            Image(
+                bands=description["bands"],
+                sampler=_synthetic_sampler(collection_id, time),
+                properties={
+                    "system:index": time.strftime("%Y_%m_%d"),
+                    "system:time_start": _millis(time),
+                },
+                crs=description["crs"],
+            )
+        )
+        time += step
+    return images
+
+
+def _pixel_centres(geometry, width, height):
+    """ Centres of the pixels of a global grid of width x height degrees inside the geometry """
+    west, south, east, north = geometry.bounds_tuple()
+    first_column = math.floor(west / width)
+    first_row = math.floor(south / height)
+    # a pixel belongs to the geometry if its centre is inside; edges shared by tiles count once
+    columns = np.arange(first_column, max(first_column + 1, math.ceil(east / width)))
+    rows = np.arange(first_row, max(first_row + 1, math.ceil(north / height)))
+    longitudes = (columns + 0.5) * width
+    latitudes = (rows + 0.5) * height
+    if east > west:
+        longitudes = longitudes[(longitudes >= west) & (longitudes < east)]
+    if north > south:
+        latitudes = latitudes[(latitudes >= south) & (latitudes < north)]
+    grid_longitudes, grid_latitudes = np.meshgrid(longitudes, latitudes[::-1])
+    return np.round(grid_longitudes.ravel(), 8), np.round(grid_latitudes.ravel(), 8)
+
+
+def _sinusoidal_centres(geometry, scale):
+    """ Centres of the pixels of the sinusoidal projection inside the geometry
+
+    Rows are scale meters apart in latitude; along a row, pixels are scale
+    meters apart, so their longitudes shift from row to row.
+
+    """
+    west, south, east, north = geometry.bounds_tuple()
+    first_row = math.floor(math.radians(south) * EARTH_RADIUS / scale)
+    last_row = max(first_row + 1, math.ceil(math.radians(north) * EARTH_RADIUS / scale))
+    longitudes, latitudes = [], []
+    for row in range(last_row - 1, first_row - 1, -1):
+        latitude = math.degrees((row + 0.5) * scale / EARTH_RADIUS)
+        if north > south and not south <= latitude < north:
+            continue
+        # meters per degree of longitude along this row
+        meters = math.radians(1) * EARTH_RADIUS * math.cos(math.radians(latitude))
+        first_column = math.floor(west * meters / scale)
+        columns = np.arange(
+            first_column, max(first_column + 1, math.ceil(east * meters / scale))
+        )
+        row_longitudes = (columns + 0.5) * scale / meters
+        if east > west:
+            row_longitudes = row_longitudes[
+                (row_longitudes >= west) & (row_longitudes < east)
+            ]
+        longitudes.append(row_longitudes)
+        latitudes.append(np.full(len(row_longitudes), latitude))
+    if not longitudes:
+        return np.empty(0), np.empty(0)
+    return (
+        np.round(np.concatenate(longitudes), 8),
+        np.round(np.concatenate(latitudes), 8),
+    )
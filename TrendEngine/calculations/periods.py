@@ -0,0 +1,164 @@
+""" Time series of polygons assembled from composites cached per year
+
+    Users often run an AOI again with the period extended by a year or
+    two, or shifted. Instead of fetching the composites of every year again,
+    get_dataset_by_year() keeps the time series of each year in the time
+    series cache (see cache.py) under a key of its own, fetches only the
+    years that are not cached, with one getRegion request per run of
+    consecutive missing years, and assembles the requested period locally.
+
+    Monthly composites are kept per year as well, the twelve months of a
+    year in one entry, since the form only asks for whole years.
+
+"""
+import numpy as np
+import pandas as pd
+
+from .cache import make_cache_key, time_series_cache
+from .utils import get_dataset_for_polygon
+from . import metrics
+
+
+def make_year_keys(
+    dataset, band_name, composite, coordinates, scale, latitude, start_year, end_year
+):
+    """ Cache key of the time series of every year of a period
+
+    Args:
+        see make_cache_key, start_year and end_year are ints
+
+    Returns:
+        keys : dict
+            {year: key}
+
+    """
+    return {
+        year: make_cache_key(
+            dataset,
+            band_name,
+            composite,
+            coordinates,
+            scale,
+            latitude,
+            "%d-01-01" % year,
+            "%d-12-31" % year,
+        )
+        for year in range(start_year, end_year + 1)
+    }
+
+
+def missing_runs(years):
+    """ Groups sorted years into runs of consecutive years
+
+    Returns:
+        runs : list
+            first and last year of each run, e.g. [(2001, 2003), (2010, 2010)]
+
+    """
+    runs = []
+    for year in years:
+        if runs and runs[-1][1] == year - 1:
+            runs[-1] = (runs[-1][0], year)
+        else:
+            runs.append((year, year))
+    return runs
+
+
+# numeric times above this are milliseconds since the epoch, below it years
+MILLISECONDS_FROM = 10000
+
+
+def year_of_rows(data):
+    """ Year of each row, from datetime64 times, from years set as time by
+        the annual composites or from milliseconds of raw images
+    """
+    if pd.api.types.is_datetime64_any_dtype(data["time"]):
+        return data["time"].dt.year.values
+    times = data["time"].values.astype(np.int64)
+    if len(times) and times.max() >= MILLISECONDS_FROM:
+        return times.astype("datetime64[ms]").astype("datetime64[Y]").astype(int) + 1970
+    return times
+
+
+def get_dataset_by_year(
+    is_polytrend,
+    collection,
+    make_composite,
+    AOI,
+    scale,
+    crs,
+    latitude,
+    year_keys,
+    images_per_year,
+    number_of_bands=None,
+):
+    """ Gets time series of every pixel in the AOI, fetching only uncached years
+
+    Args:
+        is_polytrend: bool
+            which algorithm the data is for, see get_dataset_for_polygon
+        collection: ee.ImageCollection
+            images of the AOI; every run of years is filtered to whole
+            years, so that the composite of a year never depends on the
+            requested period
+        make_composite: function
+            called with the collection, the first and the last year of a
+            run, e.g. make_annual_composite
+        AOI: ee.Geometry
+            area of interest
+        scale: int
+            pixel size in meters
+        crs: string
+            projection of the sampled pixels
+        latitude: float
+            latitude of the grid, see grid.py
+        year_keys: dict
+            cache key of each year of the period, see make_year_keys
+        images_per_year: int
+            1 for annual and 12 for monthly composites
+        number_of_bands: int, optional
+            bands of the composites, see fetch.py
+
+    Returns:
+        data : dataframe
+            rows of all years of the period, as from get_dataset_for_polygon
+
+    """
+    algorithm = "polytrend" if is_polytrend else "dbest"
+    years = sorted(year_keys)
+    parts = {}
+    for year in years:
+        part = time_series_cache.get(year_keys[year])
+        if part is not None:
+            parts[year] = part
+    missing = [year for year in years if year not in parts]
+    metrics.CACHED_YEARS.labels(algorithm=algorithm).inc(len(parts))
+    metrics.FETCHED_YEARS.labels(algorithm=algorithm).inc(len(missing))
+
+    for first, last in missing_runs(missing):
+        with metrics.stage(algorithm, "composite"):
+            composite = make_composite(
+                collection.filterDate("%d-01-01" % first, "%d-01-01" % (last + 1)),
+                first,
+                last,
+            )
+        data = get_dataset_for_polygon(
+            is_polytrend,
+            composite,
+            AOI,
+            scale,
+            crs,
+            latitude,
+            number_of_images=images_per_year * (last - first + 1),
+            number_of_bands=number_of_bands,
+        )
+        row_years = year_of_rows(data)
+        for year in range(first, last + 1):
+            part = data[row_years == year].reset_index(drop=True)
+            time_series_cache.put(year_keys[year], part)
+            parts[year] = part
+
+    data = pd.concat([parts[year] for year in years], ignore_index=True)
+    # categories of the years differ, intern the ids again
+    data["id"] = data["id"].astype("category")
+    return data
@@ -0,0 +1,151 @@
+""" Dense pixel x time representation of the time series returned by getRegion
+
+    getRegion returns one row per pixel and image. PixelCube reshapes those
+    rows once into a contiguous 2-D array, so the algorithms can read the
+    time series of a pixel as a row of the array.
+
+"""
+import numpy as np
+import pandas as pd
+
+from .grid import pixel_grid
+
+
+class PixelCube:
+    """ Values of one band for every pixel and time step of a dataset
+
+    Attributes:
+        values: numpy array
+            pixels x time steps array of float64, NaN where there is no value
+        times: numpy array
+            time axis, sorted
+        mask: numpy array
+            pixels x time steps array of bool, True where the value is valid
+        rows, cols: numpy array
+            int32 position of each pixel on the grid, row 0 is the northernmost
+        longitudes, latitudes: numpy array
+            coordinates of each pixel as returned by getRegion
+        origin: tuple
+            longitude of column 0 and latitude of row 0
+        resolution: tuple
+            distance between neighbouring columns and rows in degrees
+
+    """
+
+    def __init__(self, values, times, mask, rows, cols, longitudes, latitudes, origin, resolution):
+        self.values = values
+        self.times = times
+        self.mask = mask
+        self.rows = rows
+        self.cols = cols
+        self.longitudes = longitudes
+        self.latitudes = latitudes
+        self.origin = origin
+        self.resolution = resolution
+
+    @classmethod
+    def from_dataset(cls, dataset, band_name, scale, latitude, time_column="time"):
+        """ Builds the cube from the output of get_dataset_for_polygon
+
+        Args:
+            dataset: Pandas dataframe
+                one row per pixel and image with longitude, latitude, time and band columns
+            band_name: string
+                name of the band to be analysed
+            scale: int
+                pixel size in meters of the grid the dataset was sampled on, see grid.py
+        latitude: float
+            latitude of that grid
+            time_column: string
+                column identifying the time step of each row
+
+        Returns:
+            PixelCube
+
+        """
+        # pixels keep the order in which getRegion lists them
+        pixel_codes, pixel_keys = pd.factorize(
+            pd.MultiIndex.from_arrays(
+                [
+                    dataset["longitude"].values.astype(np.float64),
+                    dataset["latitude"].values.astype(np.float64),
+                ]
+            )
+        )
+        time_codes, times = pd.factorize(dataset[time_column], sort=True)
+
+        values = np.full((len(pixel_keys), len(times)), np.nan, dtype=np.float64)
+        values[pixel_codes, time_codes] = pd.to_numeric(
+            dataset[band_name], errors="coerce"
+        ).values
+        values = np.ascontiguousarray(values)
+        mask = ~np.isnan(values)
+
+        longitudes = pixel_keys.get_level_values(0).values
+        latitudes = pixel_keys.get_level_values(1).values
+        origin, resolution, rows, cols = pixel_grid(longitudes, latitudes, scale, latitude)
+        return cls(
+            values,
+            np.asarray(times),
+            mask,
+            rows,
+            cols,
+            longitudes,
+            latitudes,
+            origin,
+            resolution,
+        )
+
+    @property
+    def number_of_pixels(self):
+        return self.values.shape[0]
+
+    @property
+    def number_of_times(self):
+        return self.values.shape[1]
+
+    @property
+    def shape(self):
+        """ Number of rows and columns of the grid covering all pixels """
+        return int(self.rows.max()) + 1, int(self.cols.max()) + 1
+
+    def take(self, indices):
+        """ Cube of some of the pixels, on the same grid
+
+        Args:
+            indices: numpy array
+                positions of the pixels in this cube, or a boolean mask
+
+        Returns:
+            PixelCube
+
+        """
+        return PixelCube(
+            np.ascontiguousarray(self.values[indices]),
+            self.times,
+            self.mask[indices],
+            self.rows[indices],
+            self.cols[indices],
+            self.longitudes[indices],
+            self.latitudes[indices],
+            self.origin,
+            self.resolution,
+        )
+
+    def qualified(self, threshold):
+        """ Pixels with a valid value above the threshold at every time step """
+        with np.errstate(invalid="ignore"):
+            return self.mask.all(axis=1) & (self.values > threshold).all(axis=1)
+
+    def coordinates(self, rows, cols):
+        """ Longitude and latitude of the centre of grid cells """
+        longitude = self.origin[0] + np.asarray(cols) * self.resolution[0]
+        latitude = self.origin[1] - np.asarray(rows) * self.resolution[1]
+        return longitude, latitude
+
+    def grid_index(self, longitude, latitude):
+        """ Row and column of the grid cells containing the given coordinates """
+        cols = np.rint((np.asarray(longitude) - self.origin[0]) / self.resolution[0])
+        rows = np.rint((self.origin[1] - np.asarray(latitude)) / self.resolution[1])
+        return rows.astype(np.int32), cols.astype(np.int32)
+
@@ -0,0 +1,382 @@
+""" Persistent per-pixel results, reused by overlapping polygons
+
+    Analysts often draw overlapping polygons over the same region with the
+    same parameters. The pixel store keeps the result of every analysed
+    pixel, so a new polygon only fetches and analyses the pixels that no
+    earlier polygon covered.
+
+    Pixels are those of the grid polygons are sampled on (see grid.py),
+    identified by their global column and row. They are indexed in
+    blocks of BLOCK_PIXELS x BLOCK_PIXELS pixels aligned at longitude and
+    latitude 0, one Parquet file per block. A block file lists the pixels
+    of the block analysed so far, also those rejected by the NDVI threshold
+    (has_result is False for them), with their results. Polygons add the
+    pixels they analysed to the files of their blocks.
+
+    A polygon keeps the pixels whose centre lies inside it, with its edges
+    straight lines of longitude and latitude; the polygon is fetched with
+    the same planar edges (geodesic=False), so Earth Engine returns the
+    pixels the store selects. It reads the blocks it touches, fetches the
+    part of the polygon around the pixels no block lists and analyses only
+    those pixels.
+
+    Every combination of algorithm, dataset, scale, grid latitude, period
+    and algorithm parameters has a directory of its own under
+    TRENDENGINE_PIXEL_STORE_DIR, see make_store_key. Files that have not
+    been used for MAX_AGE are removed. Two requests adding pixels to the
+    same block at the same time may lose the pixels of one of them; they
+    are analysed again later.
+
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from .cache import DIRECTORY, MAX_AGE, _remove
+from .earthengine import ee
+from .grid import global_index, grid_step
+from .results import FIELD_TYPES, ResultTable
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+STORE_DIRECTORY = os.environ.get(
+    "TRENDENGINE_PIXEL_STORE_DIR", os.path.join(DIRECTORY, "pixels")
+)
+# pixels per side of a block of the index
+BLOCK_PIXELS = 32
+
+
+def make_store_key(
+    algorithm, dataset_name, scale, latitude, start_year, end_year, algorithm_parameters
+):
+    """ Key of the pixel results of one analysis setup, whatever the AOI
+
+    Args:
+        algorithm: string
+            'polytrend' or 'dbest'
+        dataset_name: string
+            value of the dataset field in home.html
+        scale: int
+            pixel size in meters
+        latitude: float
+            latitude of the grid, see grid.py; polygons on different grids
+            share no pixels
+        start_year, end_year: int
+            period of the analysis
+        algorithm_parameters: dict
+            every parameter of the algorithm that changes the result of a pixel
+
+    Returns:
+        key : string
+
+    """
+    description = json.dumps(
+        [
+            algorithm,
+            dataset_name,
+            scale,
+            latitude,
+            start_year,
+            end_year,
+            sorted(algorithm_parameters.items()),
+        ]
+    )
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+
+def points_in_polygon(longitudes, latitudes, coordinates):
+    """ Which points lie inside a polygon with planar edges, by ray casting
+
+    Args:
+        longitudes, latitudes: numpy array
+            coordinates of the points
+        coordinates: list
+            longitude, latitude, longitude, latitude... of the polygon
+            as parsed from the form
+
+    Returns:
+        inside : numpy array of bool
+
+    """
+    xs, ys = coordinates[0::2], coordinates[1::2]
+    inside = np.zeros(len(longitudes), dtype=bool)
+    for i in range(len(xs)):
+        x1, y1 = xs[i - 1], ys[i - 1]
+        x2, y2 = xs[i], ys[i]
+        if y1 == y2:
+            continue
+        crosses = (latitudes < y1) != (latitudes < y2)
+        x_cross = x1 + (latitudes - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (longitudes < x_cross)
+    return inside
+
+
+def pixel_keys(columns, rows):
+    """ One int64 per pixel from its global column and row, for set operations """
+    return np.asarray(columns, dtype=np.int64) * 2 ** 32 + (
+        np.asarray(rows, dtype=np.int64) + 2 ** 31
+    )
+
+
+class PixelStore:
+    """ Blocks of pixel results of one analysis setup, see the module docstring """
+
+    def __init__(self, algorithm, key, scale, latitude, directory=STORE_DIRECTORY):
+        self.algorithm = algorithm
+        self.scale = scale
+        self.latitude = latitude
+        self.directory = os.path.join(directory, key)
+        # width and height of a pixel in degrees
+        self.step = grid_step(scale, latitude)
+
+    def blocks_in(self, bounds):
+        """ Blocks, as (column, row), overlapping the west, south, east, north bounds """
+        west, south, east, north = bounds
+        width, height = self.step
+        columns = range(
+            int(global_index(west, width)) // BLOCK_PIXELS,
+            int(global_index(east, width)) // BLOCK_PIXELS + 1,
+        )
+        rows = range(
+            int(global_index(south, height)) // BLOCK_PIXELS,
+            int(global_index(north, height)) // BLOCK_PIXELS + 1,
+        )
+        return [(column, row) for row in rows for column in columns]
+
+    def centres(self, columns, rows):
+        """ Longitudes and latitudes of the centres of pixels """
+        width, height = self.step
+        return (np.asarray(columns) + 0.5) * width, (np.asarray(rows) + 0.5) * height
+
+    def pixel_keys(self, longitudes, latitudes):
+        """ pixel_keys() of the pixels containing the coordinates """
+        width, height = self.step
+        return pixel_keys(global_index(longitudes, width), global_index(latitudes, height))
+
+    def pixels_of(self, block):
+        """ Global columns and rows of the pixels of a block """
+        offsets = np.arange(BLOCK_PIXELS)
+        columns, rows = np.meshgrid(
+            block[0] * BLOCK_PIXELS + offsets, block[1] * BLOCK_PIXELS + offsets
+        )
+        return columns.ravel(), rows.ravel()
+
+    def blocks_of(self, columns, rows):
+        """ Blocks, as (column, row), containing the given pixels """
+        return sorted(
+            set(
+                zip(
+                    (np.asarray(columns) // BLOCK_PIXELS).tolist(),
+                    (np.asarray(rows) // BLOCK_PIXELS).tolist(),
+                )
+            )
+        )
+
+    def _path(self, block):
+        return os.path.join(self.directory, "%d_%d.parquet" % block)
+
+    def read(self, blocks):
+        """ Pixels listed by the blocks, columns column, row, has_result and the fields """
+        tables = []
+        for block in blocks:
+            path = self._path(block)
+            if not os.path.exists(path):
+                continue
+            if time.time() - os.path.getmtime(path) > MAX_AGE:
+                _remove(path)
+                continue
+            try:
+                tables.append(pd.read_parquet(path))
+            except Exception:
+                # the pixels of the block are analysed again
+                logger.exception("pixel store: couldn't read %s", path)
+                metrics.PIXEL_STORE_ERRORS.labels(operation="read").inc()
+                _remove(path)
+                continue
+            # modification time records the last use
+            os.utime(path)
+        if not tables:
+            return self.empty_table()
+        return pd.concat(tables, ignore_index=True)
+
+    def empty_table(self):
+        table = pd.DataFrame(
+            {
+                "column": np.empty(0, dtype=np.int32),
+                "row": np.empty(0, dtype=np.int32),
+                "has_result": np.empty(0, dtype=bool),
+            }
+        )
+        for name, dtype in FIELD_TYPES[self.algorithm]:
+            table[name] = np.empty(0, dtype=dtype)
+        return table
+
+    def add(self, table):
+        """ Adds analysed pixels to the files of their blocks
+
+        Args:
+            table: dataframe
+                pixels as returned by read()
+
+        """
+        if len(table) == 0:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        block_columns = table["column"].values // BLOCK_PIXELS
+        block_rows = table["row"].values // BLOCK_PIXELS
+        for block in self.blocks_of(table["column"].values, table["row"].values):
+            part = table[(block_columns == block[0]) & (block_rows == block[1])]
+            part = pd.concat([self.read([block]), part], ignore_index=True)
+            part = part.drop_duplicates(["column", "row"], keep="last")
+            path = self._path(block)
+            # write to a temporary file so readers never see half a file
+            temporary_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+            try:
+                part.to_parquet(temporary_path, index=False)
+                os.replace(temporary_path, path)
+            except Exception:
+                logger.exception("pixel store: couldn't write %s", path)
+                metrics.PIXEL_STORE_ERRORS.labels(operation="write").inc()
+                _remove(temporary_path)
+
+
+class PolygonLookup:
+    """ What a polygon takes from the store and what is left to analyse
+
+    Used in three steps by do_polytrend/do_dbest: fetch_area() tells what
+    to fetch (nothing when every pixel is stored), select() keeps the
+    pixels of the fetched cube that are not stored and merge() stores
+    their results and returns those of the whole polygon.
+
+    """
+
+    def __init__(self, store, coordinates):
+        self.store = store
+        self.coordinates = coordinates
+        xs, ys = coordinates[0::2], coordinates[1::2]
+        # pixels whose centre lies inside the polygon, tested one block at
+        # a time so that large polygons never hold their whole bounding box
+        columns, rows = [], []
+        for block in store.blocks_in((min(xs), min(ys), max(xs), max(ys))):
+            block_columns, block_rows = store.pixels_of(block)
+            longitudes, latitudes = store.centres(block_columns, block_rows)
+            inside = points_in_polygon(longitudes, latitudes, coordinates)
+            columns.append(block_columns[inside])
+            rows.append(block_rows[inside])
+        self.columns, self.rows = np.concatenate(columns), np.concatenate(rows)
+        self.keys = pixel_keys(self.columns, self.rows)
+
+        stored = store.read(store.blocks_of(self.columns, self.rows))
+        stored = stored[
+            np.isin(pixel_keys(stored["column"].values, stored["row"].values), self.keys)
+        ]
+        self.stored = stored.reset_index(drop=True)
+        self.missing = ~np.isin(
+            self.keys, pixel_keys(stored["column"].values, stored["row"].values)
+        )
+        self.analysed = None
+
+    def fetch_area(self):
+        """ Geometry to fetch and its coordinates for the cache keys
+
+        Returns:
+            geometry, coordinates : ee.Geometry, list
+                the part of the polygon, with planar edges, in the bounding
+                box of the missing pixels, and the coordinates of the
+                polygon followed by the edges of the box; None, None when
+                every pixel is stored
+
+        """
+        if not self.missing.any():
+            return None, None
+        width, height = self.store.step
+        columns, rows = self.columns[self.missing], self.rows[self.missing]
+        bounds = [
+            float(columns.min() * width),
+            float(rows.min() * height),
+            float((columns.max() + 1) * width),
+            float((rows.max() + 1) * height),
+        ]
+        # the edges of a geodesic polygon bend away from the straight edges
+        # of points_in_polygon, the planar polygon has the same pixels
+        polygon = ee.Geometry.Polygon(self.coordinates, None, False)
+        return (
+            polygon.intersection(ee.Geometry.Rectangle(bounds, None, False), 1),
+            self.coordinates + bounds,
+        )
+
+    def select(self, cube):
+        """ Pixels of the fetched cube that are inside the polygon and not stored """
+        keys = self.store.pixel_keys(cube.longitudes, cube.latitudes)
+        cube = cube.take(np.isin(keys, self.keys[self.missing]))
+        self.analysed = cube
+        return cube
+
+    def merge(self, result=None):
+        """ Stores the results of the analysed pixels and adds those stored before
+
+        Args:
+            result: ResultTable, optional
+                results of the qualified pixels of select(), None if
+                nothing was fetched
+
+        Returns:
+            result : ResultTable
+                results of the pixels of the polygon
+
+        """
+        algorithm = self.store.algorithm
+        width, height = self.store.step
+        table = self.store.empty_table()
+        if self.analysed is not None and self.analysed.number_of_pixels:
+            # every analysed pixel, with the results of the qualified ones
+            columns = global_index(self.analysed.longitudes, width)
+            rows = global_index(self.analysed.latitudes, height)
+            has_result = np.zeros(len(columns), dtype=bool)
+            fields = {
+                name: np.zeros(len(columns), dtype=dtype)
+                for name, dtype in FIELD_TYPES[algorithm]
+            }
+            if result is not None and len(result):
+                order = np.argsort(pixel_keys(columns, rows))
+                positions = order[
+                    np.searchsorted(
+                        pixel_keys(columns, rows)[order],
+                        self.store.pixel_keys(result.longitudes, result.latitudes),
+                    )
+                ]
+                has_result[positions] = True
+                for name in fields:
+                    fields[name][positions] = result[name]
+            table = pd.DataFrame(
+                {
+                    "column": columns.astype(np.int32),
+                    "row": rows.astype(np.int32),
+                    "has_result": has_result,
+                    **fields,
+                }
+            )
+            self.store.add(table)
+
+        from_store = int(self.stored["has_result"].sum())
+        metrics.STORED_PIXELS.labels(algorithm=algorithm).inc(from_store)
+        table = pd.concat([self.stored, table], ignore_index=True)
+        table = table[table["has_result"].values]
+        longitudes, latitudes = self.store.centres(table["column"].values, table["row"].values)
+        table = pd.DataFrame(
+            {
+                "longitude": longitudes,
+                "latitude": latitudes,
+                **{name: table[name].values for name, _ in FIELD_TYPES[algorithm]},
+            }
+        )
+        return ResultTable.from_dataframe(
+            algorithm, table, self.store.scale, self.store.latitude
+        )
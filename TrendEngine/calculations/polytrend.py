@@ -1,4 +1,4 @@
-from flask import Flask, render_template, url_for, request, flash, Blueprint
+from flask import Flask, render_template, url_for, request, flash, Blueprint, current_app
 import jinja2
 from werkzeug import ImmutableMultiDict
 
@@ -6,16 +6,11 @@ from werkzeug import ImmutableMultiDict
 from math import pi
 from bokeh.transform import cumsum
 
+import logging
+
 # for transforming R objects
 import numpy as np
 import pandas as pd
-import geopandas as gpd
-import pandas_bokeh
-from shapely.geometry import Point
-from rpy2.robjects.packages import importr
-from rpy2.robjects.vectors import FloatVector
-import rpy2.robjects as ro
-import re
 
 # for bokeh maps and plots
 from bokeh.io import show
@@ -26,21 +21,45 @@ from bokeh.layouts import layout, row
 from bokeh.embed import components
 
 # local imports
-from .utils import get_dataset_for_point, get_dataset_for_polygon, get_PT_statistics
+from .utils import (
+    get_dataset_for_point,
+    get_PT_statistics,
+    parse_coordinates,
+)
+from .cache import make_cache_key, make_result_key, result_cache, snap_coordinates
+from .catalog import covers_years, get_dataset
+from .periods import get_dataset_by_year, make_year_keys
+from .compositing import COMPOSITING, DEFAULT_COMPOSITING, get_composited_dataset
+from .grid import GRID_CRS, grid_latitude
+from .pixelcube import PixelCube
+from .pixelstore import PixelStore, PolygonLookup, make_store_key
+from .results import ResultTable, whole_table
+from .summary import histogram_figure
+from .export import export_polygon_result, export_time_series, make_export_directory
+from .raster import DEFAULT_MAP_MODE, MAP_MODES, raster_maps
+from . import metrics, polytrend_engine, rbridge, runtime
+
+logger = logging.getLogger(__name__)
 
 try:
-    import ee
+    from .earthengine import ee
 except ImportError:
     raise ImportError("You either haven't installed or authenticated Earth Engine")
-ee.Initialize()
+
+# colours of the raster maps, the same as those of the patch maps
+TREND_TYPE_COLORS = {-1: "grey", 0: "yellow", 1: "green", 2: "blue", 3: "red"}
+DIRECTION_COLORS = {-1: "yellow", 1: "green"}
 
 
-def visualize_polytrend_polygon(result):
+def visualize_polytrend_polygon(result, map_mode=DEFAULT_MAP_MODE):
     """ Create maps for polygons
 
     Args:
-        result: list 
-            contains what comes out of PolyTrend R package 
+        result: ResultTable
+            output of call_polytrend_polygon, see results.py
+        map_mode: string
+            'raster' draws each map as one image (see raster.py),
+            'patches' draws a patch per pixel
 
     Returns: 
         render_template with graphics
@@ -122,16 +141,45 @@ def visualize_polytrend_polygon(result):
     direction_pie.axis.axis_label = None
     direction_pie.axis.visible = False
     direction_pie.grid.grid_line_color = None
-    pie_layout = row([trend_pie, direction_pie], sizing_mode="stretch_both")
+    slope_histogram = histogram_figure(
+        result_to_display["histograms"]["slope"], "Slope (number of pixels)"
+    )
+    pie_layout = row(
+        [trend_pie, direction_pie, slope_histogram], sizing_mode="stretch_both"
+    )
     script, div = components(pie_layout)
 
     ### get maps
-    gpd_coordinates = result["geometry"].apply(Point)
-    gpd_df = gpd.GeoDataFrame(result, geometry=gpd_coordinates)
+    if map_mode == "raster":
+        plot_grid = raster_maps(
+            result,
+            [
+                ("trend_type", "Map of trend types", None, TREND_TYPE_COLORS),
+                ("direction", "Map of direction", None, DIRECTION_COLORS),
+                ("slope", "Slope map", palette, None),
+            ],
+        )
+        return render_template(
+            "results_polytrend.html",
+            result=result_to_display,
+            pt_map=plot_grid,
+            script=script,
+            div=div,
+            is_point=False,
+        )
+    # only the patch maps need geopandas and pandas_bokeh
+    import geopandas as gpd
+    import pandas_bokeh
+    from shapely.geometry import Point
+
+    table = result.to_dataframe()
+    gpd_coordinates = [
+        Point(longitude, latitude)
+        for longitude, latitude in zip(table["longitude"], table["latitude"])
+    ]
+    gpd_df = gpd.GeoDataFrame(table, geometry=gpd_coordinates)
     gpd_df.crs = {"init": "epsg:4326"}
-    pointA = result["geometry"][0]
-    pointB = result["geometry"][1]
-    buffer_size = pointA.distance(pointB) / 2
+    buffer_size = result.resolution[0] / 2
     gpd_df.geometry = gpd_df.geometry.buffer(buffer_size).envelope
     colormap_trend = ["grey", "yellow", "green", "blue", "red"]
     trend_map = gpd_df.plot_bokeh(
@@ -249,68 +297,85 @@ def visualize_polytrend_point(result, name_of_collection, start_year):
     )
 
 
-def call_polytrend_polygon(dataset, alpha, band_name, ndvi_threshold):
-    """ Splits the dataframe representing whole image into pixels
-        Calls PolyTrend R package on time series of each pixel
+def iter_polytrend_polygon(
+    cube, alpha, ndvi_threshold, engine="r", chunk_size=rbridge.CHUNK_SIZE
+):
+    """ Runs PolyTrend on the pixels of the pixel cube chunk by chunk
 
     Args:
-        dataset: Pandas dataframe 
-            NDVI values per pixel, organized by geographic coordinates and date 
+        cube: PixelCube
+            NDVI values per pixel and year, see pixelcube.py
         alpha : float
             statistical significance of the fit specified by the user in home.html form
-
-    Returns: 
-        reduced_dataset : dataframe
-            modified dataset reduced by the number of examined years. Contains for each pixel:
-            geographic coordinates, trend type, linear trend slope, direction of change, significance
+        engine : string
+            'r', 'numpy' or 'parity', see call_polytrend_polygon; the parity
+            report of each chunk is logged and counted in metrics.py
+        chunk_size : int
+            number of pixels analysed at once
+
+    Yields:
+        pixels_done, pixels_total, chunk : int, int, ResultTable
+            number of analysed and of all qualified pixels and the
+            results of the last chunk, a view on the table of all
+            qualified pixels (see results.py)
 
     """
-    PT = importr("PolyTrend")
-    PT_result = []
-    # establish how many images there are in the collection
-    list_of_images = dataset["id"]
-    ids_of_images = []
-    for img_id in list_of_images:
-        if img_id not in ids_of_images:
-            ids_of_images.append(img_id)
-
-    n = len(ids_of_images)
-    print("number of images: ", n)
-    number_of_pixels = len(dataset)
-    print("number of pixels analysed: ", number_of_pixels)
-    # split the dataset into pixel time series
-    for i in range(0, number_of_pixels, n):
-        Y = dataset[i : i + n][band_name].values
-        if all(val > ndvi_threshold for val in Y):
-            vec = FloatVector(Y)
-            result = list(PT.PolyTrend(Y=vec, alpha=alpha))
-            # populate the empty PT_result list with values
-            pixel_long = dataset.at[i, "longitude"]
-            pixel_lat = dataset.at[i, "latitude"]
-            geometry = [pixel_long, pixel_lat]
-            PT_result_header = [
-                "geometry",
-                "trend_type",
-                "slope",
-                "direction",
-                "significance",
-            ]
-            PT_result.append(
-                [
-                    geometry,
-                    int(result[2][0]),
-                    result[3][0],
-                    int(result[4][0]),
-                    int(result[5][0]),
-                ]
-            )
+    qualified = cube.qualified(ndvi_threshold)
+    metrics.PIXELS.labels(algorithm="polytrend").inc(cube.number_of_pixels)
+    metrics.REJECTED_PIXELS.labels(algorithm="polytrend").inc(int((~qualified).sum()))
+    pixel_indices = np.flatnonzero(qualified)
+    Y = cube.values[qualified]
+    if len(Y) == 0:
+        yield 0, 0, ResultTable.empty("polytrend")
+        return
+
+    # filled in place, chunk by chunk
+    table = ResultTable.allocate("polytrend", cube, pixel_indices)
+    for start in range(0, len(Y), chunk_size):
+        Y_chunk = Y[start : start + chunk_size]
+        if engine == "r":
+            # one call of the R package per chunk of pixels, see rbridge.py
+            result = rbridge.polytrend_batch(Y_chunk, alpha, chunk_size)
         else:
-            print("!!!!!!!!!!!!!!! Unqualified value !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-            pass
+            result = polytrend_engine.polytrend(Y_chunk, alpha, chunk_size)
+            if engine == "parity":
+                report = polytrend_engine.compare_with_r(Y_chunk, alpha, result)
+                metrics.record_parity("polytrend", report)
+                log = logger.warning if any(report["mismatches"].values()) else logger.info
+                log("PolyTrend parity with R package: %s", report)
+        table.fill(start, result)
+        yield start + len(Y_chunk), len(Y), table.view(start, start + len(Y_chunk))
 
-    # create a data frame for displaying results on a map
-    reduced_dataset = pd.DataFrame(PT_result[0:], columns=PT_result_header)
-    return reduced_dataset
+
+def call_polytrend_polygon(cube, alpha, ndvi_threshold, engine="r", progress=None):
+    """ Takes time series of each pixel from the pixel cube
+        and runs PolyTrend on them
+
+    Args:
+        cube: PixelCube
+            NDVI values per pixel and year, see pixelcube.py
+        alpha : float
+            statistical significance of the fit specified by the user in home.html form
+        engine : string
+            'r' calls PolyTrend R package on each pixel, 'numpy' classifies all pixels at once
+            in process, 'parity' does the latter and checks the output against the R package
+        progress : function, optional
+            called after each chunk with the number of analysed pixels, the number
+            of all pixels and the results of the chunk
+
+    Returns: 
+        result : ResultTable
+            for each qualified pixel: its position on the grid, trend type,
+            linear trend slope, direction of change, significance
+
+    """
+    chunk_size = rbridge.CHUNK_SIZE if engine == "r" else polytrend_engine.CHUNK_SIZE
+    for pixels_done, pixels_total, chunk in iter_polytrend_polygon(
+        cube, alpha, ndvi_threshold, engine, chunk_size
+    ):
+        if progress is not None:
+            progress(pixels_done, pixels_total, chunk)
+    return whole_table(chunk)
 
 
 def call_polytrend_point(dataset, alpha, band_name, ndvi_threshold):
@@ -328,15 +393,17 @@ def call_polytrend_point(dataset, alpha, band_name, ndvi_threshold):
             geographic coordinates, trend type, linear trend slope, direction of change, significance
 
     """
-    PT = importr("PolyTrend")
+    PT = runtime.r_package("PolyTrend")
     PT_result = []
     Y = dataset[band_name].values
+    metrics.PIXELS.labels(algorithm="polytrend").inc()
     # check if Y qualifies
     if all(val > ndvi_threshold for val in Y):
-        vec = FloatVector(Y)
-        result = list(PT.PolyTrend(Y=vec, alpha=alpha))
+        with runtime.r_lock:
+            result = list(PT.PolyTrend(Y=rbridge.to_r_vector(Y), alpha=alpha))
     else:
         # this will present a new screen with message that the values don't qualify
+        metrics.REJECTED_PIXELS.labels(algorithm="polytrend").inc()
         print("Values below the threshold - probably water")
         exit()
     # populate the empty PT_result list
@@ -399,7 +466,8 @@ def make_annual_composite(collection, start_year, end_year):
     return annual_ndvi
 
 
-def do_polytrend(parameters):
+@metrics.timed("polytrend", "total")
+def do_polytrend(parameters, progress=None):
     """ Get user defined parameters. Make an annual image composite. Derive time series from GEE.
         Analyze with PolyTrend. Visualize. 
 
@@ -408,6 +476,8 @@ def do_polytrend(parameters):
     Args:
         parameters: dict 
             parameters for data and the algorithm specified by the user in home.html form 
+        progress: function, optional
+            called with the number of analysed pixels and the number of all pixels, see jobs.py
 
     Returns: 
         plots 
@@ -417,35 +487,41 @@ def do_polytrend(parameters):
     """
 
     # Step 1: get all parameters entered by the user and transform them
-    name_of_collection = parameters["dataset_name"]
-    if name_of_collection == "NASA/GIMMS/3GV0":
-        band_name = "ndvi"
-        scale = 8000
-        ndvi_threshold = 0.1
-    elif name_of_collection == "MODIS/006/MOD13Q1_NDVI":
-        name_of_collection = "MODIS/006/MOD13Q1"
-        band_name = "NDVI"
-        scale = 250
-        ndvi_threshold = 1000
-    elif name_of_collection == "MODIS/006/MOD13Q1_EVI":
-        name_of_collection = "MODIS/006/MOD13Q1"
-        band_name = "EVI"
-        scale = 250
-        ndvi_threshold = 1000
-    coordinates = parameters["coordinates"]
-    regex = re.sub("[\[\]]", "", coordinates)
-    split = regex.split(",")
-    coords = list(map(float, split))
+    try:
+        runtime.ensure_ee()
+    except Exception as error:
+        print("Earth Engine could not be initialized: ", error)
+        message = "Sorry, Google Earth Engine is not available at the moment."
+        return render_template("error.html", error_message=message)
+    try:
+        dataset_info = get_dataset(parameters.get("dataset_name"), "polytrend")
+    except KeyError:
+        message = "Sorry, this dataset is not available."
+        return render_template("error.html", error_message=message)
+    name_of_collection = dataset_info["collection_id"]
+    band_name = dataset_info["band_name"]
+    scale = dataset_info["scale"]
+    ndvi_threshold = dataset_info["ndvi_threshold"]
+    coords = parse_coordinates(parameters["coordinates"])
     if len(coords) > 2:
         aoi = ee.Geometry.Polygon(coords)
         is_polygon = True
         is_point = False
     elif len(coords) == 2:
+        # points are sampled on the grid too, see grid.py; clicks within
+        # one of its pixels give the same point and share the caches
+        coords = snap_coordinates(coords, scale)
         aoi = ee.Geometry.Point(coords)
         is_point = True
         is_polygon = False
     else:
         print("wrong coordinates")
+    # previews of polygons are analysed at a coarser scale, see jobs.py
+    scale_factor = max(1, parameters.get("scale_factor", 1, type=int))
+    if len(coords) > 2:
+        scale = scale * scale_factor
+    # pixels of polygons are square in meters at this latitude, see grid.py
+    latitude = grid_latitude(coords[1::2])
 
     start_year = parameters.get("from_year")
     end_year = parameters.get("to_year")
@@ -453,61 +529,189 @@ def do_polytrend(parameters):
     end_date = end_year + "-12-31"
     start_year = int(start_year)
     end_year = int(end_year)
+    if not covers_years(dataset_info, start_year, end_year):
+        print("dataset empty")
+        message = "Sorry, the dataset for this period does not exist."
+        return render_template("error.html", error_message=message)
     img_collection = ee.ImageCollection(name_of_collection)
-    crs = img_collection.first().getInfo()["bands"][0]["crs"]
     collection = img_collection.filterDate(start_date, end_date).filterBounds(aoi)
     save_ts_to_csv = parameters.get("save_ts_to_csv")
     save_result_to_csv = parameters.get("save_result_to_csv")
     is_polytrend = True
     alpha = parameters.get("alpha", type=float)
-    try:
-        crs = collection.first().getInfo()["bands"][0]["crs"]
-    except TypeError:
-        print("dataset empty")
-        return render_template("error.html")
-
-    # Setp 2: make an anual composite of image collections using mean value
-    annual_ndvi = make_annual_composite(collection, start_year, end_year)
+    engine = parameters.get("engine", polytrend_engine.DEFAULT_ENGINE)
+    if engine not in polytrend_engine.ENGINES:
+        engine = polytrend_engine.DEFAULT_ENGINE
+    map_mode = parameters.get("map_mode", DEFAULT_MAP_MODE)
+    if map_mode not in MAP_MODES:
+        map_mode = DEFAULT_MAP_MODE
+    # composites of polygons are made in Earth Engine or locally, see compositing.py
+    compositing = parameters.get("compositing", DEFAULT_COMPOSITING)
+    if compositing not in COMPOSITING:
+        compositing = DEFAULT_COMPOSITING
+
+    # a finished analysis of the same pixels with the same parameters is reused
+    result_key = make_result_key(
+        "polytrend",
+        parameters.get("dataset_name"),
+        coords,
+        start_year,
+        end_year,
+        {
+            "alpha": alpha,
+            "engine": engine,
+            "map_mode": map_mode,
+            "scale_factor": scale_factor,
+            "compositing": compositing,
+        },
+    )
+    use_result_cache = save_ts_to_csv != "yes" and save_result_to_csv != "yes"
+    # the time series of stored pixels are not fetched again, so not when they are saved
+    use_pixel_store = current_app.config.get("PIXEL_STORE", False) and save_ts_to_csv != "yes"
+    # files of this request are written to a directory of their own, see export.py
+    export_directory = None if use_result_cache else make_export_directory()
+    if use_result_cache:
+        cached = result_cache.get(result_key)
+        if cached is not None:
+            return cached.to_response()
 
     # Depending on whether AOI is a point or polygon get a dataset, analyze it and visualize results
     if is_polygon:
-        # Step 3: get numerical values from GEE as dataframe
-        try:
-            dataset = get_dataset_for_polygon(
-                is_polytrend, annual_ndvi, aoi, scale, crs
+        # pixels analysed for earlier polygons are taken from the pixel
+        # store, only the others are fetched and analysed, see pixelstore.py
+        lookup = None
+        fetch_aoi, fetch_coords = aoi, coords
+        if use_pixel_store:
+            store_key = make_store_key(
+                "polytrend",
+                parameters.get("dataset_name"),
+                scale,
+                latitude,
+                start_year,
+                end_year,
+                {"alpha": alpha, "engine": engine, "compositing": compositing},
             )
-        except:
-            message = "Sorry, couldn't get the data you requested. Possible problems: the dataset is too large (study area too large), study period is too long or the dataset for this period does not exist."
-            return render_template("error.html", error_message=message)
-        if save_ts_to_csv:
-            dataset.to_csv("time_series.csv")
-        # Step 4: analyze data using PolyTrend algorithm
-        try:
-            result = call_polytrend_polygon(dataset, alpha, band_name, ndvi_threshold)
-        except:
-            message = "Sorry, something went wrong inside the PolyTrend function."
-            return render_template("error.html", error_message=message)
+            store = PixelStore("polytrend", store_key, scale, latitude)
+            lookup = PolygonLookup(store, coords)
+            fetch_aoi, fetch_coords = lookup.fetch_area()
+        result = None
+        if fetch_aoi is not None:
+            # Step 3: get numerical values from GEE as dataframe, only for
+            # the years that were not fetched before, see periods.py
+            try:
+                if COMPOSITING[compositing] is None:
+                    dataset = get_dataset_by_year(
+                        is_polytrend,
+                        img_collection.filterBounds(fetch_aoi),
+                        make_annual_composite,
+                        fetch_aoi,
+                        scale,
+                        GRID_CRS,
+                        latitude,
+                        make_year_keys(
+                            name_of_collection,
+                            band_name,
+                            "annual_mean",
+                            fetch_coords,
+                            scale,
+                            latitude,
+                            start_year,
+                            end_year,
+                        ),
+                        images_per_year=1,
+                        number_of_bands=dataset_info["number_of_bands"],
+                    )
+                else:
+                    # raw observations, shared with DBEST, composited locally
+                    dataset = get_composited_dataset(
+                        is_polytrend,
+                        img_collection.filterBounds(fetch_aoi),
+                        fetch_aoi,
+                        scale,
+                        GRID_CRS,
+                        latitude,
+                        dataset_info,
+                        fetch_coords,
+                        start_year,
+                        end_year,
+                        "annual",
+                        COMPOSITING[compositing],
+                    )
+            except:
+                message = "Sorry, couldn't get the data you requested. Possible problems: the dataset is too large (study area too large), study period is too long or the dataset for this period does not exist."
+                return render_template("error.html", error_message=message)
+            if save_ts_to_csv == "yes":
+                with metrics.stage("polytrend", "export"):
+                    export_time_series(dataset, export_directory)
+            with metrics.stage("polytrend", "reshape"):
+                cube = PixelCube.from_dataset(dataset, band_name, scale, latitude)
+                if lookup is not None:
+                    cube = lookup.select(cube)
+            metrics.ANALYSIS_PIXELS.labels(algorithm="polytrend").observe(
+                cube.number_of_pixels
+            )
+            # Step 4: analyze data using PolyTrend algorithm
+            try:
+                with metrics.stage("polytrend", "analysis"):
+                    result = call_polytrend_polygon(
+                        cube, alpha, ndvi_threshold, engine, progress
+                    )
+            except:
+                message = "Sorry, something went wrong inside the PolyTrend function."
+                return render_template("error.html", error_message=message)
+        if lookup is not None:
+            result = lookup.merge(result)
         if save_result_to_csv == "yes":
-            result.to_csv("PolyTrend_result.csv")
+            with metrics.stage("polytrend", "export"):
+                export_polygon_result(
+                    result,
+                    ["trend_type", "slope", "direction", "significance"],
+                    export_directory,
+                    "PolyTrend_result",
+                )
         # Step 5: visualize results
-        plots = visualize_polytrend_polygon(result)
+        with metrics.stage("polytrend", "render"):
+            plots = visualize_polytrend_polygon(result, map_mode)
 
     elif is_point:
+        # Setp 2: make an anual composite of image collections using mean value
+        with metrics.stage("polytrend", "composite"):
+            annual_ndvi = make_annual_composite(collection, start_year, end_year)
+        cache_key = make_cache_key(
+            name_of_collection,
+            band_name,
+            "annual_mean",
+            coords,
+            scale,
+            latitude,
+            start_date,
+            end_date,
+        )
         # Step 3: get numerical values from GEE as dataframe
         try:
-            dataset = get_dataset_for_point(is_polytrend, annual_ndvi, aoi, scale, crs)
+            dataset = get_dataset_for_point(
+                is_polytrend, annual_ndvi, aoi, scale, GRID_CRS, latitude, cache_key
+            )
         except:
             message = "Sorry, couldn't get the data you requested. Possible problems: the dataset is too large (study area too large), study period is too long or the dataset for this period does not exist."
             return render_template("error.html", error_message=message)
         if save_ts_to_csv == "yes":
-            dataset.to_csv("time_series.csv")
+            with metrics.stage("polytrend", "export"):
+                export_time_series(dataset, export_directory)
         # Step 4: analyze data using PolyTrend algorithm
         try:
-            result = call_polytrend_point(dataset, alpha, band_name, ndvi_threshold)
+            with metrics.stage("polytrend", "analysis"):
+                result = call_polytrend_point(dataset, alpha, band_name, ndvi_threshold)
         except:
             message = "Sorry, something went wrong inside the PolyTrend function."
             return render_template("error.html", error_message=message)
         # Step 5: visualize results
-        plots = visualize_polytrend_point(result, name_of_collection, start_year)
-
-    return plots
+        with metrics.stage("polytrend", "render"):
+            plots = visualize_polytrend_point(result, name_of_collection, start_year)
+
+    metrics.ANALYSES.labels(
+        algorithm="polytrend", aoi="polygon" if is_polygon else "point"
+    ).inc()
+    if not use_result_cache:
+        return plots
+    return result_cache.put(result_key, result, plots).to_response()
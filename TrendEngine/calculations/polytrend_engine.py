@@ -0,0 +1,190 @@
+""" In-process implementation of the PolyTrend algorithm
+
+    Classifies the trend of many pixel time series at once. All pixels of a
+    polygon share the same time axis, so the cubic, quadratic and linear fits
+    reduce to a few matrix products over a pixels x years array instead of one
+    R call per pixel.
+
+    See: Jamali, S., Seaquist, J., Eklundh, L., Ardö, J., 2014.
+    Automated mapping of vegetation trends with polynomials using NDVI imagery over the Sahel.
+    Remote Sens. Environ. 141, 79–89. https://doi.org/10.1016/j.rse.2013.10.019
+
+"""
+import numpy as np
+from scipy import stats
+
+# values accepted by the "engine" parameter of the PolyTrend form
+ENGINES = ("r", "numpy", "parity")
+# until the in-process engine agrees with the R package, see compare_with_r
+DEFAULT_ENGINE = "r"
+
+RESULT_FIELDS = ("trend_type", "slope", "direction", "significance", "degree")
+
+# slopes of the R package and of polytrend() closer than this, relative, are equal
+SLOPE_TOLERANCE = 1e-6
+
+# pixels classified at once, bounds the memory of the intermediate arrays
+CHUNK_SIZE = 50000
+
+
+def fit_polynomial(Y, degree):
+    """ Least squares fit of a polynomial in time to every row of Y
+
+    Args:
+        Y: numpy array
+            pixels x years matrix of values
+        degree: int
+            degree of the fitted polynomial
+
+    Returns:
+        coefficients : numpy array
+            pixels x (degree + 1) matrix, lowest power first
+        p_values : numpy array
+            pixels x (degree + 1) matrix, two-sided t-test of each coefficient
+
+    """
+    n = Y.shape[1]
+    X = np.arange(1, n + 1, dtype=np.float64)
+    design = np.vander(X, degree + 1, increasing=True)
+    # same solution for every pixel, so solve once against all of them
+    pseudo_inverse = np.linalg.pinv(design)
+    coefficients = Y @ pseudo_inverse.T
+    residuals = Y - coefficients @ design.T
+    df = n - degree - 1
+    if df < 1:
+        p_values = np.ones_like(coefficients)
+        return coefficients, p_values
+    sigma2 = (residuals ** 2).sum(axis=1) / df
+    unscaled = np.diag(np.linalg.inv(design.T @ design))
+    std_error = np.sqrt(sigma2[:, None] * unscaled[None, :])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_values = coefficients / std_error
+    p_values = 2 * stats.t.sf(np.abs(t_values), df)
+    # a perfect fit gives 0/0; R reports such coefficients as not significant
+    p_values[np.isnan(p_values)] = 1.0
+    return coefficients, p_values
+
+
+def polytrend(Y, alpha, chunk_size=CHUNK_SIZE, progress=None):
+    """ Runs PolyTrend on every row of Y
+
+    Args:
+        Y: numpy array
+            pixels x years matrix of values, one time series per row
+        alpha : float
+            statistical significance of the fit
+        chunk_size : int
+            number of pixels classified at once
+        progress : function, optional
+            called with the number of classified pixels and the number of all pixels
+
+    Returns:
+        result : dict
+            numpy arrays of length pixels: trend_type, slope, direction,
+            significance and degree, encoded the same way as in the R package
+
+    """
+    Y = np.atleast_2d(np.asarray(Y, dtype=np.float64))
+    if len(Y) <= chunk_size:
+        result = _polytrend_chunk(Y, alpha)
+        if progress is not None:
+            progress(len(Y), len(Y))
+        return result
+    chunks = []
+    for start in range(0, len(Y), chunk_size):
+        chunks.append(_polytrend_chunk(Y[start : start + chunk_size], alpha))
+        if progress is not None:
+            progress(min(start + chunk_size, len(Y)), len(Y))
+    return {
+        field: np.concatenate([chunk[field] for chunk in chunks])
+        for field in RESULT_FIELDS
+    }
+
+
+def _polytrend_chunk(Y, alpha):
+    """ Classifies the rows of Y, see polytrend() """
+    n = Y.shape[1]
+    first, last = 1.0, float(n)
+
+    # cubic: significant cubic term and both extremes inside the time period
+    cubic, cubic_p = fit_polynomial(Y, 3)
+    a, b, c = cubic[:, 3], cubic[:, 2], cubic[:, 1]
+    discriminant = 4 * b ** 2 - 12 * a * c
+    with np.errstate(divide="ignore", invalid="ignore"):
+        root = np.sqrt(np.where(discriminant > 0, discriminant, np.nan))
+        root_1 = (-2 * b + root) / (6 * a)
+        root_2 = (-2 * b - root) / (6 * a)
+    is_cubic = (
+        (cubic_p[:, 3] < alpha)
+        & (discriminant > 0)
+        & (root_1 >= first)
+        & (root_1 <= last)
+        & (root_2 >= first)
+        & (root_2 <= last)
+    )
+
+    # quadratic: significant quadratic term and the extreme inside the time period
+    quadratic, quadratic_p = fit_polynomial(Y, 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        extreme = -quadratic[:, 1] / (2 * quadratic[:, 2])
+    is_quadratic = (quadratic_p[:, 2] < alpha) & (extreme >= first) & (extreme <= last)
+
+    # linear fit provides the slope, direction and significance for every pixel
+    linear, linear_p = fit_polynomial(Y, 1)
+    slope = linear[:, 1]
+    is_linear = linear_p[:, 1] < alpha
+
+    degree = np.select([is_cubic, is_quadratic, is_linear], [3, 2, 1], default=0)
+    significance = np.where(is_linear, 1, -1)
+    # polynomial trend without a significant net change is a concealed trend
+    trend_type = np.where((degree >= 2) & ~is_linear, -1, degree)
+    direction = np.sign(slope).astype(int)
+
+    return {
+        "trend_type": trend_type,
+        "slope": slope,
+        "direction": direction,
+        "significance": significance,
+        "degree": degree,
+    }
+
+
+def compare_with_r(Y, alpha, result):
+    """ Checks the output of polytrend() against the PolyTrend R package
+
+    Args:
+        Y: numpy array
+            pixels x years matrix that was passed to polytrend()
+        alpha : float
+            statistical significance of the fit
+        result : dict
+            output of polytrend() for Y
+
+    Returns:
+        report : dict
+            number of compared pixels, number of mismatches per field
+            (slopes differing by more than SLOPE_TOLERANCE, relative) and
+            the largest absolute slope difference
+
+    """
+    from .rbridge import polytrend_batch
+
+    expected = polytrend_batch(Y, alpha)
+    mismatches = {}
+    for field in RESULT_FIELDS:
+        if field == "slope":
+            mismatches[field] = int(
+                (
+                    ~np.isclose(
+                        result["slope"], expected["slope"], rtol=SLOPE_TOLERANCE, atol=0
+                    )
+                ).sum()
+            )
+        else:
+            mismatches[field] = int((expected[field] != result[field]).sum())
+    difference = np.abs(expected["slope"] - result["slope"])
+    return {
+        "pixels": len(Y),
+        "mismatches": mismatches,
+        "max_slope_difference": float(difference.max(initial=0.0)),
+    }
@@ -0,0 +1,146 @@
+""" Raster rendering of polygon result maps
+
+    Pixels of a polygon lie on a regular grid, so a result field can be
+    drawn as one image instead of one patch per pixel. The results are put
+    on a 2-D array per field (NaN where no pixel was analysed) and every map
+    is a single Bokeh image glyph with a colour mapper; hovering shows the
+    value of the pixel under the cursor.
+
+"""
+import numpy as np
+
+from bokeh.embed import components
+from bokeh.layouts import gridplot
+from bokeh.models import ColorBar, HoverTool, LinearColorMapper
+from bokeh.palettes import Viridis256
+from bokeh.plotting import figure
+
+# values of the "map_mode" form field
+MAP_MODES = ("raster", "patches")
+DEFAULT_MAP_MODE = "raster"
+
+
+def grid_result(result, fields):
+    """ Puts result fields of every pixel onto a regular grid
+
+    Args:
+        result: ResultTable
+            output of call_polytrend_polygon or call_dbest_polygon,
+            with the position of each pixel on the grid, see results.py
+        fields: list
+            fields to be gridded
+
+    Returns:
+        grid : dict
+            a rows x columns float array per field, first row is the
+            southernmost, and x, y, dw, dh placing the image on the map
+
+    """
+    step_x, step_y = result.resolution
+    # the rows of the result count from the north
+    rows = result.rows.max() - result.rows
+    cols = result.cols - result.cols.min()
+    shape = (int(rows.max()) + 1, int(cols.max()) + 1)
+    west = result.origin[0] + result.cols.min() * step_x
+    south = result.origin[1] - result.rows.max() * step_y
+    grid = {
+        "x": west - step_x / 2,
+        "y": south - step_y / 2,
+        "dw": shape[1] * step_x,
+        "dh": shape[0] * step_y,
+    }
+    for field in fields:
+        image = np.full(shape, np.nan)
+        image[rows, cols] = result.with_nan(field)
+        grid[field] = image
+    return grid
+
+
+def raster_map(grid, field, title, palette=Viridis256, categories=None):
+    """ Map of one gridded field
+
+    Args:
+        grid: dict
+            output of grid_result
+        field: string
+            field to be drawn
+        title: string
+            title of the map
+        palette: list
+            colours of a continuous field
+        categories: dict, optional
+            colour of each value of a categorical field, e.g. {0: 'yellow', 1: 'green'}
+
+    Returns:
+        figure
+
+    """
+    image = grid[field]
+    if categories is not None:
+        values = sorted(categories)
+        # one colour per integer from the smallest to the largest value
+        palette = [
+            categories.get(value, "white") for value in range(values[0], values[-1] + 1)
+        ]
+        low, high = values[0] - 0.5, values[-1] + 0.5
+    else:
+        finite = image[np.isfinite(image)]
+        low, high = (finite.min(), finite.max()) if len(finite) else (0, 1)
+    # cells without a pixel stay transparent
+    mapper = LinearColorMapper(
+        palette=palette, low=low, high=high, nan_color=(0, 0, 0, 0)
+    )
+    plot = figure(
+        title=title,
+        match_aspect=True,
+        x_range=(grid["x"], grid["x"] + grid["dw"]),
+        y_range=(grid["y"], grid["y"] + grid["dh"]),
+        tools="pan,wheel_zoom,reset,save",
+        plot_width=500,
+        plot_height=450,
+    )
+    renderer = plot.image(
+        image=[image],
+        x=grid["x"],
+        y=grid["y"],
+        dw=grid["dw"],
+        dh=grid["dh"],
+        color_mapper=mapper,
+    )
+    plot.add_tools(
+        HoverTool(
+            renderers=[renderer],
+            tooltips=[
+                ("longitude", "$x{0.0000}"),
+                ("latitude", "$y{0.0000}"),
+                (field, "@image"),
+            ],
+        )
+    )
+    plot.add_layout(ColorBar(color_mapper=mapper, location=(0, 0)), "right")
+    return plot
+
+
+def raster_maps(result, maps, columns=2):
+    """ Grid of raster maps, as HTML to be put into a results template
+
+    Args:
+        result: ResultTable
+            output of call_polytrend_polygon or call_dbest_polygon
+        maps: list
+            (field, title, palette, categories) of each map, see raster_map
+        columns: int
+            maps in a row
+
+    Returns:
+        html : string
+            script and div of the maps
+
+    """
+    grid = grid_result(result, [field for field, _, _, _ in maps])
+    plots = [
+        raster_map(grid, field, title, palette, categories)
+        for field, title, palette, categories in maps
+    ]
+    script, div = components(gridplot(plots, ncols=columns))
+    return script + div
@@ -0,0 +1,156 @@
+""" Batched calls of the PolyTrend and DBEST R packages
+
+    Instead of converting and dispatching every pixel separately, a whole
+    chunk of pixel time series is passed to R as one matrix. The R packages
+    are applied to its rows inside R and the results come back as a single
+    numeric vector, which NumPy reads without copying. R is started on the
+    first call (see runtime.py), not when this module is imported.
+
+"""
+import numpy as np
+
+from .dbest_pool import DBEST_TRANSLATIONS
+from . import runtime
+
+# pixels passed to R in one call
+CHUNK_SIZE = 2000
+
+# PolyTrend returns list(Y, alpha, TrendType, Slope, Direction, Significance, PolynomialDegree)
+POLYTREND_FIELDS = ("trend_type", "slope", "direction", "significance", "degree")
+_POLYTREND_R = """
+function(m, alpha) {
+    first <- function(x) if (length(x)) as.numeric(x[[1]]) else NA_real_
+    as.numeric(vapply(seq_len(nrow(m)), function(i) {
+        r <- PolyTrend::PolyTrend(m[i, ], alpha)
+        vapply(r[3:7], first, numeric(1))
+    }, numeric(5)))
+}
+"""
+
+# first value of Start, Duration, End, Change, ChangeType and Significance,
+# the same fields that were read from each pixel's DBEST result
+# (NA for a pixel without breakpoints, kept as missing by ResultTable.fill)
+DBEST_FIELDS = ("start", "duration", "end", "change", "change_type", "significance")
+_DBEST_R = """
+function(m, ...) {
+    first <- function(x) if (length(x)) as.numeric(x[[1]]) else NA_real_
+    as.numeric(vapply(seq_len(nrow(m)), function(i) {
+        r <- DBEST::DBEST(data = m[i, ], ...)
+        vapply(r[3:8], first, numeric(1))
+    }, numeric(6)))
+}
+"""
+
+# R code of the batch functions, evaluated once per process by runtime.r_function
+_R_FUNCTIONS = {"PolyTrend": _POLYTREND_R, "DBEST": _DBEST_R}
+
+
+def _r_function(name):
+    return runtime.r_function(name, _R_FUNCTIONS[name])
+
+
+def prepare():
+    """ Evaluates the batch functions now instead of on their first call """
+    for name in _R_FUNCTIONS:
+        _r_function(name)
+
+
+def to_r_vector(y):
+    """ Converts the time series of one pixel into an R numeric vector """
+    runtime.ensure_r()
+    from rpy2.robjects.vectors import FloatVector
+
+    return FloatVector(np.asarray(y, dtype=np.float64))
+
+
+def to_r_matrix(Y):
+    """ Converts a pixels x time steps array into an R matrix with one conversion """
+    ro = runtime.ensure_r()
+    from rpy2.robjects.vectors import FloatVector
+
+    Y = np.asarray(Y, dtype=np.float64)
+    # R matrices are stored column by column
+    return ro.r.matrix(FloatVector(Y.ravel(order="F")), nrow=Y.shape[0])
+
+
+def to_numpy(vector, number_of_fields):
+    """ Reads a numeric R vector as a pixels x fields array without copying it """
+    return np.asarray(vector).reshape(-1, number_of_fields)
+
+
+def polytrend_batch(Y, alpha, chunk_size=CHUNK_SIZE, progress=None):
+    """ Runs the PolyTrend R package on every row of Y, one R call per chunk
+
+    Args:
+        Y: numpy array
+            pixels x years matrix of values, one time series per row
+        alpha : float
+            statistical significance of the fit
+        chunk_size : int
+            number of pixels passed to R in one call
+        progress : function, optional
+            called with the number of analysed pixels and the number of all pixels
+
+    Returns:
+        result : dict
+            numpy arrays of length pixels: trend_type, slope, direction,
+            significance and degree
+
+    """
+    polytrend = _r_function("PolyTrend")
+    chunks = []
+    for i in range(0, len(Y), chunk_size):
+        with runtime.r_lock:
+            vector = polytrend(to_r_matrix(Y[i : i + chunk_size]), alpha)
+            chunks.append(to_numpy(vector, len(POLYTREND_FIELDS)))
+        if progress is not None:
+            progress(min(i + chunk_size, len(Y)), len(Y))
+    values = _concatenate(chunks, len(POLYTREND_FIELDS))
+    result = {}
+    for column, field in enumerate(POLYTREND_FIELDS):
+        result[field] = values[:, column]
+        if field != "slope":
+            result[field] = result[field].astype(int)
+    return result
+
+
+def dbest_batch(Y, dbest_parameters, chunk_size=CHUNK_SIZE, progress=None):
+    """ Runs the DBEST R package on every row of Y, one R call per chunk
+
+    Args:
+        Y: numpy array
+            pixels x months matrix of values, one time series per row
+        dbest_parameters : dict
+            DBEST arguments with Python names, e.g. data_type, breakpoints_no
+        chunk_size : int
+            number of pixels passed to R in one call
+        progress : function, optional
+            called with the number of analysed pixels and the number of all pixels
+
+    Returns:
+        values : numpy array
+            pixels x 6 array with start, duration, end, change,
+            change type and significance of the largest change
+
+    """
+    r_names = {python: r for r, python in DBEST_TRANSLATIONS.items()}
+    r_parameters = {
+        r_names.get(name, name): value for name, value in dbest_parameters.items()
+    }
+    dbest = _r_function("DBEST")
+    chunks = []
+    for i in range(0, len(Y), chunk_size):
+        with runtime.r_lock:
+            vector = dbest(to_r_matrix(Y[i : i + chunk_size]), **r_parameters)
+            chunks.append(to_numpy(vector, len(DBEST_FIELDS)))
+        if progress is not None:
+            progress(min(i + chunk_size, len(Y)), len(Y))
+    return _concatenate(chunks, len(DBEST_FIELDS))
+
+
+def _concatenate(chunks, number_of_fields):
+    if not chunks:
+        return np.empty((0, number_of_fields))
+    if len(chunks) == 1:
+        return chunks[0]
+    return np.concatenate(chunks)
@@ -0,0 +1,260 @@
+""" Compact per-pixel results of polygon analyses
+
+    A ResultTable keeps one typed NumPy array per result field instead of
+    rows of Python objects: the position of each pixel on the grid of its
+    pixel cube as int32 row and column, the categories (trend type,
+    direction, change type, significance) as int8, the time steps of DBEST
+    as int16 and slopes and changes as float32. The table is allocated
+    once for all qualified pixels and filled chunk by chunk in place; the
+    chunks handed to progress callbacks are views on it.
+
+    A pixel can lack a value, e.g. DBEST reports no change for a stable
+    pixel (NaN from the R package). Float fields keep NaN, integer fields
+    the smallest value of their type (missing_value), which no result
+    takes. with_nan() gives a field as floats with NaN for those pixels;
+    the summaries, maps and exports read the fields through it.
+
+    The maps (raster.py, streaming.py), the summaries (summary.py) and the
+    exports (export.py) read the arrays directly. to_dataframe() builds a
+    table with longitude and latitude columns where one is needed, e.g. for
+    the patch maps; to_arrow() builds the columns of the Parquet files
+    from the arrays without a dataframe.
+
+"""
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from .grid import pixel_grid
+
+# fields of each algorithm and their types, in the order of the result files
+FIELD_TYPES = {
+    "polytrend": (
+        ("trend_type", np.int8),
+        ("slope", np.float32),
+        ("direction", np.int8),
+        ("significance", np.int8),
+    ),
+    "dbest": (
+        ("start", np.int16),
+        ("duration", np.int16),
+        ("end", np.int16),
+        ("change", np.float32),
+        ("change_type", np.int8),
+        ("significance", np.int8),
+    ),
+}
+
+
+def missing_value(dtype):
+    """ Value of a field of this type for a pixel without a value """
+    dtype = np.dtype(dtype)
+    if dtype.kind in "iu":
+        return np.iinfo(dtype).min
+    return np.nan
+
+
+def to_field(values, dtype):
+    """ Values cast to the type of a field, NaN becoming missing_value(dtype) """
+    values = np.asarray(values)
+    if np.dtype(dtype).kind in "iu" and values.dtype.kind == "f":
+        values = np.where(np.isnan(values), missing_value(dtype), values)
+    return values.astype(dtype)
+
+
+class ResultTable:
+    """ Results of the pixels of a polygon, one typed array per field
+
+    Attributes:
+        algorithm: string
+            'polytrend' or 'dbest'
+        rows, cols: numpy array
+            int32 position of each pixel on the grid, row 0 is the northernmost
+        origin: tuple
+            longitude of column 0 and latitude of row 0
+        resolution: tuple
+            distance between neighbouring columns and rows in degrees
+        fields: dict
+            array of each field of FIELD_TYPES[algorithm]
+        base: ResultTable
+            table whose arrays a view shares, None if the table owns them
+
+    """
+
+    def __init__(self, algorithm, rows, cols, origin, resolution, fields, base=None):
+        self.algorithm = algorithm
+        self.rows = rows
+        self.cols = cols
+        self.origin = origin
+        self.resolution = resolution
+        self.fields = fields
+        self.base = base
+
+    @classmethod
+    def allocate(cls, algorithm, cube, pixel_indices):
+        """ Table for some pixels of a cube, to be filled with fill()
+
+        Args:
+            algorithm: string
+                'polytrend' or 'dbest'
+            cube: PixelCube
+                cube of the analysed pixels, see pixelcube.py
+            pixel_indices: numpy array
+                positions of the analysed pixels in the cube
+
+        Returns:
+            ResultTable
+
+        """
+        size = len(pixel_indices)
+        return cls(
+            algorithm,
+            cube.rows[pixel_indices].astype(np.int32),
+            cube.cols[pixel_indices].astype(np.int32),
+            cube.origin,
+            cube.resolution,
+            {name: np.zeros(size, dtype=dtype) for name, dtype in FIELD_TYPES[algorithm]},
+        )
+
+    @classmethod
+    def empty(cls, algorithm):
+        """ Table without pixels """
+        return cls(
+            algorithm,
+            np.empty(0, dtype=np.int32),
+            np.empty(0, dtype=np.int32),
+            (0.0, 0.0),
+            (1.0, 1.0),
+            {name: np.empty(0, dtype=dtype) for name, dtype in FIELD_TYPES[algorithm]},
+        )
+
+    @classmethod
+    def from_dataframe(cls, algorithm, table, scale, latitude):
+        """ Table of the rows of to_dataframe(), e.g. read from the pixel store
+
+        The position of the pixels on the grid of the given scale and
+        latitude (see grid.py) is derived from their coordinates.
+
+        """
+        if len(table) == 0:
+            return cls.empty(algorithm)
+        origin, resolution, rows, cols = pixel_grid(
+            table["longitude"].values, table["latitude"].values, scale, latitude
+        )
+        return cls(
+            algorithm,
+            rows,
+            cols,
+            origin,
+            resolution,
+            {
+                name: to_field(table[name].values, dtype)
+                for name, dtype in FIELD_TYPES[algorithm]
+            },
+        )
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, field):
+        return self.fields[field]
+
+    @property
+    def field_names(self):
+        return [name for name, _ in FIELD_TYPES[self.algorithm]]
+
+    @property
+    def longitudes(self):
+        """ Longitude of the centre of each pixel """
+        return self.origin[0] + self.cols * self.resolution[0]
+
+    @property
+    def latitudes(self):
+        """ Latitude of the centre of each pixel """
+        return self.origin[1] - self.rows * self.resolution[1]
+
+    @property
+    def nbytes(self):
+        """ Memory taken by the arrays """
+        return (
+            self.rows.nbytes
+            + self.cols.nbytes
+            + sum(values.nbytes for values in self.fields.values())
+        )
+
+    def fill(self, start, values):
+        """ Writes the results of consecutive pixels, starting at position start
+
+        Args:
+            start: int
+                position of the first pixel of the chunk in the table
+            values: dict
+                array of every field for the pixels of the chunk; values
+                are cast to the type of the field, NaN to missing_value()
+
+        Returns:
+            number of pixels written : int
+
+        """
+        size = 0
+        for name, dtype in FIELD_TYPES[self.algorithm]:
+            column = to_field(values[name], dtype)
+            size = len(column)
+            self.fields[name][start : start + size] = column
+        return size
+
+    def missing(self, field):
+        """ True for the pixels without a value of the field """
+        values = self.fields[field]
+        if values.dtype.kind == "f":
+            return np.isnan(values)
+        return values == missing_value(values.dtype)
+
+    def with_nan(self, field):
+        """ The field as floats, NaN for the pixels without a value """
+        values = self.fields[field]
+        if values.dtype.kind == "f":
+            return values
+        return np.where(self.missing(field), np.nan, values)
+
+    def view(self, start, stop):
+        """ Pixels from start to stop, sharing the arrays of this table """
+        return ResultTable(
+            self.algorithm,
+            self.rows[start:stop],
+            self.cols[start:stop],
+            self.origin,
+            self.resolution,
+            {name: values[start:stop] for name, values in self.fields.items()},
+            base=self if self.base is None else self.base,
+        )
+
+    def to_arrow(self):
+        """ pyarrow Table with longitude, latitude and a column per field,
+            built from the arrays of this table without a dataframe
+        """
+        # pixels without a value are nulls
+        columns = [pa.array(self.longitudes), pa.array(self.latitudes)] + [
+            pa.array(self.fields[name], mask=self.missing(name))
+            for name in self.field_names
+        ]
+        return pa.Table.from_arrays(columns, ["longitude", "latitude"] + self.field_names)
+
+    def to_dataframe(self):
+        """ Dataframe with longitude, latitude and a column per field,
+            fields with pixels without a value as floats with NaN
+        """
+        table = pd.DataFrame(
+            {"longitude": self.longitudes, "latitude": self.latitudes}
+        )
+        for name in self.field_names:
+            if self.missing(name).any():
+                table[name] = self.with_nan(name)
+            else:
+                table[name] = self.fields[name]
+        return table
+
+
+def whole_table(chunk):
+    """ The table a chunk yielded by iter_polytrend_polygon/iter_dbest_polygon is a view on """
+    return chunk if chunk.base is None else chunk.base
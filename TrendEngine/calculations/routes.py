@@ -1,12 +1,24 @@
-from flask import Flask, render_template, url_for, request, flash, Blueprint
+from flask import (
+    Flask,
+    render_template,
+    url_for,
+    request,
+    flash,
+    Blueprint,
+    jsonify,
+    current_app,
+    Response,
+    stream_with_context,
+)
 import jinja2
 
-# for running R packages
-from rpy2.robjects.packages import importr
-
-# local imports
-from .dbest import do_dbest
-from .polytrend import do_polytrend
+# local imports, do_dbest and do_polytrend are loaded by runtime.get_algorithm
+from .cache import result_cache, time_series_cache
+from .grid import grid_latitude, grid_step
+from .catalog import DATASETS
+from .utils import parse_coordinates
+from .streaming import make_stream_map, stream_job
+from . import jobs, metrics, runtime
 
 ### import R's utility package
 ## only has to be done the first time the application is run
@@ -21,13 +33,205 @@ calculations = Blueprint("calculations", __name__)
 
 @calculations.route("/result", methods=["GET", "POST"])
 def get_result():
-    """ Get user's input and send to polytrend_func in polytrend.py"""
+    """ Get user's input and send to polytrend_func in polytrend.py
+
+        Polygons are analysed in a background job (see jobs.py) and the
+        user gets a page that follows its progress; points are analysed
+        within the request. The same form can be sent as a GET query, so
+        that browsers can revalidate cached results with their ETag.
+        With preview 'auto' or 'manual' a polygon is first analysed at a
+        coarse scale and refined at the native scale afterwards or when
+        the user asks for it.
+    """
 
     if request.method == "POST":
         parameters = request.form
+    else:
+        parameters = request.args
 
     if parameters["isDbest"] == "yes":
-        result = do_dbest(parameters)
+        algorithm = "dbest"
     elif parameters["isPolytrend"] == "yes":
-        result = do_polytrend(parameters)
+        algorithm = "polytrend"
+    function = runtime.get_algorithm(algorithm)
+
+    preview = parameters.get("preview", "no")
+    preview_factor = None
+    if preview in ("auto", "manual") and _is_polygon(parameters):
+        preview_factor = current_app.config.get("PREVIEW_SCALE_FACTOR", 4)
+
+    if current_app.config.get("ASYNC_POLYGON_JOBS") and _is_polygon(parameters):
+        job = jobs.submit(
+            current_app._get_current_object(),
+            algorithm,
+            function,
+            parameters.copy(),
+            _pixel_size(parameters),
+            preview_factor,
+            refine=preview != "manual",
+        )
+        return _render_job(job)
+    if preview_factor:
+        # without background jobs only the preview is analysed
+        parameters = jobs.with_scale_factor(parameters, preview_factor)
+    result = function(parameters)
     return result
+
+
+def _is_polygon(parameters):
+    try:
+        return len(parse_coordinates(parameters["coordinates"])) > 2
+    except (KeyError, ValueError):
+        # let do_polytrend/do_dbest report the error
+        return False
+
+
+def _pixel_size(parameters):
+    """ Width and height of a pixel of the chosen dataset and polygon in
+        degrees, for the streamed map
+    """
+    dataset = DATASETS.get(parameters.get("dataset_name"))
+    if dataset is None:
+        return None
+    coordinates = parse_coordinates(parameters["coordinates"])
+    return grid_step(dataset["scale"], grid_latitude(coordinates[1::2]))
+
+
+def _render_job(job):
+    script, div = make_stream_map(job.algorithm)
+    return render_template("job.html", job=job.to_dict(), script=script, div=div)
+
+
+@calculations.route("/jobs/<job_id>")
+def get_job_status(job_id):
+    """ Status of a background job as JSON """
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "unknown job"}), 404
+    return jsonify(job.to_dict())
+
+
+@calculations.route("/jobs/<job_id>/progress")
+def get_job_progress(job_id):
+    """ Number of analysed pixels of a background job """
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "unknown job"}), 404
+    percent = (
+        round(100.0 * job.pixels_done / job.pixels_total, 1) if job.pixels_total else 0.0
+    )
+    return jsonify(
+        {
+            "status": job.status,
+            "pixels_done": job.pixels_done,
+            "pixels_total": job.pixels_total,
+            "percent": percent,
+        }
+    )
+
+
+@calculations.route("/jobs/<job_id>/result")
+def get_job_result(job_id):
+    """ Results page of a finished background job """
+    job = jobs.get_job(job_id)
+    if job is None:
+        return render_template(
+            "error.html", error_message="The job does not exist or has expired."
+        )
+    if job.status == jobs.FAILED:
+        return render_template(
+            "error.html", error_message="The analysis failed: %s" % job.error
+        )
+    if job.status != jobs.FINISHED:
+        return _render_job(job), 202
+    return job.html
+
+
+@calculations.route("/jobs/<job_id>/preview")
+def get_job_preview(job_id):
+    """ Results page of the coarse analysis of a job, once it is done """
+    job = jobs.get_job(job_id)
+    if job is None or job.preview_html is None:
+        return (
+            render_template("error.html", error_message="There is no preview for this job."),
+            404,
+        )
+    return job.preview_html
+
+
+@calculations.route("/jobs/<job_id>/refine", methods=["POST"])
+def refine_job(job_id):
+    """ Analyses a previewed polygon again at the native scale, in a new job """
+    job = jobs.get_job(job_id)
+    if job is None or job.parameters is None:
+        return render_template(
+            "error.html", error_message="The job does not exist or has expired."
+        )
+    new_job = jobs.refine_job(
+        current_app._get_current_object(),
+        job,
+        runtime.get_algorithm(job.algorithm),
+    )
+    return _render_job(new_job)
+
+
+@calculations.route("/jobs/<job_id>/stream")
+def stream_job_results(job_id):
+    """ Results of a background job as Server-Sent Events, chunk by chunk """
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "unknown job"}), 404
+    response = Response(
+        stream_with_context(stream_job(job)), mimetype="text/event-stream"
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@calculations.route("/cache/stats")
+def get_cache_stats():
+    """ Hit and miss counters and size of the time series and result caches """
+    statistics = time_series_cache.stats()
+    statistics["results"] = result_cache.stats()
+    return jsonify(statistics)
+
+
+@calculations.route("/metrics")
+def get_metrics():
+    """ Timings of the analysis steps, pixel and cache counters and cache sizes for Prometheus """
+    time_series = time_series_cache.stats()
+    for tier in ("memory", "disk"):
+        metrics.CACHE_ENTRIES.labels(cache="time_series", tier=tier).set(
+            time_series[tier + "_entries"]
+        )
+        metrics.CACHE_BYTES.labels(cache="time_series", tier=tier).set(
+            time_series[tier + "_bytes"]
+        )
+    results = result_cache.stats()
+    metrics.CACHE_ENTRIES.labels(cache="result", tier="memory").set(results["entries"])
+    metrics.CACHE_BYTES.labels(cache="result", tier="memory").set(results["bytes"])
+    text, content_type = metrics.render()
+    return Response(text, content_type=content_type)
+
+
+@calculations.route("/health", methods=["GET", "POST"])
+def get_health():
+    """ What this process has initialized; a POST warms it up first
+
+        A POST initializes Earth Engine, starts R and imports the R
+        packages (see runtime.warm_up), so that a load balancer or a
+        deployment script can prepare a worker before it gets users.
+        Responds with 503 when the warm-up fails.
+    """
+    if request.method == "POST":
+        try:
+            timings = runtime.warm_up()
+        except Exception as error:
+            status = runtime.health()
+            status["error"] = str(error)
+            return jsonify(status), 503
+        status = runtime.health()
+        status["warm_up"] = timings
+        return jsonify(status)
+    return jsonify(runtime.health())
@@ -0,0 +1,179 @@
+""" Deferred initialization of Earth Engine, R and the heavy libraries
+
+    Importing TrendEngine neither connects to Earth Engine nor starts R,
+    and the modules that need geopandas, pandas_bokeh, bokeh or rpy2 are
+    imported by the routes when the first analysis is requested. Earth
+    Engine and R are initialized once per process by ensure_ee() and
+    ensure_r(), right before they are first needed.
+
+    R packages are imported once per process by r_package(), which hands
+    out the cached package with the Python names of its arguments, and R
+    functions evaluated from code are kept by r_function(). The embedded R
+    is not thread safe, so every call into it is made holding r_lock.
+
+    Servers that fork their workers from a preloaded application can call
+    warm_up() (or set TRENDENGINE_WARM_UP=1) so that this work is done once
+    in the parent process instead of in the first request of every worker.
+
+"""
+import importlib
+import os
+import threading
+import time
+
+from .dbest_pool import DBEST_TRANSLATIONS
+
+# warm up when the package is imported, e.g. by gunicorn --preload
+WARM_UP = os.environ.get("TRENDENGINE_WARM_UP", "0") == "1"
+
+# modules of the analyses, imported on their first use
+ALGORITHMS = {
+    "polytrend": ("TrendEngine.calculations.polytrend", "do_polytrend"),
+    "dbest": ("TrendEngine.calculations.dbest", "do_dbest"),
+}
+
+# R packages used by the analyses and their arguments renamed for Python
+R_PACKAGES = {"PolyTrend": {}, "DBEST": DBEST_TRANSLATIONS}
+
+_lock = threading.Lock()
+_ee_ready = False
+_ro = None
+# held during every call into R
+r_lock = threading.RLock()
+_packages = {}
+_functions = {}
+
+
+def ensure_ee():
+    """ Initializes the Earth Engine API once per process
+
+    Raises whatever ee.Initialize() raises, e.g. when the credentials are
+    missing or Earth Engine cannot be reached, so that the next request
+    tries again.
+
+    """
+    global _ee_ready
+    if _ee_ready:
+        return
+    with _lock:
+        if not _ee_ready:
+            from .earthengine import ee
+
+            ee.Initialize()
+            _ee_ready = True
+
+
+def ensure_r():
+    """ Starts the embedded R once per process
+
+    Returns:
+        rpy2.robjects module
+
+    """
+    global _ro
+    if _ro is None:
+        with _lock:
+            if _ro is None:
+                import rpy2.robjects as ro
+
+                _ro = ro
+    return _ro
+
+
+def r_package(name):
+    """ An R package from R_PACKAGES, imported once per process
+
+    Returns:
+        rpy2 package whose functions are called with Python argument names,
+        e.g. r_package('DBEST').DBEST(data=..., data_type=...)
+
+    """
+    if name not in _packages:
+        ensure_r()
+        from rpy2.robjects.packages import importr
+
+        with r_lock:
+            if name not in _packages:
+                _packages[name] = importr(name, robject_translations=R_PACKAGES[name])
+    return _packages[name]
+
+
+def r_function(name, code):
+    """ An R function evaluated from code once per process, see rbridge.py """
+    if name not in _functions:
+        ro = ensure_r()
+        with r_lock:
+            if name not in _functions:
+                _functions[name] = ro.r(code)
+    return _functions[name]
+
+
+def warm_up_r():
+    """ Starts R, imports the R packages and evaluates the batch functions """
+    from . import rbridge
+
+    for name in R_PACKAGES:
+        r_package(name)
+    rbridge.prepare()
+
+
+def health():
+    """ What has been initialized in this process, without initializing anything
+
+    Returns:
+        status : dict
+            earth_engine and r are True once initialized, packages lists
+            the imported R packages and functions the evaluated R functions
+
+    """
+    return {
+        "earth_engine": _ee_ready,
+        "r": _ro is not None,
+        "packages": sorted(_packages),
+        "functions": sorted(_functions),
+    }
+
+
+def get_algorithm(algorithm):
+    """ do_polytrend or do_dbest, importing its module on the first call
+
+    Args:
+        algorithm: string
+            'polytrend' or 'dbest'
+
+    Returns:
+        function
+            called with the form parameters, see routes.py
+
+    """
+    module_name, function_name = ALGORITHMS[algorithm]
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def warm_up(earth_engine=True, r=True):
+    """ Does the deferred work now, e.g. before a server forks its workers
+
+    Args:
+        earth_engine: bool
+            initialize Earth Engine
+        r: bool
+            start R and import the R packages; not to be used when R must
+            not be shared with forked processes
+
+    Returns:
+        timings : dict
+            seconds taken by each step
+
+    """
+    timings = {}
+    steps = [("modules", lambda: [get_algorithm(name) for name in ALGORITHMS])]
+    if earth_engine:
+        steps.append(("earth_engine", ensure_ee))
+    if r:
+        steps.append(("r", warm_up_r))
+    for name, step in steps:
+        start = time.perf_counter()
+        step()
+        timings[name] = time.perf_counter() - start
+    print("warm-up done ", timings)
+    return timings
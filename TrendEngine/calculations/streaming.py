@@ -0,0 +1,126 @@
+""" Progressive results of background jobs over Server-Sent Events
+
+    While a polygon is analysed (see jobs.py) every finished chunk of pixels
+    is turned into a small JSON payload. The job page opens an EventSource
+    on /jobs/<job_id>/stream, receives the payloads as they come and adds
+    the pixels to a Bokeh map with ColumnDataSource.stream, so the map
+    fills in long before the whole analysis is done.
+
+"""
+import json
+import time
+
+# seconds between two looks at the job
+STREAM_INTERVAL = 0.5
+
+# field that colours the map and its colours, as in the maps of the results pages
+MAP_COLORS = {
+    "polytrend": (
+        "trend_type",
+        {-1: "grey", 0: "yellow", 1: "green", 2: "blue", 3: "red"},
+    ),
+    "dbest": ("change_type", {0: "grey", 1: "yellow"}),
+}
+
+STREAM_COLUMNS = ("longitude", "latitude", "width", "height", "color")
+
+
+def chunk_payload(algorithm, chunk, pixel_size):
+    """ Columns of the streamed map for one chunk of results
+
+    Args:
+        algorithm: string
+            'polytrend' or 'dbest'
+        chunk: ResultTable
+            results of call_polytrend_polygon/call_dbest_polygon for some pixels
+        pixel_size: tuple
+            width and height of a pixel in degrees
+
+    Returns:
+        payload : dict
+            lists of longitude, latitude, width, height and color
+
+    """
+    field, colors = MAP_COLORS[algorithm]
+    return {
+        "longitude": chunk.longitudes.tolist(),
+        "latitude": chunk.latitudes.tolist(),
+        "width": [pixel_size[0]] * len(chunk),
+        "height": [pixel_size[1]] * len(chunk),
+        "color": [colors.get(int(value), "white") for value in chunk[field]],
+    }
+
+
+def make_stream_map(algorithm):
+    """ Empty map that the job page fills with streamed pixels
+
+    Returns:
+        script, div : string
+            Bokeh components for the job page
+
+    """
+    # imported here, so that importing the routes does not load bokeh
+    from bokeh.embed import components
+    from bokeh.models import ColumnDataSource
+    from bokeh.plotting import figure
+
+    field, _ = MAP_COLORS[algorithm]
+    source = ColumnDataSource(
+        data={column: [] for column in STREAM_COLUMNS}, name="stream_source"
+    )
+    stream_map = figure(
+        title="Map of %s (analysed pixels)" % field.replace("_", " "),
+        match_aspect=True,
+        sizing_mode="scale_width",
+        plot_height=400,
+        tools="pan,wheel_zoom,reset",
+    )
+    stream_map.rect(
+        x="longitude",
+        y="latitude",
+        width="width",
+        height="height",
+        fill_color="color",
+        line_color=None,
+        source=source,
+    )
+    return components(stream_map)
+
+
+def format_event(event, data):
+    """ One Server-Sent Event """
+    return "event: %s\ndata: %s\n\n" % (event, json.dumps(data))
+
+
+def stream_job(job, interval=STREAM_INTERVAL):
+    """ Events of a job until it is finished
+
+    Sends every chunk of results once, followed by the progress and the
+    running statistics, and ends with a 'done' or 'failed' event.
+
+    """
+    sent = 0
+    while True:
+        status = job.status
+        chunks = job.chunks[sent:]
+        for payload in chunks:
+            yield format_event("chunk", payload)
+        sent += len(chunks)
+        if chunks or status not in ("finished", "failed"):
+            yield format_event(
+                "progress",
+                {
+                    "status": status,
+                    "pixels_done": job.pixels_done,
+                    "pixels_total": job.pixels_total,
+                    "statistics": job.statistics.to_dict(),
+                    "stage": job.stage,
+                    "preview": job.preview_html is not None,
+                },
+            )
+        if status in ("finished", "failed") and sent == len(job.chunks):
+            yield format_event(
+                "done" if status == "finished" else "failed", job.to_dict()
+            )
+            return
+        time.sleep(interval)
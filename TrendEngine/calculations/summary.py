@@ -0,0 +1,206 @@
+""" Summary statistics of polygon results, updated chunk by chunk
+
+    A summary keeps counts of categories and fixed-size histograms, so it
+    takes the same memory for ten pixels as for ten million and can be
+    updated with each chunk of results as it is finished (see jobs.py) or
+    with a whole result table at once. Its dictionary feeds the pie charts
+    and the results templates.
+
+"""
+import numpy as np
+
+# number of bins of every histogram
+HISTOGRAM_BINS = 32
+
+
+class Histogram:
+    """ Histogram with a fixed number of bins whose range grows with the data
+
+    The range is taken from the first values. When later values fall
+    outside of it, the range is doubled and neighbouring bins are merged,
+    so counts are never lost and the number of bins stays the same.
+
+    """
+
+    def __init__(self, bins=HISTOGRAM_BINS):
+        self.bins = bins
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.lower = None
+        self.width = None
+        self.count = 0
+        self.total = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    @property
+    def upper(self):
+        return self.lower + self.width * self.bins
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if not len(values):
+            return
+        low, high = values.min(), values.max()
+        if self.lower is None:
+            self.lower = low
+            self.width = max((high - low) / self.bins, 1e-12)
+        # the upper edge belongs to the last bin
+        while low < self.lower or high > self.upper:
+            self._double(extend_down=low < self.lower)
+        indices = np.floor((values - self.lower) / self.width).astype(np.int64)
+        indices = np.clip(indices, 0, self.bins - 1)
+        self.counts += np.bincount(indices, minlength=self.bins)
+        self.count += len(values)
+        self.total += values.sum()
+        self.minimum = min(self.minimum, low)
+        self.maximum = max(self.maximum, high)
+
+    def _double(self, extend_down):
+        merged = self.counts.reshape(-1, 2).sum(axis=1)
+        counts = np.zeros(self.bins, dtype=np.int64)
+        if extend_down:
+            counts[self.bins // 2 :] = merged
+            self.lower -= self.width * self.bins
+        else:
+            counts[: self.bins // 2] = merged
+        self.counts = counts
+        self.width *= 2
+
+    def to_dict(self):
+        if self.lower is None:
+            return {"edges": [], "counts": [], "count": 0}
+        edges = self.lower + self.width * np.arange(self.bins + 1)
+        return {
+            "edges": edges.tolist(),
+            "counts": self.counts.tolist(),
+            "count": self.count,
+            "mean": self.total / self.count,
+            "min": float(self.minimum),
+            "max": float(self.maximum),
+        }
+
+
+class CategoryCounts:
+    """ Number of pixels per value of a field with known values """
+
+    def __init__(self, values):
+        self.values = list(values)
+        self.counts = np.zeros(len(self.values), dtype=np.int64)
+
+    def update(self, values):
+        values = np.asarray(values)
+        for i, value in enumerate(self.values):
+            self.counts[i] += np.count_nonzero(values == value)
+
+    def to_dict(self):
+        return {str(value): int(count) for value, count in zip(self.values, self.counts)}
+
+
+class Summary:
+    """ Counts and histograms of the fields of a result table """
+
+    # counted fields, {field: {value: name}}
+    categories = {}
+    # fields summarized by histograms
+    histograms = ()
+
+    def __init__(self):
+        self.pixels = 0
+        self._categories = {
+            field: CategoryCounts(names) for field, names in self.categories.items()
+        }
+        self._histograms = {field: Histogram() for field in self.histograms}
+
+    def update(self, chunk):
+        """ Adds the rows of a result table or of a chunk of it """
+        self.pixels += len(chunk)
+        for field, counts in self._categories.items():
+            counts.update(chunk[field])
+        for field, histogram in self._histograms.items():
+            # pixels without a value are not counted
+            histogram.update(chunk.with_nan(field))
+        return self
+
+    def to_dict(self):
+        """ count_<name> and proc_<name> of every category, counts and histograms """
+        result = {"count_total": self.pixels}
+        for field, names in self.categories.items():
+            for value, count in zip(names, self._categories[field].counts):
+                result["count_" + names[value]] = int(count)
+                result["proc_" + names[value]] = (
+                    round(count / self.pixels * 100, 1) if self.pixels else 0.0
+                )
+        result["counts"] = {
+            field: counts.to_dict() for field, counts in self._categories.items()
+        }
+        result["histograms"] = {
+            field: histogram.to_dict() for field, histogram in self._histograms.items()
+        }
+        return result
+
+
+class PolyTrendSummary(Summary):
+    categories = {
+        "trend_type": {
+            -1: "concealed",
+            0: "no_trend",
+            1: "linear",
+            2: "quadratic",
+            3: "cubic",
+        },
+        "direction": {-1: "negative", 1: "positive"},
+    }
+    histograms = ("slope",)
+
+
+class DbestSummary(Summary):
+    categories = {
+        "change_type": {0: "non_abrupt", 1: "abrupt"},
+        "significance": {0: "not_significant", 1: "significant"},
+    }
+    histograms = ("start", "duration", "change")
+
+    def to_dict(self):
+        """ Also count_no_change and proc_no_change, pixels without any change """
+        result = super().to_dict()
+        changed = sum(self._categories["change_type"].counts)
+        result["count_no_change"] = int(self.pixels - changed)
+        result["proc_no_change"] = (
+            round((self.pixels - changed) / self.pixels * 100, 1) if self.pixels else 0.0
+        )
+        return result
+
+
+SUMMARIES = {"polytrend": PolyTrendSummary, "dbest": DbestSummary}
+
+
+def make_summary(algorithm):
+    """ Empty summary for the results of 'polytrend' or 'dbest' """
+    return SUMMARIES[algorithm]()
+
+
+def histogram_figure(histogram, title):
+    """ Bokeh bar chart of a histogram from Summary.to_dict() """
+    # imported here, summaries are also kept by jobs that draw nothing
+    from bokeh.plotting import figure
+
+    plot = figure(
+        plot_height=350,
+        title=title,
+        toolbar_location=None,
+        tools="hover",
+        tooltips="@left{0.000} to @right{0.000}: @top",
+        sizing_mode="scale_both",
+    )
+    edges = histogram["edges"]
+    plot.quad(
+        top=histogram["counts"],
+        bottom=0,
+        left=edges[:-1],
+        right=edges[1:],
+        fill_color="forestgreen",
+        line_color="white",
+    )
+    plot.y_range.start = 0
+    return plot
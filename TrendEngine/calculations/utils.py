@@ -1,64 +1,89 @@
 from flask import render_template
 import jinja2
-import ee
 import pandas as pd
+import re
 
-def get_dataset_for_polygon(is_polytrend, collection, AOI, scale, crs):
-    crs = collection.first().getInfo()['bands'][0]['crs']
-    print('crs', crs)
-    geom_values = collection.getRegion(geometry=AOI, scale=scale, crs=crs)
-    geom_values_list = ee.List(geom_values).getInfo()
+from .cache import time_series_cache
+from .summary import PolyTrendSummary
+from . import metrics
+from .fetch import fetch_region, fetch_region_tiled
+from .ingest import region_to_dataframe
 
-    # Convert to a Pandas DataFrame.
-    header = geom_values_list[0]
-    data = pd.DataFrame(geom_values_list[1:], columns=header)
-    if (is_polytrend): 
-        data['datetime'] = pd.to_datetime(data['time'], unit='ms').dt.date
-        data.set_index('datetime')
-    else:
-        data['time'] = [pd.to_datetime(item['value'], unit='ms') for item in data['time']]
-        data.set_index('time')
-    data.groupby(['longitude', 'latitude'])
-    return data
+def parse_coordinates(coordinates):
+    """ Turns coordinates posted from home.html, e.g. '[[[13, 54], [15, 53], [13, 53]]]',
+        into a flat list of floats: longitude, latitude, longitude, latitude...
+    """
+    regex = re.sub("[\[\]]", "", coordinates)
+    split = regex.split(",")
+    return list(map(float, split))
+
+def get_dataset_for_polygon(
+    is_polytrend,
+    collection,
+    AOI,
+    scale,
+    crs,
+    latitude,
+    cache_key=None,
+    number_of_images=None,
+    number_of_bands=None,
+):
+    """ Gets time series of every pixel in the AOI as a dataframe
+
+    latitude is that of the grid the pixels are sampled on with crs
+    GRID_CRS, see grid.py. With a cache_key, see cache.make_cache_key, a
+    dataset fetched before for the same key is returned without asking
+    Earth Engine. number_of_images and number_of_bands describe the
+    collection for planning the tiles; when not given they are asked from
+    Earth Engine.
+
+    """
+    if cache_key is not None:
+        data = time_series_cache.get(cache_key)
+        if data is not None:
+            return data
+    algorithm = "polytrend" if is_polytrend else "dbest"
+    # large AOIs are fetched in tiles, see fetch.py
+    with metrics.stage(algorithm, "download"):
+        geom_values_list = fetch_region_tiled(
+            collection, AOI, scale, crs, latitude, number_of_images, number_of_bands
+        )
 
-def get_dataset_for_point(is_polytrend, collection, AOI, scale, crs):
-    geom_values = collection.getRegion(geometry=AOI, scale=scale, crs=crs)
-    geom_values_list = ee.List(geom_values).getInfo()
-    header = geom_values_list[0]
-    data = pd.DataFrame(geom_values_list[1:], columns=header)
-    if (is_polytrend): 
-        data['datetime'] = pd.to_datetime(data['time'], unit='ms', utc=True).dt.date
-    else:
-        data['time'] = [pd.to_datetime(item['value'], unit='ms') for item in data['time']]
-    data.set_index('time')
-    data.groupby(['longitude', 'latitude'])
+    # Convert to a Pandas DataFrame with typed columns, see ingest.py
+    with metrics.stage(algorithm, "to_dataframe"):
+        data = region_to_dataframe(geom_values_list)
+        if (is_polytrend): 
+            data['datetime'] = pd.to_datetime(data['time'], unit='ms').dt.normalize()
+    _count_fetched(algorithm, data)
+    if cache_key is not None:
+        time_series_cache.put(cache_key, data)
     return data
 
-def get_PT_statistics(result):
-    result_to_display = {}
-    linear = result.loc[result['trend_type'] == 1]
-    no_trend = result.loc[result['trend_type'] == 0]
-    concealed = result.loc[result['trend_type'] == -1]
-    quadratic = result.loc[result['trend_type'] == 2]
-    cubic = result.loc[result['trend_type'] == 3]
-    negative = result.loc[result['direction'] == -1]
-    positive = result.loc[result['direction'] == 1]
+def get_dataset_for_point(
+    is_polytrend, collection, AOI, scale, crs, latitude, cache_key=None
+):
+    """ Gets the time series of a single point as a dataframe, see get_dataset_for_polygon """
+    if cache_key is not None:
+        data = time_series_cache.get(cache_key)
+        if data is not None:
+            return data
+    algorithm = "polytrend" if is_polytrend else "dbest"
+    with metrics.stage(algorithm, "download"):
+        geom_values_list = fetch_region(collection, AOI, scale, crs, latitude)
+    with metrics.stage(algorithm, "to_dataframe"):
+        data = region_to_dataframe(geom_values_list)
+        if (is_polytrend): 
+            data['datetime'] = pd.to_datetime(data['time'], unit='ms').dt.normalize()
+    _count_fetched(algorithm, data)
+    if cache_key is not None:
+        time_series_cache.put(cache_key, data)
+    return data
 
-    result_to_display['count_total'] = len(result)
-    result_to_display['count_linear'] = len(linear)
-    result_to_display['count_no_trend'] = len(no_trend)
-    result_to_display['count_concealed'] = len(concealed)
-    result_to_display['count_quadratic'] = len(quadratic)
-    result_to_display['count_cubic'] = len(cubic)
-    result_to_display['count_negative'] = len(negative)
-    result_to_display['count_positive'] = len(positive)
+def _count_fetched(algorithm, data):
+    """ Adds a fetched time series table to the metrics, see metrics.py """
+    metrics.FETCHED_ROWS.labels(algorithm=algorithm).inc(len(data))
+    metrics.FETCHED_BYTES.labels(algorithm=algorithm).inc(int(data.memory_usage().sum()))
 
-    count_total = result_to_display['count_total']
-    result_to_display['proc_linear'] = round((result_to_display['count_linear']/count_total) * 100, 1)
-    result_to_display['proc_no_trend'] = round((result_to_display['count_no_trend']/count_total) * 100, 1)
-    result_to_display['proc_concealed'] = round((result_to_display['count_concealed']/count_total) * 100, 1)
-    result_to_display['proc_quadratic'] = round((result_to_display['count_quadratic']/count_total) * 100, 1)
-    result_to_display['proc_cubic'] = round((result_to_display['count_cubic']/count_total) * 100, 1)
-    result_to_display['proc_negative'] = round((result_to_display['count_negative']/count_total) * 100, 1)
-    result_to_display['proc_positive'] = round((result_to_display['count_positive']/count_total) * 100, 1)
-    return result_to_display
+def get_PT_statistics(result):
+    """ Counts and percentages of trend types and directions, see summary.py """
+    return PolyTrendSummary().update(result).to_dict()
@@ -21,6 +21,8 @@ class DbestParametersForm(FlaskForm):
 	distance = StringField('Distance threshold', default='default')
 	duration = IntegerField('Duration', default=24)
 	alpha = DecimalField('Alpha', rounding=None, places=2, default=0.05)
+	dbest_engine = SelectField('Engine', choices=[('r', 'R package'), ('numpy', 'in-process (fast)'),
+		('parity', 'in-process, checked against R package')], default='r')
 
 	save_ts_to_csv = SelectField('Save time series to file (time_series.csv)', choices=[(False, 'No'), (True, 'Yes')], default=False)
 	save_result_to_csv = SelectField('Save result to file (DBEST_result.csv)', choices=[(False, 'No'), (True, 'Yes')], default=False)
@@ -38,6 +40,8 @@ class PolyTrendParametersForm(FlaskForm):
 	coordinates = DecimalField('Coordinates', validators=[DataRequired()])
 	#PolyTrend parameters
 	alpha = DecimalField('Alpha', rounding=None, places=2, default=0.05)
+	engine = SelectField('Engine', choices=[('r', 'R package'), ('numpy', 'in-process (fast)'),
+		('parity', 'in-process, checked against R package')], default='r')
 
 	save_ts_to_csv = SelectField('Save time series to file (time_series.csv)', choices=[(False, 'No'), (True, 'Yes')], default=False)
 	save_result_to_csv = SelectField('Save result to file PolyTrend_result.csv', choices=[(False, 'No'), (True, 'Yes')], default=False)
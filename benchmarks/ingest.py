@@ -0,0 +1,104 @@
+""" Cost of turning getRegion responses into dataframes
+
+    Fetches a polygon from the offline Earth Engine stand-in once and times
+    ingest.region_to_dataframe() against the conversion it replaced: an
+    object dataframe whose Earth Engine dates were converted one by one.
+
+    Usage, from the root of the repository:
+        python -m benchmarks.ingest --algorithm dbest --pixels 100 --years 10
+
+"""
+import argparse
+import os
+import time
+
+# must be set before TrendEngine imports the Earth Engine backend
+os.environ.setdefault("TRENDENGINE_EE_BACKEND", "offline")
+
+import pandas as pd  # noqa: E402
+
+from TrendEngine.calculations.catalog import DATASETS, get_dataset  # noqa: E402
+from TrendEngine.calculations.earthengine import ee  # noqa: E402
+from TrendEngine.calculations.fetch import fetch_region  # noqa: E402
+from TrendEngine.calculations.grid import (  # noqa: E402
+    GRID_CRS,
+    METERS_PER_DEGREE,
+    grid_latitude,
+    grid_step,
+)
+from TrendEngine.calculations.ingest import region_to_dataframe  # noqa: E402
+
+
+def previous_conversion(geom_values_list):
+    """ The dataframe as it was built before ingest.py """
+    data = pd.DataFrame(geom_values_list[1:], columns=geom_values_list[0])
+    if isinstance(data["time"].iloc[0], dict):
+        data["time"] = [pd.to_datetime(item["value"], unit="ms") for item in data["time"]]
+    else:
+        data["datetime"] = pd.to_datetime(data["time"], unit="ms").dt.date
+    return data
+
+
+def fetch_response(args):
+    """ getRegion response of a square AOI """
+    from TrendEngine.calculations.dbest import make_monthly_composite
+    from TrendEngine.calculations.polytrend import make_annual_composite
+
+    dataset = get_dataset(args.dataset, args.algorithm)
+    west, south = args.longitude, args.latitude
+    north = south + args.pixels * dataset["scale"] / METERS_PER_DEGREE
+    latitude = grid_latitude([south, north])
+    east = west + args.pixels * grid_step(dataset["scale"], latitude)[0]
+    aoi = ee.Geometry.Polygon([west, south, east, south, east, north, west, north])
+    end_year = args.from_year + args.years - 1
+    collection = ee.ImageCollection(dataset["collection_id"]).filterDate(
+        "%d-01-01" % args.from_year, "%d-12-31" % end_year
+    )
+    if args.algorithm == "dbest":
+        composite = make_monthly_composite(collection, args.from_year, end_year)
+    else:
+        composite = make_annual_composite(collection, args.from_year, end_year)
+    return fetch_region(composite, aoi, dataset["scale"], GRID_CRS, latitude)
+
+
+def best_time(function, response, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = function(response)
+        times.append(time.perf_counter() - start)
+    return min(times), data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--algorithm", choices=["polytrend", "dbest"], default="dbest")
+    parser.add_argument("--dataset", choices=sorted(DATASETS), default="MODIS/006/MOD13Q1_NDVI")
+    parser.add_argument("--pixels", type=int, default=100, help="pixels per side of the AOI")
+    parser.add_argument("--years", type=int, default=10)
+    parser.add_argument("--from-year", type=int, default=2001)
+    parser.add_argument("--longitude", type=float, default=13.0)
+    parser.add_argument("--latitude", type=float, default=53.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    response = fetch_response(args)
+    print("%d rows of %d columns" % (len(response) - 1, len(response[0])))
+    for name, function in (
+        ("previous", previous_conversion),
+        ("region_to_dataframe", region_to_dataframe),
+    ):
+        seconds, data = best_time(function, response, args.repeat)
+        print(
+            "%s: best %.3f s, %.1f MB, types %s"
+            % (
+                name,
+                seconds,
+                data.memory_usage(deep=True).sum() / 2 ** 20,
+                ", ".join("%s=%s" % (column, data[column].dtype) for column in data),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+""" End to end benchmark of the PolyTrend and DBEST pipelines
+
+    Runs do_polytrend or do_dbest on the offline Earth Engine stand-in
+    (see TrendEngine/calculations/offline_ee.py), so no account or network
+    is needed. The AOI is a square of the given number of pixels per side.
+
+    Usage, from the root of the repository:
+        python -m benchmarks.pipeline --algorithm polytrend --pixels 100 --years 15 --engine numpy
+        python -m benchmarks.pipeline --algorithm dbest --dbest-engine numpy
+
+    A run that renders the error page stops the benchmark with its message.
+
+"""
+import argparse
+import os
+import tempfile
+import time
+
+# must be set before TrendEngine imports the Earth Engine backend
+os.environ.setdefault("TRENDENGINE_EE_BACKEND", "offline")
+os.environ.setdefault("TRENDENGINE_CACHE_DIR", tempfile.mkdtemp(prefix="trendengine-bench-"))
+
+from flask import template_rendered  # noqa: E402
+from werkzeug.datastructures import ImmutableMultiDict  # noqa: E402
+
+from TrendEngine import app  # noqa: E402
+from TrendEngine.calculations.cache import time_series_cache  # noqa: E402
+from TrendEngine.calculations.catalog import DATASETS  # noqa: E402
+from TrendEngine.calculations.compositing import COMPOSITING, DEFAULT_COMPOSITING  # noqa: E402
+from TrendEngine.calculations.dbest import do_dbest  # noqa: E402
+from TrendEngine.calculations.grid import METERS_PER_DEGREE, grid_latitude, grid_step  # noqa: E402
+from TrendEngine.calculations import dbest_engine, polytrend_engine  # noqa: E402
+from TrendEngine.calculations.polytrend import do_polytrend  # noqa: E402
+from TrendEngine.calculations.cache import result_cache  # noqa: E402
+
+
+def make_parameters(args):
+    """ Form fields as they are posted from home.html """
+    scale = DATASETS[args.dataset]["scale"]
+    west, south = args.longitude, args.latitude
+    north = south + args.pixels * scale / METERS_PER_DEGREE
+    east = west + args.pixels * grid_step(scale, grid_latitude([south, north]))[0]
+    if args.pixels == 1:
+        coordinates = "[%f,%f]" % (west, south)
+    else:
+        coordinates = "[[[%f,%f],[%f,%f],[%f,%f],[%f,%f]]]" % (
+            west, south, east, south, east, north, west, north
+        )
+    is_dbest = args.algorithm == "dbest"
+    return ImmutableMultiDict(
+        [
+            ("dataset_name", args.dataset),
+            ("from_year", str(args.from_year)),
+            ("to_year", str(args.from_year + args.years - 1)),
+            ("coordinates", coordinates),
+            ("save_ts_to_csv", "no"),
+            ("save_result_to_csv", "no"),
+            ("isDbest", "yes" if is_dbest else "no"),
+            ("isPolytrend", "no" if is_dbest else "yes"),
+            ("alpha", str(args.alpha)),
+            ("engine", args.engine),
+            ("dbest_engine", args.dbest_engine),
+            ("data_type", "cyclical"),
+            ("algorithm", "changedetection"),
+            ("breakpoint_no", "3"),
+            ("seasonality", "12"),
+            ("first_level_shift", "0.1"),
+            ("second_level_shift", "0.2"),
+            ("distance", "default"),
+            ("duration", "24"),
+            ("compositing", args.compositing),
+        ]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--algorithm", choices=["polytrend", "dbest"], default="polytrend")
+    parser.add_argument("--dataset", choices=sorted(DATASETS), default="MODIS/006/MOD13Q1_NDVI")
+    parser.add_argument("--pixels", type=int, default=50, help="pixels per side of the AOI")
+    parser.add_argument("--years", type=int, default=10)
+    parser.add_argument("--from-year", type=int, default=2001)
+    parser.add_argument("--longitude", type=float, default=13.0)
+    parser.add_argument("--latitude", type=float, default=53.0)
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument(
+        "--engine",
+        choices=polytrend_engine.ENGINES,
+        default=polytrend_engine.DEFAULT_ENGINE,
+        help="PolyTrend engine",
+    )
+    parser.add_argument(
+        "--dbest-engine",
+        choices=dbest_engine.ENGINES,
+        default=dbest_engine.DEFAULT_ENGINE,
+        help="DBEST engine, 'r' needs R and the DBEST package",
+    )
+    parser.add_argument(
+        "--compositing",
+        choices=sorted(COMPOSITING),
+        default=DEFAULT_COMPOSITING,
+        help="make the composites in Earth Engine or locally from raw observations",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--keep-cache",
+        action="store_true",
+        help="let repeated runs use the time series and result caches and the pixel store",
+    )
+    args = parser.parse_args()
+
+    parameters = make_parameters(args)
+    run = do_dbest if args.algorithm == "dbest" else do_polytrend
+    timings = []
+    # stored pixel results would spare repeated runs the whole analysis
+    app.config["PIXEL_STORE"] = args.keep_cache
+    errors = []
+
+    def record_error(sender, template, context, **extra):
+        if template.name == "error.html":
+            errors.append(context.get("error_message"))
+
+    template_rendered.connect(record_error, app)
+    with app.test_request_context("/result", method="POST"):
+        for _ in range(args.repeat):
+            if not args.keep_cache:
+                time_series_cache.clear()
+                result_cache.clear()
+            start = time.perf_counter()
+            page = run(parameters)
+            if not isinstance(page, str):
+                page = page.get_data(as_text=True)
+            timings.append(time.perf_counter() - start)
+            if errors:
+                raise SystemExit("%s failed: %s" % (args.algorithm, errors[-1]))
+            print("run: %.3f s, %d bytes of HTML" % (timings[-1], len(page)))
+    print(
+        "%s, %d x %d pixels, %d years: best %.3f s, mean %.3f s"
+        % (
+            args.algorithm,
+            args.pixels,
+            args.pixels,
+            args.years,
+            min(timings),
+            sum(timings) / len(timings),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+""" Startup time of the application
+
+    Imports TrendEngine in fresh Python processes, as a server worker does
+    when it starts, and reports how long the import took and which of the
+    heavy libraries it loaded. With --warm-up the deferred work of
+    runtime.warm_up() is timed as well, which is what the first request
+    (or a preloading server) pays instead.
+
+    Usage, from the root of the repository:
+        python -m benchmarks.startup --repeat 5
+        python -m benchmarks.startup --repeat 5 --warm-up
+
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ("geopandas", "pandas_bokeh", "shapely", "bokeh", "rpy2")
+
+# runs in a fresh interpreter and prints its measurements as JSON
+_CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import TrendEngine
+imported = time.perf_counter() - start
+result = {
+    "import": imported,
+    "loaded": [name for name in %r if name in sys.modules],
+}
+if %r:
+    from TrendEngine.calculations import runtime
+    result["warm_up"] = runtime.warm_up(r=%r)
+print(json.dumps(result))
+"""
+
+
+def measure(warm_up, r):
+    """ Import time (and warm-up timings) of one fresh process """
+    environment = dict(os.environ)
+    environment.setdefault("TRENDENGINE_EE_BACKEND", "offline")
+    # the warm-up is timed separately, never as part of the import
+    environment["TRENDENGINE_WARM_UP"] = "0"
+    output = subprocess.run(
+        [sys.executable, "-c", _CHILD % (HEAVY_MODULES, warm_up, r)],
+        env=environment,
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+    # the last line, the warm-up prints its own summary before
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warm-up", action="store_true", help="time runtime.warm_up()")
+    parser.add_argument("--no-r", action="store_true", help="do not start R in the warm-up")
+    args = parser.parse_args()
+
+    runs = [measure(args.warm_up, not args.no_r) for _ in range(args.repeat)]
+    imports = [run["import"] for run in runs]
+    print("import TrendEngine: median %.3f s, min %.3f s, max %.3f s" % (
+        statistics.median(imports), min(imports), max(imports)
+    ))
+    print("heavy modules loaded by the import: %s" % (", ".join(runs[0]["loaded"]) or "none"))
+    if args.warm_up:
+        for step in runs[0]["warm_up"]:
+            times = [run["warm_up"][step] for run in runs]
+            print("warm-up %s: median %.3f s" % (step, statistics.median(times)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+import os
+
+# the offline stand-in replaces Earth Engine, see TrendEngine/calculations/offline_ee.py
+os.environ.setdefault("TRENDENGINE_EE_BACKEND", "offline")
@@ -0,0 +1,24 @@
+from TrendEngine.calculations.cache import make_result_key, snap_coordinates
+from TrendEngine.calculations.grid import grid_latitude, grid_step
+
+SCALE = 250
+
+
+def test_points_snap_to_the_centre_of_their_grid_pixel():
+    width, height = grid_step(SCALE, grid_latitude([53.0]))
+    centre = [(5600 + 0.5) * width, (23600 + 0.5) * height]
+    assert snap_coordinates(centre, SCALE) == [round(c, 6) for c in centre]
+    for dx, dy in [(-0.4, -0.4), (0.4, 0.1), (0.1, 0.4)]:
+        point = [centre[0] + dx * width, centre[1] + dy * height]
+        assert snap_coordinates(point, SCALE) == snap_coordinates(centre, SCALE)
+    outside = [centre[0] + 0.6 * width, centre[1]]
+    assert snap_coordinates(outside, SCALE) != snap_coordinates(centre, SCALE)
+
+
+def test_polygons_are_keyed_on_their_rounded_vertices():
+    vertices = [14.0, 53.0, 14.3, 53.0, 14.3, 53.2, 14.0, 53.2]
+    key = make_result_key("polytrend", "MODIS", vertices, 2005, 2010, {"alpha": 0.05})
+    nudged = [vertices[0] + 1e-9] + vertices[1:]
+    assert make_result_key("polytrend", "MODIS", nudged, 2005, 2010, {"alpha": 0.05}) == key
+    moved = [vertices[0] + 1e-4] + vertices[1:]
+    assert make_result_key("polytrend", "MODIS", moved, 2005, 2010, {"alpha": 0.05}) != key
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from TrendEngine.calculations.compositing import composite
+
+
+def make_raw():
+    """ Two pixels, observations in January and July of 2001 and 2002 """
+    times = pd.to_datetime(
+        ["2001-01-01", "2001-01-17", "2001-07-01", "2002-01-01", "2002-07-01", "2003-01-01"]
+    )
+    return pd.DataFrame(
+        {
+            "longitude": np.repeat([1.0, 2.0], len(times)),
+            "latitude": 5.0,
+            "time": np.tile(times.values, 2),
+            "NDVI": [1, 3, 5, 7, np.nan, 100, 2, 4, 6, 8, 10, 100],
+        }
+    )
+
+
+def test_annual_mean_and_max():
+    mean = composite(make_raw(), "NDVI", "annual", "mean", 2001, 2002)
+    assert mean["time"].tolist() == [2001, 2002, 2001, 2002]
+    assert mean["longitude"].tolist() == [1.0, 1.0, 2.0, 2.0]
+    # the masked observation is skipped, 2003 is outside the period
+    np.testing.assert_allclose(mean["NDVI"], [3, 7, 4, 9])
+    maximum = composite(make_raw(), "NDVI", "annual", "max", 2001, 2002)
+    np.testing.assert_allclose(maximum["NDVI"], [5, 7, 6, 10])
+
+
+def test_monthly_mean_leaves_months_without_observations_missing():
+    monthly = composite(make_raw(), "NDVI", "monthly", "mean", 2001, 2002)
+    assert len(monthly) == 2 * 24
+    first = monthly[monthly["longitude"] == 1.0]
+    assert first["time"].iloc[6] == np.datetime64("2001-07-01")
+    values = first["NDVI"].values
+    assert values[0] == 2 and values[6] == 5 and values[12] == 7
+    # July 2002 has only a masked observation
+    assert np.isnan(values[18])
+    assert np.isnan(values[1])
+
+
+def test_unknown_period_or_reducer():
+    with pytest.raises(ValueError):
+        composite(make_raw(), "NDVI", "weekly", "mean", 2001, 2002)
+    with pytest.raises(ValueError):
+        composite(make_raw(), "NDVI", "annual", "median", 2001, 2002)
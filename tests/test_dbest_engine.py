@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from TrendEngine.calculations import dbest_engine, rbridge
+
+MONTHS = 72
+PARAMETERS = dict(
+    data_type="cyclical",
+    seasonality=12,
+    algorithm="changedetection",
+    breakpoints_no=3,
+    first_level_shift=0.1,
+    second_level_shift=0.2,
+    duration=24,
+    distance_threshold="default",
+    alpha=0.05,
+)
+
+
+def seasonal(months=MONTHS):
+    return 0.5 + 0.1 * np.sin(2 * np.pi * np.arange(months) / 12)
+
+
+def test_flat_and_seasonal_series_have_no_change():
+    Y = np.vstack([np.full(MONTHS, 0.5), seasonal()])
+    values = dbest_engine.dbest(Y, **PARAMETERS)
+    assert values.shape == (2, len(dbest_engine.RESULT_FIELDS))
+    assert np.isnan(values).all()
+
+
+def test_flat_series_point_has_no_breakpoint():
+    result = dbest_engine.dbest_point(np.full(MONTHS, 0.5), **PARAMETERS)
+    fields = dict(zip(dbest_engine.CHANGE_DETECTION_FIELDS, result[0]))
+    assert fields["breakpoint_no"][0] == 0
+    assert len(fields["start"]) == 0
+
+
+def test_abrupt_change_is_found():
+    months = np.arange(MONTHS)
+    y = seasonal() + np.where(months >= 36, 0.3, 0.0)
+    start, duration, end, change, change_type, significance = dbest_engine.dbest(
+        y[None, :], **PARAMETERS
+    )[0]
+    assert change == pytest.approx(0.3, abs=0.02)
+    assert change_type == 1
+    assert significance == 1
+    assert abs(start - 36) <= 1
+
+
+def test_gradual_change_is_found():
+    months = np.arange(MONTHS)
+    y = seasonal() + np.clip((months - 30) / 12, 0, 1) * 0.2
+    start, duration, end, change, change_type, significance = dbest_engine.dbest(
+        y[None, :], **PARAMETERS
+    )[0]
+    assert change > 0.1
+    assert change_type == 0
+    assert significance == 1
+
+
+def test_noise_is_rarely_significant():
+    Y = 0.5 + 0.02 * np.random.RandomState(0).randn(200, MONTHS)
+    values = dbest_engine.dbest(Y, **PARAMETERS)
+    significant = np.nan_to_num(values[:, 5]) == 1
+    assert significant.mean() <= PARAMETERS["alpha"]
+
+
+def test_generalization_keeps_at_most_breakpoints_no_breakpoints():
+    months = np.arange(MONTHS)
+    y = seasonal() + 0.1 * np.abs(np.sin(months / 7))
+    parameters = dict(PARAMETERS, algorithm="generalization", breakpoints_no=1)
+    result = dbest_engine.dbest_point(y, **parameters)
+    fields = dict(zip(dbest_engine.GENERALIZATION_FIELDS, result[0]))
+    assert fields["segment_no"][0] <= 2
+
+
+def test_chunks_give_the_same_result():
+    Y = seasonal() + 0.05 * np.random.RandomState(1).randn(7, MONTHS)
+    whole = dbest_engine.dbest(Y, **PARAMETERS)
+    chunked = dbest_engine.dbest(Y, chunk_size=3, **PARAMETERS)
+    np.testing.assert_array_equal(whole, chunked)
+
+
+def test_compare_with_r_counts_mismatches(monkeypatch):
+    step = np.where(np.arange(MONTHS) >= 36, 0.3, 0.0)
+    Y = np.vstack([np.full(MONTHS, 0.5), seasonal() + step])
+    values = dbest_engine.dbest(Y, **PARAMETERS)
+    expected = values.copy()
+    expected[1, 0] += 1
+    monkeypatch.setattr(rbridge, "dbest_batch", lambda Y, parameters: expected)
+    report = dbest_engine.compare_with_r(Y, PARAMETERS, values)
+    assert report["pixels"] == 2
+    assert report["mismatches"]["start"] == 1
+    assert report["mismatches"]["change"] == 0
+    assert report["max_change_difference"] == 0.0
@@ -0,0 +1,29 @@
+from TrendEngine.calculations import fetch
+from TrendEngine.calculations.grid import grid_step
+
+SCALE = 250
+WIDTH, HEIGHT = grid_step(SCALE, 50.0)
+
+
+def test_small_area_is_one_tile():
+    bounds = (10.0, 50.0, 10.0 + 10 * WIDTH, 50.0 + 10 * HEIGHT)
+    assert fetch.plan_tiles(bounds, SCALE, 20) == [bounds]
+
+
+def test_tiles_cover_the_area_and_stay_under_the_limit():
+    bounds = (10.0, 50.0, 12.0, 51.0)
+    images = 20
+    tiles = fetch.plan_tiles(bounds, SCALE, images)
+    limit = fetch.MAX_REGION_ELEMENTS * fetch.TILE_FILL
+    assert len(tiles) >= fetch.estimate_elements(bounds, SCALE, images) / limit
+    for tile in tiles:
+        assert fetch.estimate_elements(tile, SCALE, images) <= fetch.MAX_REGION_ELEMENTS
+    area = sum((west - east) * (south - north) for west, south, east, north in tiles)
+    assert abs(area - 2.0) < 1e-9
+    assert min(tile[0] for tile in tiles) == 10.0 and max(tile[2] for tile in tiles) == 12.0
+    assert min(tile[1] for tile in tiles) == 50.0 and max(tile[3] for tile in tiles) == 51.0
+
+
+def test_more_bands_give_more_tiles():
+    bounds = (10.0, 50.0, 12.0, 51.0)
+    assert len(fetch.plan_tiles(bounds, SCALE, 20, 2)) > len(fetch.plan_tiles(bounds, SCALE, 20))
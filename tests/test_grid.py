@@ -0,0 +1,33 @@
+import math
+
+import numpy as np
+import pytest
+
+from TrendEngine.calculations.grid import grid_latitude, grid_step, grid_transform, pixel_grid
+
+SCALE = 250
+
+
+def test_aois_with_their_centre_in_one_band_share_a_grid():
+    assert grid_latitude([53.1, 53.9]) == grid_latitude([52.6, 54.2]) == 53.5
+    assert grid_latitude([-0.4, 0.2]) == -0.5
+    assert grid_latitude([12.3]) == 12.5
+
+
+def test_pixels_are_square_in_meters_at_the_grid_latitude():
+    width, height = grid_step(SCALE, 53.5)
+    assert height == pytest.approx(SCALE / 111320.0)
+    assert width * math.cos(math.radians(53.5)) == pytest.approx(height)
+    assert grid_step(SCALE, 0.0) == (height, height)
+    assert grid_transform(SCALE, 53.5) == [width, 0, 0, 0, -height, 0]
+
+
+def test_pixel_grid_positions():
+    width, height = grid_step(SCALE, 53.5)
+    longitudes = (np.array([100, 101, 100, 102]) + 0.5) * width
+    latitudes = (np.array([700, 700, 699, 698]) + 0.5) * height
+    origin, resolution, rows, cols = pixel_grid(longitudes, latitudes, SCALE, 53.5)
+    assert resolution == (width, height)
+    assert origin == pytest.approx((100.5 * width, 700.5 * height))
+    np.testing.assert_array_equal(rows, [0, 0, 1, 2])
+    np.testing.assert_array_equal(cols, [0, 1, 0, 2])
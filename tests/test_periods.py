@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+
+from TrendEngine.calculations.periods import missing_runs, year_of_rows
+
+
+def test_missing_runs():
+    assert missing_runs([]) == []
+    assert missing_runs([2001]) == [(2001, 2001)]
+    assert missing_runs([2001, 2002, 2003, 2010, 2012, 2013]) == [
+        (2001, 2003),
+        (2010, 2010),
+        (2012, 2013),
+    ]
+
+
+def test_year_of_rows():
+    dates = pd.DataFrame({"time": pd.to_datetime(["2001-01-01", "2002-12-31"])})
+    np.testing.assert_array_equal(year_of_rows(dates), [2001, 2002])
+    years = pd.DataFrame({"time": [2001, 2002]})
+    np.testing.assert_array_equal(year_of_rows(years), [2001, 2002])
+    # raw images, milliseconds since the epoch
+    milliseconds = pd.DataFrame({"time": [978307200000, 1041379199000]})
+    np.testing.assert_array_equal(year_of_rows(milliseconds), [2001, 2002])
@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+
+from TrendEngine.calculations.grid import grid_latitude, grid_step
+from TrendEngine.calculations.pixelcube import PixelCube
+from TrendEngine.calculations.pixelstore import PixelStore, PolygonLookup, points_in_polygon
+from TrendEngine.calculations.results import ResultTable
+
+SCALE = 8000
+# rows 740 to 780 lie between 53 and 56 degrees north
+HEIGHT = grid_step(SCALE, 0)[1]
+LATITUDE = grid_latitude([740 * HEIGHT, 780 * HEIGHT])
+WIDTH = grid_step(SCALE, LATITUDE)[0]
+
+
+def bounds(west, south, east, north):
+    """ Edges of pixels in degrees, from global columns and rows """
+    return [west * WIDTH, south * HEIGHT, east * WIDTH, north * HEIGHT]
+
+
+def rectangle(west, south, east, north):
+    """ Polygon along the edges of pixels, from global columns and rows """
+    west, south, east, north = bounds(west, south, east, north)
+    return [west, south, east, south, east, north, west, north]
+
+
+# square of 40 x 40 pixels, crossing the edge of two blocks
+SQUARE = rectangle(20, 740, 60, 780)
+
+
+def make_cube(columns, rows, years=3):
+    """ Cube of pixels of the grid, with the pixel centres of getRegion """
+    longitudes = (np.repeat(columns, years) + 0.5) * WIDTH
+    latitudes = (np.repeat(rows, years) + 0.5) * HEIGHT
+    dataset = pd.DataFrame(
+        {
+            "longitude": longitudes,
+            "latitude": latitudes,
+            "time": np.tile(np.arange(years), len(columns)),
+            "ndvi": 0.5,
+        }
+    )
+    return PixelCube.from_dataset(dataset, "ndvi", SCALE, LATITUDE)
+
+
+def analyse(cube):
+    """ PolyTrend result with the column of each pixel as its slope """
+    result = ResultTable.allocate("polytrend", cube, np.arange(cube.number_of_pixels))
+    result.fields["slope"][:] = np.floor(cube.longitudes / WIDTH)
+    return result
+
+
+def test_points_in_polygon():
+    # L shape, the notch at the north east is outside
+    polygon = [0, 0, 2, 0, 2, 1, 1, 1, 1, 2, 0, 2]
+    longitudes = np.array([0.5, 1.5, 0.5, 1.5, 3.0, -0.5])
+    latitudes = np.array([0.5, 0.5, 1.5, 1.5, 0.5, 0.5])
+    inside = points_in_polygon(longitudes, latitudes, polygon)
+    np.testing.assert_array_equal(inside, [True, True, True, False, False, False])
+
+
+def test_store_keeps_the_pixels_of_every_block(tmp_path):
+    store = PixelStore("polytrend", "key", SCALE, LATITUDE, directory=str(tmp_path))
+    table = store.empty_table()
+    table = pd.DataFrame(
+        {
+            "column": np.array([1, 40, 40], dtype=np.int32),
+            "row": np.array([1, 1, -5], dtype=np.int32),
+            "has_result": [True, False, True],
+            **{name: np.zeros(3, dtype=table[name].dtype) for name in table.columns[3:]},
+        }
+    )
+    store.add(table)
+    assert len(list(tmp_path.joinpath("key").iterdir())) == 3
+    read = store.read(store.blocks_of(table["column"], table["row"]))
+    assert sorted(zip(read["column"], read["row"])) == [(1, 1), (40, -5), (40, 1)]
+    # a pixel added again replaces the stored one
+    store.add(table.iloc[[1]].assign(has_result=True))
+    assert store.read([(1, 0)])["has_result"].all()
+
+
+def test_pixels_of_a_polygon():
+    store = PixelStore("polytrend", "key", SCALE, LATITUDE, directory="/nonexistent")
+    lookup = PolygonLookup(store, SQUARE)
+    assert len(lookup.columns) == 40 * 40
+    assert lookup.columns.min() == 20 and lookup.columns.max() == 59
+    assert lookup.rows.min() == 740 and lookup.rows.max() == 779
+    assert lookup.missing.all()
+
+
+def test_only_missing_pixels_are_fetched_and_analysed(tmp_path):
+    store = PixelStore("polytrend", "key", SCALE, LATITUDE, directory=str(tmp_path))
+    columns, rows = [grid.ravel() for grid in np.meshgrid(np.arange(15, 65), np.arange(735, 785))]
+
+    first = PolygonLookup(store, SQUARE)
+    geometry, coordinates = first.fetch_area()
+    assert coordinates[len(SQUARE):] == bounds(20, 740, 60, 780)
+    # the fetched cube may have pixels outside the polygon
+    cube = first.select(make_cube(columns, rows))
+    assert cube.number_of_pixels == 40 * 40
+    result = first.merge(analyse(cube))
+    assert len(result) == 40 * 40
+
+    # the west half is stored, only the east half is fetched
+    shifted = rectangle(40, 740, 80, 780)
+    second = PolygonLookup(store, shifted)
+    assert second.missing.sum() == 20 * 40
+    _, coordinates = second.fetch_area()
+    assert coordinates[len(SQUARE):] == bounds(60, 740, 80, 780)
+    columns, rows = [grid.ravel() for grid in np.meshgrid(np.arange(60, 80), np.arange(740, 780))]
+    cube = second.select(make_cube(columns, rows))
+    assert cube.number_of_pixels == 20 * 40
+    result = second.merge(analyse(cube))
+    assert len(result) == 40 * 40
+    np.testing.assert_array_equal(result["slope"], np.floor(result.longitudes / WIDTH))
+
+    # every pixel of the second polygon is stored now
+    assert PolygonLookup(store, shifted).fetch_area() == (None, None)
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+from scipy import stats
+
+from TrendEngine.calculations import polytrend_engine, rbridge
+
+YEARS = np.arange(1, 21, dtype=np.float64)
+# small deterministic noise, so that the fits are not perfect
+NOISE = 0.01 * np.sin(7 * YEARS)
+
+
+def classify(y, alpha=0.05):
+    result = polytrend_engine.polytrend(y[None, :], alpha)
+    return {field: values[0] for field, values in result.items()}
+
+
+def test_fit_polynomial_matches_polyfit():
+    Y = np.vstack([0.3 + 0.01 * YEARS + NOISE, 0.01 * (YEARS - 5) ** 2 + NOISE])
+    for degree in (1, 2, 3):
+        coefficients, _ = polytrend_engine.fit_polynomial(Y, degree)
+        for row, y in zip(coefficients, Y):
+            expected = np.polyfit(YEARS, y, degree)[::-1]
+            np.testing.assert_allclose(row, expected, rtol=1e-8, atol=1e-12)
+
+
+def test_linear_p_value_matches_linregress():
+    y = 0.5 + 0.002 * YEARS + 0.02 * np.cos(5 * YEARS)
+    _, p_values = polytrend_engine.fit_polynomial(y[None, :], 1)
+    assert p_values[0, 1] == pytest.approx(stats.linregress(YEARS, y).pvalue)
+
+
+def test_linear_trend():
+    result = classify(0.3 + 0.01 * YEARS + NOISE)
+    assert result["trend_type"] == 1
+    assert result["slope"] == pytest.approx(0.01, abs=1e-3)
+    assert result["direction"] == 1
+    assert result["significance"] == 1
+
+
+def test_no_trend():
+    result = classify(0.5 + NOISE)
+    assert result["trend_type"] == 0
+    assert result["significance"] == -1
+
+
+def test_quadratic_trend():
+    result = classify(0.01 * (YEARS - 5) ** 2 + NOISE)
+    assert result["trend_type"] == 2
+    assert result["significance"] == 1
+
+
+def test_symmetric_quadratic_trend_is_concealed():
+    result = classify(0.01 * (YEARS - 10.5) ** 2 + NOISE)
+    assert result["trend_type"] == -1
+    assert result["degree"] == 2
+    assert result["significance"] == -1
+
+
+def test_cubic_trend():
+    y = 0.001 * (YEARS - 6) * (YEARS - 10) * (YEARS - 17) + 0.02 * YEARS + NOISE
+    result = classify(y)
+    assert result["trend_type"] == 3
+    assert result["direction"] == 1
+
+
+def test_cubic_with_extreme_outside_the_period_is_not_cubic():
+    y = 0.001 * (YEARS - 4) * (YEARS - 10) * (YEARS - 17) + 0.05 * YEARS + NOISE
+    assert classify(y)["trend_type"] == 1
+
+
+def test_chunks_give_the_same_result():
+    Y = 0.5 + 0.05 * np.random.RandomState(0).randn(11, len(YEARS)) + 0.01 * YEARS
+    whole = polytrend_engine.polytrend(Y, 0.05)
+    chunked = polytrend_engine.polytrend(Y, 0.05, chunk_size=4)
+    for field in polytrend_engine.RESULT_FIELDS:
+        np.testing.assert_array_equal(whole[field], chunked[field])
+
+
+def test_compare_with_r_counts_mismatches(monkeypatch):
+    Y = np.vstack([0.3 + 0.01 * YEARS + NOISE, 0.5 + NOISE])
+    result = polytrend_engine.polytrend(Y, 0.05)
+    expected = {field: values.copy() for field, values in result.items()}
+    expected["trend_type"][1] = 3
+    expected["slope"][0] *= 1.1
+    monkeypatch.setattr(rbridge, "polytrend_batch", lambda Y, alpha: expected)
+    report = polytrend_engine.compare_with_r(Y, 0.05, result)
+    assert report["pixels"] == 2
+    assert report["mismatches"]["trend_type"] == 1
+    assert report["mismatches"]["slope"] == 1
+    assert report["mismatches"]["direction"] == 0
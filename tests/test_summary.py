@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from TrendEngine.calculations.summary import Histogram
+
+
+def test_values_in_range_are_counted_in_their_bin():
+    histogram = Histogram(bins=4)
+    histogram.update([0.0, 1.0, 2.0, 3.0, 4.0])
+    assert histogram.to_dict()["counts"] == [1, 1, 1, 2]
+
+
+def test_bins_are_merged_when_the_range_grows():
+    histogram = Histogram(bins=4)
+    histogram.update([0.0, 4.0])
+    histogram.update([7.0])
+    summary = histogram.to_dict()
+    assert summary["edges"] == [0.0, 2.0, 4.0, 6.0, 8.0]
+    # 4.0 was in the last bin, [3, 4], merged into [2, 4]
+    assert summary["counts"] == [1, 1, 0, 1]
+    histogram.update([-1.0])
+    summary = histogram.to_dict()
+    assert summary["edges"][0] < -1.0 and summary["edges"][-1] >= 7.0
+    assert sum(summary["counts"]) == summary["count"] == 4
+    assert summary["min"] == -1.0 and summary["max"] == 7.0
+    assert summary["mean"] == 2.5
+
+
+def test_chunks_give_the_counts_of_all_values_at_once():
+    values = np.random.RandomState(0).normal(size=1000)
+    whole, chunked = Histogram(), Histogram()
+    whole.update(values)
+    for chunk in np.array_split(np.sort(values), 10):
+        chunked.update(chunk)
+    assert sum(chunked.to_dict()["counts"]) == whole.to_dict()["count"] == 1000
+    assert chunked.to_dict()["mean"] == pytest.approx(whole.to_dict()["mean"])
+
+
+def test_missing_values_are_not_counted():
+    histogram = Histogram()
+    histogram.update([np.nan, np.nan])
+    assert histogram.to_dict() == {"edges": [], "counts": [], "count": 0}
+    histogram.update([1.0, np.nan, np.inf])
+    assert histogram.to_dict()["count"] == 1